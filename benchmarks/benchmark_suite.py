@@ -0,0 +1,182 @@
+"""
+Times the main entry points of the project on synthetic datasets of several
+sizes without any network access, recording the time and peak memory of each
+run to a .json file that can be compared between commits.
+
+    python benchmarks/benchmark_suite.py -s small medium -o benchmark_results.json
+    python benchmarks/benchmark_suite.py -s small -o new.json -c benchmark_results.json
+"""
+import os, sys, gc, json, time, shutil, argparse, platform, tempfile, subprocess, tracemalloc
+import numpy as np
+import pandas as pd
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from covid_data import CovidData
+from datasetmanager import AirportToLocation
+from infection_path import get_infection_path
+from sweep import initial_infect_thresh
+from synthetic_dataset import SCALES, generate_dataset
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the project on synthetic datasets")
+    parser.add_argument("-s", "--scales", type=str, nargs='+', default=['small', 'medium'], choices=sorted(SCALES),
+                        help="the dataset sizes to benchmark")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+                        help="the number of timed runs of each benchmark, the fastest is reported")
+    parser.add_argument("-b", "--benchmarks", type=str, nargs='+', default=None,
+                        help="only run these benchmarks")
+    parser.add_argument("-o", "--output", type=str, default="benchmark_results.json",
+                        help="the .json file to write the results to")
+    parser.add_argument("-c", "--compare", type=str, default=None,
+                        help="a .json file from an earlier run to compare against")
+    parser.add_argument("--no_memory", action="store_true",
+                        help="skip the extra run of each benchmark that measures peak memory")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_FOLDER, capture_output=True,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_get_data(covid_data, bin_region_column):
+    def run():
+        covid_data.clearCache()
+        covid_data.getData(bin_region_column)
+    return run
+
+def bench_routes(covid_data, bin_region_column):
+    def run():
+        covid_data.clearCache()
+        covid_data.routesToWeightedEdges(bin_region_column, None)
+    return run
+
+def bench_airport_to_location(covid_data):
+    def run():
+        AirportToLocation(covid_data.confirmed_df).generateNewAirportToLocationDataset()
+    return run
+
+def bench_border_dataset(covid_data):
+    def run():
+        covid_data.createBorderDataset()
+    return run
+
+def bench_infection_path(covid_data, bin_region_column, border_closures):
+    data, routes = covid_data.getData(bin_region_column)
+    data_confirmed = data['confirmed']
+    infect_thresh = initial_infect_thresh(data_confirmed[covid_data.getDates()].to_numpy(), 1.0)
+    border_closure_index = covid_data.getBorderClosureIndex() if border_closures else None
+    def run():
+        get_infection_path(data_confirmed, routes, infect_thresh, bin_region_column,
+                           border_closures=border_closure_index)
+    return run
+
+BENCHMARKS = [
+    ('getData county',              lambda covid_data: bench_get_data(covid_data, 'county')),
+    ('getData state',               lambda covid_data: bench_get_data(covid_data, 'state')),
+    ('getData country',             lambda covid_data: bench_get_data(covid_data, 'country')),
+    ('routesToWeightedEdges county', lambda covid_data: bench_routes(covid_data, 'county')),
+    ('routesToWeightedEdges state', lambda covid_data: bench_routes(covid_data, 'state')),
+    ('routesToWeightedEdges country', lambda covid_data: bench_routes(covid_data, 'country')),
+    ('generateNewAirportToLocationDataset', bench_airport_to_location),
+    ('createBorderDataset',         bench_border_dataset),
+    ('infection path state',        lambda covid_data: bench_infection_path(covid_data, 'state', False)),
+    ('infection path state borders', lambda covid_data: bench_infection_path(covid_data, 'state', True)),
+    ('infection path country',      lambda covid_data: bench_infection_path(covid_data, 'country', False)),
+]
+
+def measure(run, repeats, memory):
+    """
+    Times repeats runs of run and, if memory is True, does one more run under
+    tracemalloc to find its peak memory since tracing slows the code down.
+    """
+    seconds = []
+    for _ii in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+
+    peak_bytes = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak_bytes
+
+def run_scale(scale, benchmark_names, repeats, memory, seed):
+    work_folder = tempfile.mkdtemp()
+    previous_folder = os.getcwd()
+    results = []
+    try:
+        # CovidData uses paths relative to the working directory
+        os.chdir(work_folder)
+        generate_dataset('dataset', seed=seed, **SCALES[scale])
+        covid_data = CovidData()
+        covid_data.createBorderDataset()
+
+        for name, setup in BENCHMARKS:
+            if not benchmark_names is None and not name in benchmark_names:
+                continue
+            seconds, peak_bytes = measure(setup(covid_data), repeats, memory)
+            results.append({
+                'benchmark'  : name,
+                'scale'      : scale,
+                'seconds'    : min(seconds),
+                'all_seconds': seconds,
+                'peak_bytes' : peak_bytes
+            })
+            print("{:<8} {:<38} {:>9.4f}s {:>12}".format(scale, name, min(seconds),
+                  "-" if peak_bytes is None else "{:.1f} MB".format(peak_bytes/2**20)))
+    finally:
+        os.chdir(previous_folder)
+        shutil.rmtree(work_folder)
+    return results
+
+def compare(results, previous_results):
+    previous = {(result['benchmark'], result['scale']) : result for result in previous_results['results']}
+    print("\nCompared with {}".format(previous_results.get('commit')))
+    for result in results:
+        key = (result['benchmark'], result['scale'])
+        if not key in previous:
+            continue
+        speedup = previous[key]['seconds']/result['seconds'] if result['seconds'] > 0 else float('inf')
+        print("{:<8} {:<38} {:>9.4f}s -> {:>9.4f}s {:>7.2f}x".format(key[1], key[0], previous[key]['seconds'],
+              result['seconds'], speedup))
+
+def main():
+    args = parse_args()
+    results = []
+    for scale in args.scales:
+        results.extend(run_scale(scale, args.benchmarks, args.repeats, not args.no_memory, args.seed))
+
+    summary = {
+        'commit'   : git_commit(),
+        'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'   : platform.python_version(),
+        'numpy'    : np.__version__,
+        'pandas'   : pd.__version__,
+        'seed'     : args.seed,
+        'repeats'  : args.repeats,
+        'scales'   : {scale : SCALES[scale] for scale in args.scales},
+        'results'  : results
+    }
+    with open(args.output, 'w') as fp:
+        json.dump(summary, fp, indent=2)
+    print("\nWrote results to {}".format(args.output))
+
+    if not args.compare is None:
+        with open(args.compare, 'r') as fp:
+            compare(results, json.load(fp))
+
+if __name__ == "__main__":
+    main()
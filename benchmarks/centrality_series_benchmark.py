@@ -0,0 +1,101 @@
+"""
+Compares centrality_series with networkx on the infection graphs of every
+date, with and without key locations, on a synthetic dataset and times both.
+
+    python benchmarks/centrality_series_benchmark.py -s medium
+"""
+import os, sys, json, time, shutil, argparse, tempfile
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import networkx as nx
+from covid_data import CovidData
+from sweep import ScenarioData
+from centrality import centrality_series
+from synthetic_dataset import SCALES, generate_dataset
+
+NETWORKX_CENTRALITIES = {
+    'degree'      : nx.degree_centrality,
+    'closeness'   : nx.closeness_centrality,
+    'betweenness' : nx.betweenness_centrality,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compares centrality_series with networkx on the infection graphs")
+    parser.add_argument("-s", "--scale", type=str, default='medium', choices=sorted(SCALES),
+                        help="the size of the synthetic dataset")
+    parser.add_argument("-p", "--percentiles", type=float, nargs='+', default=[50, 80, 95],
+                        help="percentiles of the latest cases used as the infect threshold")
+    parser.add_argument("-k", "--key_steps", type=int, nargs='+', default=[0, 2, 4],
+                        help="every key_step-th location is a key location, 0 for no key locations")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="a .json file to write the results to")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+def networkx_series(infect_graphs):
+    return {date : {metric : centrality(infect_graphs[date]) for metric, centrality in NETWORKX_CENTRALITIES.items()}
+            for date in infect_graphs}
+
+def max_difference(series, expected):
+    """
+    Returns the largest difference between the values of centrality_series
+    and networkx, asserting they have the same locations on every date.
+    """
+    difference = 0.0
+    for date, centralities in expected.items():
+        for metric, values in centralities.items():
+            column = series[metric][date].dropna()
+            assert set(column.index) == set(values), "Different locations on {} for {}".format(date, metric)
+            for location, value in values.items():
+                difference = max(difference, abs(column[location] - value))
+    return difference
+
+def main():
+    args = parse_args()
+    work_folder = tempfile.mkdtemp()
+    current_folder = os.getcwd()
+    results = {'scale' : args.scale, 'runs' : []}
+    try:
+        generate_dataset(os.path.join(work_folder, 'dataset'), seed=args.seed, **SCALES[args.scale])
+        os.chdir(work_folder)
+        data = ScenarioData.fromCovidData(CovidData(), 'state')
+        engine = data.getEngine()
+        location_names = list(engine.location_names)
+
+        print("{:>10} {:>8} {:>8} {:>12} {:>12} {:>10}".format('percentile', 'key step', 'removed', 'series s',
+                                                               'networkx s', 'max diff'))
+        for percentile in args.percentiles:
+            infect_thresh = np.percentile(data.cases[:, -1], percentile)
+            for key_step in args.key_steps:
+                key_locations = location_names[::key_step] if key_step > 0 else None
+                infect_graphs = engine.run(infect_thresh, key_locations=key_locations)[0]
+
+                start = time.perf_counter()
+                series = centrality_series(infect_graphs)
+                series_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                expected = networkx_series(infect_graphs)
+                networkx_seconds = time.perf_counter() - start
+
+                run = {'percentile' : percentile, 'key_step' : key_step,
+                       'removed' : sum(len(removed_nodes) for _nodes, _edges, removed_nodes, _confirmed in infect_graphs.deltas),
+                       'series_seconds' : series_seconds, 'networkx_seconds' : networkx_seconds,
+                       'max_difference' : max_difference(series, expected)}
+                results['runs'].append(run)
+                print("{percentile:>10.0f} {key_step:>8} {removed:>8} {series_seconds:>12.3f} {networkx_seconds:>12.3f} {max_difference:>10.2e}".format(**run))
+                assert run['max_difference'] < 1e-9, "centrality_series does not match networkx"
+    finally:
+        os.chdir(current_folder)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    if not args.output is None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print("\nWrote results to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
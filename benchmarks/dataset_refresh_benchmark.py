@@ -0,0 +1,158 @@
+"""
+Measures how long CovidManager.downloadDataset takes and how many bytes it
+downloads when refreshing the COVID datasets from a local stub server.
+
+    python benchmarks/dataset_refresh_benchmark.py -l 0.05
+
+With --history it instead measures a refresh that adds one date to synthetic
+datasets with more and more dates, to check the delta ingest does not grow
+with the history:
+
+    python benchmarks/dataset_refresh_benchmark.py --history 100 200 400 800
+"""
+import os, sys, time, shutil, argparse, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd
+from datasetmanager import CovidManager, is_date_column
+from stub_dataset_server import StubDatasetServer
+from synthetic_dataset import SCALES, generate_dataset
+
+DATA_LABELS = ['covid_confirmed', 'covid_deaths', 'covid_recovered', 'covid_us_confirmed', 'covid_us_deaths', 'iso_table']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks refreshing the COVID datasets against a local stub server")
+    parser.add_argument("-d", "--dataset_folder", type=str, default="dataset",
+                        help="folder with the .csv files served by the stub server")
+    parser.add_argument("-l", "--latency", type=float, default=0.05,
+                        help="seconds the stub server waits before responding")
+    parser.add_argument("-t", "--download_threads", type=int, default=6)
+    parser.add_argument("-p", "--port", type=int, default=8766)
+    parser.add_argument("--history", type=int, nargs='+', default=None,
+                        help="the numbers of dates of the synthetic datasets to refresh")
+    parser.add_argument("-s", "--scale", type=str, default='medium', choices=sorted(SCALES),
+                        help="the number of locations of the synthetic datasets for --history")
+    return parser.parse_args()
+
+def change_dataset(filename):
+    # Appending a blank line changes the content but not the parsed dataset
+    with open(filename, 'a') as fp:
+        fp.write('\n')
+
+def refresh(name, local_folder, server, download_threads, forget_validators=False):
+    manager = CovidManager(dataset_folder=local_folder, dataset_urls_csv=os.path.join(local_folder, 'dataset_urls.csv'),
+                           backup_folder=os.path.join(local_folder, 'backup_covid/'), download_threads=download_threads)
+    if forget_validators and os.path.isfile(manager.validators_fn):
+        os.remove(manager.validators_fn)
+
+    requests_before = server.getStats()
+    start = time.perf_counter()
+    manager.downloadDataset()
+    seconds = time.perf_counter() - start
+
+    metrics = manager.getRefreshMetrics()
+    statuses = [metrics['datasets'][data_label]['status'] for data_label in DATA_LABELS]
+    sent = server.getStats()['bytes_sent'] - requests_before['bytes_sent']
+    print("{:<36} {:>7.2f}s {:>12} bytes {:>6} changed  full rebuilt: {}".format(
+        name, seconds, sent, statuses.count('changed'), metrics['full_rebuilt']))
+
+def publish(source_datasets, upstream_folder, num_dates):
+    """
+    Writes the datasets with only their first num_dates dates to the folder
+    served by the stub server.
+    """
+    for data_label, df in source_datasets.items():
+        dates = [column for column in df.columns if is_date_column(column)]
+        if len(dates) > 0:
+            df = df[[column for column in df.columns if not is_date_column(column)] + dates[:num_dates]]
+        df.to_csv(os.path.join(upstream_folder, data_label + '.csv'), index=False)
+
+def refresh_history(args, work_folder):
+    """
+    Refreshes synthetic datasets of each size in args.history after one date
+    is added, timing the whole refresh, the delta ingest of the full datasets
+    and what exporting the full .csv files would add.
+    """
+    print("{:>6} {:>10} {:>10} {:>10} {:>6}".format('dates', 'refresh s', 'ingest s', 'export s', 'mode'))
+    scale = dict(SCALES[args.scale])
+    for num_dates in args.history:
+        history_folder = os.path.join(work_folder, str(num_dates))
+        source_folder = os.path.join(history_folder, 'source')
+        upstream_folder = os.path.join(history_folder, 'upstream')
+        local_folder = os.path.join(history_folder, 'local') + '/'
+        os.makedirs(upstream_folder)
+        os.makedirs(local_folder)
+        scale['num_dates'] = num_dates + 1
+        generate_dataset(source_folder, **scale)
+        source_datasets = {data_label : pd.read_csv(os.path.join(source_folder, data_label + '.csv')) for data_label in DATA_LABELS}
+
+        with StubDatasetServer(upstream_folder, port=args.port, latency=0) as server:
+            with open(os.path.join(local_folder, 'dataset_urls.csv'), 'w') as fp:
+                for data_label in DATA_LABELS:
+                    fp.write('{},{}\n'.format(data_label, server.getUrl(data_label + '.csv')))
+            publish(source_datasets, upstream_folder, num_dates)
+            CovidManager(dataset_folder=local_folder, dataset_urls_csv=os.path.join(local_folder, 'dataset_urls.csv'),
+                         backup_folder=os.path.join(local_folder, 'backup_covid/')).downloadDataset()
+
+            publish(source_datasets, upstream_folder, num_dates + 1)
+            manager = CovidManager(dataset_folder=local_folder, dataset_urls_csv=os.path.join(local_folder, 'dataset_urls.csv'),
+                                   backup_folder=os.path.join(local_folder, 'backup_covid/'), download_threads=args.download_threads)
+            ingest_seconds = []
+            ingest = manager.ingestFullDataset
+            def timed_ingest(datasets):
+                start = time.perf_counter()
+                full_datasets = ingest(datasets)
+                ingest_seconds.append(time.perf_counter() - start)
+                return full_datasets
+            manager.ingestFullDataset = timed_ingest
+
+            start = time.perf_counter()
+            manager.downloadDataset()
+            refresh_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            manager.exportFullDataset()
+            export_seconds = time.perf_counter() - start
+        print("{:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>6}".format(num_dates, refresh_seconds, sum(ingest_seconds), export_seconds,
+                                                                 manager.getChangeReport().get('mode', '-')))
+
+def main():
+    args = parse_args()
+    if not args.history is None:
+        work_folder = tempfile.mkdtemp()
+        try:
+            refresh_history(args, work_folder)
+        finally:
+            shutil.rmtree(work_folder)
+        return
+    work_folder = tempfile.mkdtemp()
+    upstream_folder = os.path.join(work_folder, 'upstream')
+    local_folder = os.path.join(work_folder, 'local') + '/'
+    os.makedirs(upstream_folder)
+    os.makedirs(local_folder)
+    for data_label in DATA_LABELS:
+        shutil.copyfile(os.path.join(args.dataset_folder, data_label + '.csv'), os.path.join(upstream_folder, data_label + '.csv'))
+
+    try:
+        for conditional in [True, False]:
+            with StubDatasetServer(upstream_folder, port=args.port, latency=args.latency, conditional=conditional) as server:
+                with open(os.path.join(local_folder, 'dataset_urls.csv'), 'w') as fp:
+                    for data_label in DATA_LABELS:
+                        fp.write('{},{}\n'.format(data_label, server.getUrl(data_label + '.csv')))
+
+                if conditional:
+                    refresh("serial, no validators (old)", local_folder, server, 1, forget_validators=True)
+                    refresh("concurrent, no validators", local_folder, server, args.download_threads, forget_validators=True)
+                    refresh("nothing changed (304)", local_folder, server, args.download_threads)
+                    change_dataset(os.path.join(upstream_folder, 'covid_recovered.csv'))
+                    refresh("covid_recovered changed", local_folder, server, args.download_threads)
+                    change_dataset(os.path.join(upstream_folder, 'covid_confirmed.csv'))
+                    refresh("covid_confirmed changed", local_folder, server, args.download_threads)
+                else:
+                    refresh("no conditional support, same hash", local_folder, server, args.download_threads)
+    finally:
+        shutil.rmtree(work_folder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+The threaded route downloader download_route_dataset.py used before it was
+moved to asyncio. Only kept so route_downloader_benchmark.py can compare the
+two, do not use it to build the dataset.
+"""
+import threading, queue
+import requests
+
+def get_info_from_iata(iata_code, airport_df):
+    """
+    NOTE: Not Thread Safe! Only call for the thread that puts data into dictionary
+    """
+    airport = airport_df.loc[airport_df['codeIataAirport'] == iata_code]
+    for _index, row in airport.iterrows():
+        return row['County'], row['Province/State'], row['Country/Region']
+    return None, None, None
+
+def call_api(api_call, api_key, iata_airport):
+    current_api_call = api_call.format(api_key = api_key, depart_codeIata=iata_airport)
+    try:
+        response = requests.get(url=current_api_call)
+    except:
+        print("Error connecting to server for Iata Code {}".format(iata_airport))
+        return "reset"
+    json_data = response.json()
+    if type(json_data) == type({}):
+        return None
+    return json_data
+
+def download_routes_threaded(airport_df, api_call, api_key, thread_num=8):
+    """
+    Downloads the routes with thread_num - 1 threads making the API calls and
+    one thread processing the routes.
+
+    returns:
+        The rows of the routes dataset.
+    """
+    depart_call_q = queue.Queue()
+    push_to_dict_q = queue.Queue()
+    rows = []
+
+    def worker_api_call():
+        while True:
+            depart_iata_airport, depart_county, depart_state, depart_country = depart_call_q.get()
+            if depart_iata_airport == None: break
+
+            routes = call_api(api_call, api_key, depart_iata_airport)
+
+            # If the connection is reset then put it back onto the queue
+            if routes == "reset":
+                depart_call_q.put((depart_iata_airport, depart_county, depart_state, depart_country))
+                depart_call_q.task_done()
+                continue
+            # Error handling json errors
+            if routes == None:
+                depart_call_q.task_done()
+                continue
+
+            push_to_dict_q.put((depart_iata_airport, depart_county, depart_state, depart_country, routes))
+            depart_call_q.task_done()
+
+    def worker_process():
+        while True:
+            depart_iata_airport, depart_county, depart_state, depart_country, routes = push_to_dict_q.get()
+            if depart_country == None: break
+
+            for route in routes:
+                arrival_iata_airport = route['arrivalIata']
+                arrival_county, arrival_state, arrival_country = get_info_from_iata(arrival_iata_airport, airport_df)
+                if arrival_state == None and arrival_country == None: continue
+                rows.append((depart_iata_airport, depart_county, depart_state, depart_country,
+                             arrival_iata_airport, arrival_county, arrival_state, arrival_country))
+
+            push_to_dict_q.task_done()
+
+    threads = []
+    for _t_num in range(thread_num - 1):
+        thread = threading.Thread(target=worker_api_call, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    processing_thread = threading.Thread(target=worker_process, daemon=True)
+    processing_thread.start()
+
+    for _index, row in airport_df.iterrows():
+        depart_call_q.put((row['codeIataAirport'], row['County'], row['Province/State'], row['Country/Region']))
+
+    depart_call_q.join()
+    for thread in threads:
+        depart_call_q.put((None, None, None, None))
+    for thread in threads:
+        thread.join()
+
+    push_to_dict_q.join()
+    push_to_dict_q.put((None, None, None, None, None))
+    processing_thread.join()
+    return rows
@@ -0,0 +1,89 @@
+"""
+Compares CovidData.getData reading only the dates and rows it needs from the
+COVID datasets with loading the whole datasets first, from the binary cache
+and from the .csv files, on a synthetic dataset.
+
+    python benchmarks/pushdown_benchmark.py -s large -r 3
+"""
+import os, sys, json, time, shutil, argparse, tempfile
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pandas as pd
+from covid_data import CovidData
+from datasetmanager import CovidManager
+from synthetic_dataset import SCALES, generate_dataset
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks getData with and without date, metric and country pushdown")
+    parser.add_argument("-s", "--scale", type=str, default='large', choices=sorted(SCALES),
+                        help="the size of the synthetic dataset")
+    parser.add_argument("-r", "--repeats", type=int, default=3,
+                        help="the number of times each query is timed, the fastest is kept")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="a .json file to write the results to")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+def get_queries(dates):
+    return [
+        ('state, latest',           {'bin_region_column' : 'state', 'specific_date' : 'latest'}),
+        ('county, last 14 days',    {'bin_region_column' : 'county', 'start_date' : dates[-14]}),
+        ('county, US',              {'bin_region_column' : 'county', 'country' : 'US'}),
+        ('country, deaths, 30 days', {'bin_region_column' : 'country', 'start_date' : dates[-30], 'metrics' : ['deaths']}),
+    ]
+
+def time_query(query, cache, pushdown, repeats):
+    """
+    Returns the fastest seconds a new CovidData takes to answer query. The
+    routes are loaded before timing since both ways need them.
+    """
+    metrics = query.get('metrics', ['confirmed', 'deaths'] + (['recovered'] if query['bin_region_column'] == 'country' else []))
+    times = []
+    for _repeat in range(repeats):
+        covid_data = CovidData()
+        covid_data.covid_manager = CovidManager(cache=cache)
+        covid_data.routesToWeightedEdges(query['bin_region_column'], query.get('country', None))
+        start = time.perf_counter()
+        if not pushdown:
+            covid_data.loadCovidDatasets(metrics)
+        data, _routes = covid_data.getData(**query)
+        times.append(time.perf_counter() - start)
+    return min(times), data
+
+def main():
+    args = parse_args()
+    work_folder = tempfile.mkdtemp()
+    current_folder = os.getcwd()
+    results = {'scale' : args.scale, 'runs' : []}
+    try:
+        generate_dataset(os.path.join(work_folder, 'dataset'), seed=args.seed, **SCALES[args.scale])
+        os.chdir(work_folder)
+        covid_data = CovidData()
+        covid_data.warm()
+        queries = get_queries(covid_data.getDates())
+
+        print("{:>26} {:>6} {:>12} {:>12} {:>8}".format('query', 'source', 'full load s', 'pushdown s', 'speedup'))
+        for name, query in queries:
+            for cache in [True, False]:
+                full_seconds, full_data = time_query(query, cache, False, args.repeats)
+                pushdown_seconds, pushdown_data = time_query(query, cache, True, args.repeats)
+                for data_type in full_data:
+                    pd.testing.assert_frame_equal(full_data[data_type], pushdown_data[data_type])
+                run = {'query' : name, 'source' : 'cache' if cache else 'csv', 'full_load_seconds' : full_seconds,
+                       'pushdown_seconds' : pushdown_seconds, 'speedup' : full_seconds / pushdown_seconds}
+                results['runs'].append(run)
+                print("{query:>26} {source:>6} {full_load_seconds:>12.3f} {pushdown_seconds:>12.3f} {speedup:>7.1f}x".format(**run))
+    finally:
+        os.chdir(current_folder)
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    if not args.output is None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print("\nWrote results to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
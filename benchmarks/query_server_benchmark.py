@@ -0,0 +1,138 @@
+"""
+Measures the latency and throughput of the local query server under
+concurrent clients on a synthetic dataset, and compares a client query with
+each process constructing its own CovidData.
+
+    python benchmarks/query_server_benchmark.py -s small -c 1 4 16 -n 50
+"""
+import os, sys, json, time, shutil, argparse, tempfile, subprocess
+from multiprocessing import Pool
+import numpy as np
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from query_server import CovidDataClient
+from synthetic_dataset import SCALES, generate_dataset
+
+# The queries each client cycles through
+QUERIES = [
+    ('getData', {'bin_region_column' : 'county'}),
+    ('getData', {'bin_region_column' : 'state'}),
+    ('getData', {'bin_region_column' : 'country'}),
+    ('getData', {'bin_region_column' : 'state', 'specific_date' : 'latest'}),
+    ('routesToWeightedEdges', {'bin_region_column' : 'state', 'country' : None}),
+    ('getInfectionPath', {'bin_region_column' : 'state', 'infect_percent' : 1.0}),
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the query server with concurrent clients")
+    parser.add_argument("-s", "--scale", type=str, default='small', choices=sorted(SCALES),
+                        help="the size of the synthetic dataset")
+    parser.add_argument("-c", "--concurrency", type=int, nargs='+', default=[1, 4, 16],
+                        help="the numbers of concurrent client processes")
+    parser.add_argument("-n", "--num_requests", type=int, default=50,
+                        help="the number of requests sent by each client")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="a .json file to write the results to")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+def run_client(args):
+    """
+    Sends num_requests queries from a new connection and returns the
+    latency of each and when the first was sent and the last answered.
+    """
+    socket_path, client_index, num_requests = args
+    latencies = []
+    with CovidDataClient(socket_path) as client:
+        start = time.time()
+        for request_index in range(num_requests):
+            method, query_args = QUERIES[(client_index + request_index) % len(QUERIES)]
+            request_start = time.perf_counter()
+            getattr(client, method)(**query_args)
+            latencies.append(time.perf_counter() - request_start)
+        end = time.time()
+    return latencies, start, end
+
+def run_local(dataset_folder):
+    """
+    Returns the seconds a new process takes to construct its own CovidData
+    and get the state data, what every notebook does without the server.
+    """
+    code = ("import sys, time; start = time.perf_counter(); sys.path.insert(0, {!r}); "
+            "from covid_data import CovidData; CovidData().getData('state'); "
+            "print(time.perf_counter() - start)").format(REPO_FOLDER)
+    output = subprocess.run([sys.executable, '-c', code], cwd=dataset_folder, capture_output=True, check=True)
+    return float(output.stdout.decode().strip().splitlines()[-1])
+
+def wait_for_socket(socket_path, server, timeout=120):
+    start = time.perf_counter()
+    while not os.path.exists(socket_path):
+        assert server.poll() is None, "The query server stopped"
+        assert time.perf_counter() - start < timeout, "The query server did not start"
+        time.sleep(0.05)
+
+def summarise(concurrency, results):
+    latencies = np.concatenate([np.asarray(client_latencies) for client_latencies, _start, _end in results])
+    seconds = max(end for _latencies, _start, end in results) - min(start for _latencies, start, _end in results)
+    return {
+        'concurrency'   : concurrency,
+        'requests'      : int(latencies.shape[0]),
+        'seconds'       : seconds,
+        'throughput'    : latencies.shape[0] / seconds,
+        'p50_ms'        : float(np.percentile(latencies, 50) * 1e3),
+        'p95_ms'        : float(np.percentile(latencies, 95) * 1e3),
+        'p99_ms'        : float(np.percentile(latencies, 99) * 1e3),
+        'max_ms'        : float(latencies.max() * 1e3)
+    }
+
+def main():
+    args = parse_args()
+    work_folder = tempfile.mkdtemp()
+    socket_path = os.path.join(work_folder, 'covid_query.sock')
+    server = None
+    results = {'scale' : args.scale, 'num_requests' : args.num_requests, 'runs' : []}
+    try:
+        generate_dataset(os.path.join(work_folder, 'dataset'), seed=args.seed, **SCALES[args.scale])
+        results['local_covid_data_seconds'] = run_local(work_folder)
+        print("New process with its own CovidData().getData('state'): {:.3f}s".format(results['local_covid_data_seconds']))
+
+        start = time.perf_counter()
+        server = subprocess.Popen([sys.executable, os.path.join(REPO_FOLDER, 'query_server.py'), '--socket', socket_path],
+                                  cwd=work_folder, stdout=subprocess.DEVNULL)
+        wait_for_socket(socket_path, server)
+        print("Server warm after {:.3f}s".format(time.perf_counter() - start))
+
+        start = time.perf_counter()
+        with CovidDataClient(socket_path) as client:
+            client.getData('state')
+            results['first_query_seconds'] = time.perf_counter() - start
+            print("First client getData('state'): {:.3f}s".format(results['first_query_seconds']))
+
+        print("{:>11} {:>9} {:>12} {:>9} {:>9} {:>9} {:>9}".format('concurrency', 'requests', 'requests/s', 'p50 ms',
+                                                                   'p95 ms', 'p99 ms', 'max ms'))
+        for concurrency in args.concurrency:
+            with Pool(concurrency) as pool:
+                client_results = pool.map(run_client, [(socket_path, client_index, args.num_requests)
+                                                       for client_index in range(concurrency)])
+            run = summarise(concurrency, client_results)
+            results['runs'].append(run)
+            print("{concurrency:>11} {requests:>9} {throughput:>12.1f} {p50_ms:>9.2f} {p95_ms:>9.2f} {p99_ms:>9.2f} {max_ms:>9.2f}".format(**run))
+
+        with CovidDataClient(socket_path) as client:
+            results['server_stats'] = client.getServerStats()
+    finally:
+        if not server is None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    if not args.output is None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print("\nWrote results to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
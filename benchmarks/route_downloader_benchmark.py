@@ -0,0 +1,75 @@
+"""
+Compares the throughput of the asyncio route downloader in
+download_route_dataset.py with the old threaded downloader against the local
+stub routes server.
+
+    python benchmarks/route_downloader_benchmark.py -n 2000 -l 0.02 -t 8
+"""
+import os, sys, time, argparse, asyncio
+from collections import Counter
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import download_route_dataset
+from stub_routes_server import StubRoutesServer
+from legacy_route_downloader import download_routes_threaded
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the route downloaders against a local stub server")
+    parser.add_argument("-a", "--airport_dataset", type=str, default="dataset/airport_to_location.csv")
+    parser.add_argument("-n", "--num_airports", type=int, default=2000,
+                        help="the number of departure airports to download routes for")
+    parser.add_argument("-l", "--latency", type=float, default=0.02,
+                        help="seconds the stub server waits before responding")
+    parser.add_argument("-f", "--failure_rate", type=float, default=0.05,
+                        help="fraction of requests failed by the stub server in the retry run")
+    parser.add_argument("-t", "--concurrency", type=int, default=8,
+                        help="the number of threads or concurrent requests")
+    parser.add_argument("-p", "--port", type=int, default=8765)
+    return parser.parse_args()
+
+def row_counts(rows):
+    # NaN != NaN so convert the rows to strings before comparing
+    return Counter(tuple(str(value) for value in row) for row in rows)
+
+def run_async(airport_df, api_call, concurrency, retry_backoff=0.01):
+    download_route_dataset.API_CALL = api_call
+    iata_lookup = download_route_dataset.build_iata_lookup(airport_df)
+    departures = download_route_dataset.get_departures(airport_df)
+    return asyncio.run(download_route_dataset.download_routes(departures, iata_lookup, concurrency,
+                                                              retry_backoff=retry_backoff))
+
+def report(name, num_airports, rows, seconds):
+    print("{:<28} {:>8.2f}s {:>10.1f} airports/s {:>10} routes".format(name, seconds, num_airports / seconds, len(rows)))
+
+def main():
+    args = parse_args()
+    airport_df = pd.read_csv(args.airport_dataset).iloc[:args.num_airports]
+    airport_codes = airport_df['codeIataAirport'].dropna().to_list()
+    num_airports = airport_df.shape[0]
+
+    with StubRoutesServer(airport_codes, port=args.port, latency=args.latency) as server:
+        start = time.perf_counter()
+        threaded_rows = download_routes_threaded(airport_df, server.getApiCall(), "BENCHMARK", args.concurrency)
+        report("threaded (legacy)", num_airports, threaded_rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        async_rows = run_async(airport_df, server.getApiCall(), args.concurrency)
+        report("asyncio", num_airports, async_rows, time.perf_counter() - start)
+
+    print("Same routes: {}".format(row_counts(threaded_rows) == row_counts(async_rows)))
+
+    # The threaded downloader can not recover from error responses so only
+    # the asyncio downloader is run with failures
+    with StubRoutesServer(airport_codes, port=args.port, latency=args.latency, failure_rate=args.failure_rate) as server:
+        start = time.perf_counter()
+        retry_rows = run_async(airport_df, server.getApiCall(), args.concurrency)
+        report("asyncio ({:.0%} failures)".format(args.failure_rate), num_airports, retry_rows, time.perf_counter() - start)
+        print("Stub server stats: {}".format(server.getStats()))
+
+    print("Same routes with retries: {}".format(row_counts(retry_rows) == row_counts(async_rows)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Local stand-in for the servers hosting the COVID .csv files. Serves the files
+in a folder with ETag and Last-Modified headers and answers conditional
+requests with 304 Not Modified, like raw.githubusercontent.com.
+
+    python benchmarks/stub_dataset_server.py --folder dataset --port 8766
+"""
+import os, time, argparse, hashlib, threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def create_handler(folder, latency=0.0, conditional=True, stats=None):
+    """
+    parameters:
+        folder:      the folder of files to serve.
+
+        latency:     seconds to wait before responding to each request.
+
+        conditional: if False the ETag and Last-Modified headers are ignored
+                     and the files are always sent.
+
+        stats:       if not None, a dictionary counting the requests, the
+                     304 responses and the bytes sent.
+    """
+    if stats is None:
+        stats = {}
+    stats.update({'requests' : 0, 'not_modified' : 0, 'bytes_sent' : 0})
+    lock = threading.Lock()
+
+    class DatasetHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if latency > 0:
+                time.sleep(latency)
+            filename = os.path.join(folder, os.path.basename(self.path.split('?')[0]))
+            if not os.path.isfile(filename):
+                self.send_error(404)
+                return
+
+            with open(filename, 'rb') as fp:
+                content = fp.read()
+            etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+            modified = os.path.getmtime(filename)
+            last_modified = formatdate(modified, usegmt=True)
+
+            not_modified = False
+            if conditional:
+                if 'If-None-Match' in self.headers:
+                    not_modified = self.headers['If-None-Match'] == etag
+                elif 'If-Modified-Since' in self.headers:
+                    try:
+                        not_modified = int(modified) <= parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp()
+                    except (TypeError, ValueError):
+                        not_modified = False
+
+            with lock:
+                stats['requests'] += 1
+                if not_modified:
+                    stats['not_modified'] += 1
+                else:
+                    stats['bytes_sent'] += len(content)
+
+            if not_modified:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            if conditional:
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            self.wfile.write(content)
+
+    return DatasetHandler
+
+class StubDatasetServer:
+
+    def __init__(self, folder, host='127.0.0.1', port=8766, **handler_kwargs):
+        """
+        Runs the stub server in a background thread.
+        """
+        self.host = host
+        self.port = port
+        self.stats = {}
+        self.server = ThreadingHTTPServer((host, port), create_handler(folder, stats=self.stats, **handler_kwargs))
+        self.thread = None
+
+    def getUrl(self, filename):
+        return "http://{}:{}/{}".format(self.host, self.port, filename)
+
+    def getStats(self):
+        return dict(self.stats)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serves .csv files with ETag and Last-Modified headers")
+    parser.add_argument("-f", "--folder", type=str, default="dataset")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8766)
+    parser.add_argument("-l", "--latency", type=float, default=0.0,
+                        help="seconds to wait before responding to each request")
+    parser.add_argument("--no_conditional", action="store_true",
+                        help="ignore conditional requests and always send the files")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    handler = create_handler(args.folder, latency=args.latency, conditional=not args.no_conditional)
+    print("Serving {} at http://{}:{}/".format(args.folder, args.host, args.port))
+    ThreadingHTTPServer((args.host, args.port), handler).serve_forever()
@@ -0,0 +1,130 @@
+"""
+Local stand-in for the aviation-edge routes endpoint so the route downloaders
+can be run and benchmarked without an API key or network access.
+
+    python benchmarks/stub_routes_server.py --port 8765 --latency 0.05
+
+then run download_route_dataset.py with
+    -c "http://127.0.0.1:8765/v2/public/routes?key={api_key}&departureIata={depart_codeIata}&limit=30000"
+"""
+import asyncio, argparse, random, threading, zlib
+from aiohttp import web
+import pandas as pd
+
+ROUTES_PATH = "/v2/public/routes"
+ROUTE_CALL = "http://{host}:{port}" + ROUTES_PATH + "?key={{api_key}}&departureIata={{depart_codeIata}}&limit=30000"
+
+def stub_routes(depart_iata, airport_codes, max_routes=40):
+    """
+    Returns the same list of routes for depart_iata on every call so the
+    downloaded datasets can be compared.
+    """
+    rand = random.Random(zlib.crc32(depart_iata.encode('utf-8')))
+    num_routes = rand.randint(0, max_routes)
+    return [{'departureIata' : depart_iata, 'arrivalIata' : rand.choice(airport_codes)} for _ii in range(num_routes)]
+
+def create_app(airport_codes, latency=0.0, failure_rate=0.0, max_routes=40, seed=0, stats=None):
+    """
+    parameters:
+        airport_codes: the Iata codes that have routes, any other code gets the
+                       error message the API returns.
+
+        latency:       seconds to wait before responding to each request.
+
+        failure_rate:  fraction of requests answered with a 503 error.
+
+        max_routes:    the maximum number of routes departing an airport.
+
+        stats:         if not None, a dictionary that counts the requests and
+                       the failures returned.
+    """
+    airport_codes = list(airport_codes)
+    known_codes = set(airport_codes)
+    failure_rand = random.Random(seed)
+    if stats is None:
+        stats = {}
+    stats.update({'requests' : 0, 'failures' : 0})
+
+    async def routes_handler(request):
+        stats['requests'] += 1
+        if latency > 0:
+            await asyncio.sleep(latency)
+        if failure_rand.random() < failure_rate:
+            stats['failures'] += 1
+            return web.Response(status=503, text="Service Unavailable")
+
+        depart_iata = request.query.get('departureIata', '')
+        if not depart_iata in known_codes:
+            return web.json_response({'error' : {'text' : 'No Record Found'}})
+        return web.json_response(stub_routes(depart_iata, airport_codes, max_routes))
+
+    app = web.Application()
+    app.router.add_get(ROUTES_PATH, routes_handler)
+    return app
+
+class StubRoutesServer:
+
+    def __init__(self, airport_codes, host='127.0.0.1', port=8765, **app_kwargs):
+        """
+        Runs the stub server on its own event loop in a background thread so
+        both the threaded and asyncio downloaders can use it.
+        """
+        self.host = host
+        self.port = port
+        self.stats = {}
+        self.app = create_app(airport_codes, stats=self.stats, **app_kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.thread = None
+
+    def getApiCall(self):
+        return ROUTE_CALL.format(host=self.host, port=self.port)
+
+    def getStats(self):
+        return dict(self.stats)
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.app)
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, self.host, self.port)
+            self.loop.run_until_complete(site.start())
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.runner.cleanup())
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serves fake aviation-edge routes for the airports in the airport dataset")
+    parser.add_argument("-a", "--airport_dataset", type=str, default="dataset/airport_to_location.csv")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8765)
+    parser.add_argument("-l", "--latency", type=float, default=0.0,
+                        help="seconds to wait before responding to each request")
+    parser.add_argument("-f", "--failure_rate", type=float, default=0.0,
+                        help="fraction of requests answered with a 503 error")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    airport_codes = pd.read_csv(args.airport_dataset)['codeIataAirport'].dropna().to_list()
+    app = create_app(airport_codes, latency=args.latency, failure_rate=args.failure_rate)
+    print("Serving {} airports at {}".format(len(airport_codes), ROUTE_CALL.format(host=args.host, port=args.port)))
+    web.run_app(app, host=args.host, port=args.port)
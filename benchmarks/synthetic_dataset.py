@@ -0,0 +1,289 @@
+"""
+Generates synthetic datasets in the same .csv and .json layouts as the files
+in dataset/ so the benchmarks can run without network access.
+
+    python benchmarks/synthetic_dataset.py -o /tmp/synthetic --countries 60 --dates 130
+"""
+import os, json, string, random, argparse, datetime
+import numpy as np
+import pandas as pd
+
+FIRST_DATE = datetime.date(2020, 1, 22)
+DATA_LABELS = ['covid_confirmed', 'covid_deaths', 'covid_recovered', 'covid_us_confirmed', 'covid_us_deaths', 'iso_table']
+US_COLUMNS = ['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'County', 'Province/State', 'Country/Region', 'Lat', 'Long', 'Combined_Key']
+
+SCALES = {
+    'small'  : {'num_countries' : 20,  'num_states' : 40,  'num_counties' : 100,  'num_dates' : 60,  'num_airports' : 500,   'num_routes' : 5000},
+    'medium' : {'num_countries' : 60,  'num_states' : 150, 'num_counties' : 1000, 'num_dates' : 130, 'num_airports' : 3000,  'num_routes' : 30000},
+    'large'  : {'num_countries' : 190, 'num_states' : 330, 'num_counties' : 3200, 'num_dates' : 130, 'num_airports' : 10000, 'num_routes' : 70000},
+}
+
+def date_columns(num_dates):
+    dates = [FIRST_DATE + datetime.timedelta(days=ii) for ii in range(num_dates)]
+    return ["{}/{}/{}".format(date.month, date.day, date.year % 100) for date in dates]
+
+def letter_codes(length, count):
+    codes = []
+    for ii in range(count):
+        code = ""
+        for _jj in range(length):
+            code = string.ascii_uppercase[ii % 26] + code
+            ii //= 26
+        codes.append(code)
+    return codes
+
+def cumulative_cases(rand, num_rows, num_dates, scale=1.0):
+    """
+    Returns a rows x dates array of cumulative cases that start growing on a
+    random date for every row.
+    """
+    starts = rand.integers(0, max(num_dates - 1, 1), size=num_rows)
+    growth = rand.uniform(1.02, 1.3, size=num_rows)
+    days = np.maximum(np.arange(num_dates)[None, :] - starts[:, None], 0)
+    cases = np.where(days > 0, np.power(growth[:, None], np.minimum(days, 80)) * scale, 0.0)
+    return np.maximum.accumulate(np.floor(cases).astype(np.int64), axis=1)
+
+class SyntheticLocations:
+
+    def __init__(self, num_countries, num_states, num_counties, seed=0):
+        """
+        Random countries, provinces and US counties with coordinates. One of
+        the countries is the US, which holds all of the counties, and a few
+        countries are split into provinces like in the global datasets.
+        """
+        rand = np.random.default_rng(seed)
+        num_countries = max(num_countries, 3)
+        self.countries = ['US'] + ["Country {}".format(code) for code in letter_codes(3, num_countries - 1)]
+        self.iso2 = dict(zip(self.countries, ['US'] + [code for code in letter_codes(2, num_countries + 1) if not code == 'US'][:num_countries - 1]))
+        self.country_coordinates = {country : (rand.uniform(-60, 70), rand.uniform(-180, 180)) for country in self.countries}
+
+        # Provinces belong to a handful of countries other than the US
+        province_countries = self.countries[1:1 + max(1, min(len(self.countries) - 1, num_states // 10))]
+        self.provinces = []
+        for ii in range(num_states):
+            country = province_countries[ii % len(province_countries)]
+            self.provinces.append(("Province {}".format(ii), country))
+
+        us_states = ["State {}".format(code) for code in letter_codes(2, max(1, min(50, num_counties // 20 + 1)))]
+        self.counties = [("County {}".format(ii), us_states[ii % len(us_states)]) for ii in range(num_counties)]
+        self.us_states = us_states
+        self.rand = rand
+
+    def near(self, country, spread=5.0):
+        lat, long = self.country_coordinates[country]
+        return (round(float(np.clip(lat + self.rand.normal(0, spread), -89, 89)), 4),
+                round(float(np.clip(long + self.rand.normal(0, spread), -179, 179)), 4))
+
+    def globalRows(self):
+        """
+        The (Province/State, Country/Region, Lat, Long) rows of the global
+        datasets, countries with provinces have one row per province.
+        """
+        province_countries = set(country for _province, country in self.provinces)
+        rows = []
+        for country in sorted(self.countries):
+            if country in province_countries:
+                for province, province_country in self.provinces:
+                    if province_country == country:
+                        rows.append((province, country) + self.near(country))
+            else:
+                rows.append((np.nan, country) + self.country_coordinates[country])
+        return rows
+
+    def usRows(self):
+        """
+        The (County, Province/State, Lat, Long) rows of the US datasets.
+        """
+        return [(county, state) + self.near('US') for county, state in self.counties]
+
+def write_covid_datasets(folder, locations, num_dates, seed=0):
+    rand = np.random.default_rng(seed + 1)
+    dates = date_columns(num_dates)
+
+    global_rows = locations.globalRows()
+    global_df = pd.DataFrame(global_rows, columns=['Province/State', 'Country/Region', 'Lat', 'Long'])
+    confirmed = cumulative_cases(rand, len(global_rows), num_dates, scale=5.0)
+    for data_label, values in [('covid_confirmed', confirmed),
+                               ('covid_deaths', confirmed // 20),
+                               ('covid_recovered', confirmed // 3)]:
+        df = pd.concat([global_df, pd.DataFrame(values, columns=dates)], axis=1)
+        df.to_csv(os.path.join(folder, data_label + '.csv'), index=False, header=True)
+
+    us_rows = locations.usRows()
+    us_df = pd.DataFrame({
+        'UID'            : [84000000 + ii for ii in range(len(us_rows))],
+        'iso2'           : 'US',
+        'iso3'           : 'USA',
+        'code3'          : 840,
+        'FIPS'           : [float(1000 + ii) for ii in range(len(us_rows))],
+        'County'         : [row[0] for row in us_rows],
+        'Province/State' : [row[1] for row in us_rows],
+        'Country/Region' : 'US',
+        'Lat'            : [row[2] for row in us_rows],
+        'Long'           : [row[3] for row in us_rows],
+        'Combined_Key'   : ["{}, {}, US".format(row[0], row[1]) for row in us_rows]
+    }, columns=US_COLUMNS)
+    us_confirmed = cumulative_cases(rand, len(us_rows), num_dates)
+    pd.concat([us_df, pd.DataFrame(us_confirmed, columns=dates)], axis=1).to_csv(
+        os.path.join(folder, 'covid_us_confirmed.csv'), index=False, header=True)
+
+    # The US deaths dataset has an extra Population column before the dates
+    us_deaths_df = us_df.copy()
+    us_deaths_df['Population'] = rand.integers(1000, 1000000, size=len(us_rows))
+    pd.concat([us_deaths_df, pd.DataFrame(us_confirmed // 20, columns=dates)], axis=1).to_csv(
+        os.path.join(folder, 'covid_us_deaths.csv'), index=False, header=True)
+
+def write_iso_table(folder, locations):
+    rows = []
+    uid = 1
+    for country in sorted(locations.countries):
+        lat, long = locations.country_coordinates[country]
+        iso2 = locations.iso2[country]
+        rows.append([uid, iso2, iso2 + 'X', float(uid), np.nan, np.nan, np.nan, country, lat, long, country, 1000000.0])
+        uid += 1
+        for province, province_country in locations.provinces:
+            if province_country == country:
+                rows.append([uid, iso2, iso2 + 'X', float(uid), np.nan, np.nan, province, country, lat, long,
+                             "{}, {}".format(province, country), 100000.0])
+                uid += 1
+    pd.DataFrame(rows, columns=US_COLUMNS + ['Population']).to_csv(os.path.join(folder, 'iso_table.csv'), index=False, header=True)
+
+def write_airports(folder, locations, num_airports, seed=0):
+    """
+    Writes airportDatabase.json with airports placed near random countries,
+    a few with an unknown country code like the real database.
+
+    returns:
+        The Iata code of each airport and the (County, Province/State,
+        Country/Region) it is in.
+    """
+    rand = random.Random(seed + 2)
+    codes = letter_codes(3, num_airports)
+    us_rows = locations.usRows()
+    airports = []
+    airport_locations = []
+    for airport_id, code in enumerate(codes, start=1):
+        country = rand.choice(locations.countries)
+        iso2 = locations.iso2[country] if rand.random() > 0.02 else 'ZZ'
+        lat, long = locations.near(country)
+        if country == 'US' and len(us_rows) > 0:
+            county, state, lat, long = rand.choice(us_rows)
+            airport_locations.append((county, state, country))
+        else:
+            airport_locations.append((np.nan, np.nan, country))
+        airports.append({
+            "GMT"              : "0",
+            "airportId"        : airport_id,
+            "codeIataAirport"  : code,
+            "codeIataCity"     : code,
+            "codeIcaoAirport"  : "X" + code,
+            "codeIso2Country"  : iso2,
+            "geonameId"        : str(airport_id),
+            "latitudeAirport"  : lat,
+            "longitudeAirport" : long,
+            "nameAirport"      : "Airport " + code,
+            "nameCountry"      : country,
+            "phone"            : "",
+            "timezone"         : "UTC"
+        })
+    with open(os.path.join(folder, 'airportDatabase.json'), 'w') as fp:
+        json.dump(airports, fp)
+    return codes, airport_locations
+
+def write_routes(folder, airport_codes, airport_locations, num_routes, seed=0):
+    rand = np.random.default_rng(seed + 3)
+    # Busy airports have most of the routes like the real network
+    weights = rand.pareto(1.5, size=len(airport_codes)) + 1
+    weights /= weights.sum()
+    departs = rand.choice(len(airport_codes), size=num_routes, p=weights)
+    arrivals = rand.choice(len(airport_codes), size=num_routes, p=weights)
+
+    columns = {}
+    for prefix, indexes in [('Depart', departs), ('Arrival', arrivals)]:
+        columns[prefix + 'codeIataAirport'] = [airport_codes[ii] for ii in indexes]
+        columns[prefix + 'County'] = [airport_locations[ii][0] for ii in indexes]
+        columns[prefix + 'Province/State'] = [airport_locations[ii][1] for ii in indexes]
+        columns[prefix + 'Country/Region'] = [airport_locations[ii][2] for ii in indexes]
+    pd.DataFrame(columns).to_csv(os.path.join(folder, 'airport_routes.csv'), index=False, header=True)
+
+def write_border_closures(folder, locations, num_dates, seed=0):
+    rand = random.Random(seed + 4)
+    dates = date_columns(num_dates)
+    eu_countries = sorted(locations.countries[1:])[:max(1, len(locations.countries) // 8)]
+    pd.DataFrame({'Country' : eu_countries}).to_csv(os.path.join(folder, 'eu_countries.csv'), index=False, header=True)
+
+    lines = ["Province/State:Country/Region:ClosureDate:WhiteList:BlackList:Notes"]
+    for country in rand.sample(locations.countries, max(1, len(locations.countries) // 3)):
+        whitelist = ""
+        blacklist = ""
+        choice = rand.random()
+        if choice < 0.3:
+            whitelist = "EU"
+        elif choice < 0.6:
+            blacklist = "|".join(rand.sample(locations.countries, min(3, len(locations.countries))))
+        lines.append(":{}:{}:{}:{}:".format(country, rand.choice(dates), whitelist, blacklist))
+    for province, country in rand.sample(locations.provinces, min(5, len(locations.provinces))):
+        lines.append("{}:{}:{}:::".format(province, country, rand.choice(dates)))
+    with open(os.path.join(folder, 'border_closures.csv'), 'w') as fp:
+        fp.write("\n".join(lines) + "\n")
+
+def generate_dataset(dataset_folder, num_countries=60, num_states=150, num_counties=1000, num_dates=130,
+                     num_airports=3000, num_routes=30000, seed=0):
+    """
+    Writes a synthetic dataset folder that CovidData can load without
+    downloading anything.
+
+    parameters:
+        dataset_folder: the folder to write the files to, normally a
+                        dataset/ folder inside the working directory.
+
+        num_countries:  the number of countries (including the US).
+
+        num_states:     the number of provinces of the global datasets.
+
+        num_counties:   the number of US counties.
+
+        num_dates:      the number of dates starting from 1/22/20.
+
+        num_airports:   the number of airports in airportDatabase.json.
+
+        num_routes:     the number of routes in airport_routes.csv.
+
+        seed:           the seed of the random data.
+    """
+    os.makedirs(dataset_folder, exist_ok=True)
+    locations = SyntheticLocations(num_countries, num_states, num_counties, seed=seed)
+    write_covid_datasets(dataset_folder, locations, num_dates, seed=seed)
+    write_iso_table(dataset_folder, locations)
+    airport_codes, airport_locations = write_airports(dataset_folder, locations, num_airports, seed=seed)
+    write_routes(dataset_folder, airport_codes, airport_locations, num_routes, seed=seed)
+    write_border_closures(dataset_folder, locations, num_dates, seed=seed)
+
+    # The files were just written so CovidManager will not try to refresh
+    # them, the urls are never requested
+    with open(os.path.join(dataset_folder, 'dataset_urls.csv'), 'w') as fp:
+        for data_label in DATA_LABELS:
+            fp.write("{},http://127.0.0.1:9/{}.csv\n".format(data_label, data_label))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generates a synthetic dataset folder")
+    parser.add_argument("-o", "--output", type=str, required=True, help="the dataset folder to write")
+    parser.add_argument("-s", "--scale", type=str, default=None, choices=sorted(SCALES),
+                        help="use the sizes of a benchmark scale")
+    parser.add_argument("--countries", type=int, default=60)
+    parser.add_argument("--states", type=int, default=150)
+    parser.add_argument("--counties", type=int, default=1000)
+    parser.add_argument("--dates", type=int, default=130)
+    parser.add_argument("--airports", type=int, default=3000)
+    parser.add_argument("--routes", type=int, default=30000)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.scale is None:
+        sizes = {'num_countries' : args.countries, 'num_states' : args.states, 'num_counties' : args.counties,
+                 'num_dates' : args.dates, 'num_airports' : args.airports, 'num_routes' : args.routes}
+    else:
+        sizes = SCALES[args.scale]
+    generate_dataset(args.output, seed=args.seed, **sizes)
@@ -0,0 +1,268 @@
+import bisect
+import numpy as np
+import pandas as pd
+
+class BorderClosureIndex:
+
+    # Fewer location names than this are looked up one by one, more are
+    # deduplicated with pandas first
+    FACTORIZE_MIN_LOCATIONS = 256
+
+    def __init__(self, border_closures, dates):
+        """
+        Compiled version of the border closures dataset for quickly checking
+        if the border between two locations is closed on a date.
+
+        Each location with border closures is given an array of the date
+        indexes where its closure policy changes (the closure epochs) and
+        the whitelist or blacklist of countries as a set for each epoch.
+        The EU expansion is already applied to the lists by
+        CovidData.createBorderDataset.
+
+        For blockedEdges the closures are also given integer IDs and every
+        country in the lists an integer ID, with a dates x closures table of
+        the epoch in place and an epochs x countries table of the countries
+        each epoch disallows.
+
+        parameters:
+            border_closures: The dictionary from CovidData.loadBorderDataset.
+
+            dates:           The list of dates in the COVID datasets, date
+                             indexes refer to this list.
+        """
+        self.border_closures = border_closures
+        self.dates = list(dates)
+        self.date_indexes = {}
+        for date_index, date in enumerate(self.dates):
+            self.date_indexes.setdefault(date, date_index)
+
+        self.closures = {
+            'country' : {},
+            'state'   : {}
+        }
+        for region in self.closures:
+            for location, closure_list in border_closures[region].items():
+                self.closures[region][location] = self._compileClosures(closure_list)
+
+        # Compiled closures for each location name, resolved on first use
+        self.location_closures = {}
+        self._compileTables()
+        # (closure ID, country ID) of each location name, resolved on first use
+        self.location_ids = {}
+
+    def getDateIndex(self, date):
+        try:
+            return self.date_indexes[date]
+        except KeyError:
+            raise ValueError("{} is not in the list of dates".format(date))
+
+    def _compileClosures(self, closure_list):
+        """
+        The policy in place on a date is the last entry in closure_list
+        (in list order) that started on or before that date.
+        """
+        entry_date_indexes = [self.getDateIndex(entry['date']) for entry in closure_list]
+        order = sorted(range(len(closure_list)), key=entry_date_indexes.__getitem__)
+
+        epoch_starts = []
+        epoch_policies = []
+        latest_entry = -1
+        for entry_index in order:
+            latest_entry = max(latest_entry, entry_index)
+            entry = closure_list[latest_entry]
+            if len(entry['blacklist']) > 0:
+                policy = (True, frozenset(entry['blacklist']))
+            else:
+                policy = (False, frozenset(entry['whitelist']))
+
+            epoch_start = entry_date_indexes[entry_index]
+            if len(epoch_starts) > 0 and epoch_starts[-1] == epoch_start:
+                epoch_policies[-1] = policy
+            else:
+                epoch_starts.append(epoch_start)
+                epoch_policies.append(policy)
+
+        return np.array(epoch_starts, dtype=np.int32), epoch_policies
+
+    def _compileTables(self):
+        """
+        Builds the integer tables used by blockedEdges. The last closure ID
+        is for locations without closures, the last epoch row is an epoch
+        with open borders and the last country ID is for countries that are
+        not in any list.
+        """
+        self.closure_ids = {}
+        self.country_ids = {}
+        closures = []
+        for region in ['state', 'country']:
+            for location, closure in self.closures[region].items():
+                self.closure_ids[(region, location)] = len(closures)
+                closures.append(closure)
+                for _is_blacklist, countries in closure[1]:
+                    for country in countries:
+                        self.country_ids.setdefault(country, len(self.country_ids))
+
+        num_epochs = sum(len(epoch_policies) for _epoch_starts, epoch_policies in closures)
+        self.open_epoch = num_epochs
+        self.other_country = len(self.country_ids)
+        self.disallowed = np.zeros((num_epochs + 1, len(self.country_ids) + 1), dtype=bool)
+        self.epoch_table = np.full((max(len(self.dates), 1), len(closures) + 1), self.open_epoch, dtype=np.int64)
+
+        date_indexes = np.arange(self.epoch_table.shape[0])
+        epoch_offset = 0
+        for closure_id, (epoch_starts, epoch_policies) in enumerate(closures):
+            for epoch, (is_blacklist, countries) in enumerate(epoch_policies):
+                country_ids = [self.country_ids[country] for country in countries]
+                if is_blacklist:
+                    self.disallowed[epoch_offset + epoch, country_ids] = True
+                else:
+                    self.disallowed[epoch_offset + epoch, :] = True
+                    self.disallowed[epoch_offset + epoch, country_ids] = False
+            epochs = np.searchsorted(epoch_starts, date_indexes, side='right') - 1
+            self.epoch_table[:, closure_id] = np.where(epochs < 0, self.open_epoch, epoch_offset + epochs)
+            epoch_offset += len(epoch_policies)
+
+    def _closureKey(self, location):
+        """
+        Returns the (region, location) key in self.closures of the closures
+        that apply to a location name, or None if it never closed its borders.
+        """
+        location_split = location.split(':')
+        country = location_split[-1]
+        if len(location_split) > 1 and not location_split[-2] == 'none':
+            state_location = '{}:{}'.format(location_split[-2], country)
+            if state_location in self.closures['state']:
+                return ('state', state_location)
+        if country in self.closures['country']:
+            return ('country', country)
+        return None
+
+    def getLocationIds(self, location):
+        """
+        Returns the closure ID and the country ID used by blockedEdges for a
+        location name.
+        """
+        if not location in self.location_ids:
+            closure_key = self._closureKey(location)
+            closure_id = len(self.closure_ids) if closure_key is None else self.closure_ids[closure_key]
+            country_id = self.country_ids.get(location.rsplit(':', 1)[-1], self.other_country)
+            self.location_ids[location] = (closure_id, country_id)
+        return self.location_ids[location]
+
+    def getClosures(self, location):
+        """
+        Returns the compiled closures (epoch start date indexes and the
+        policy of each epoch) that apply to a location name in the
+        "State:Country" or "Country" format. Returns None if the location
+        never closed its borders.
+        """
+        if location in self.location_closures:
+            return self.location_closures[location]
+
+        closure_key = self._closureKey(location)
+        closures = None
+        if not closure_key is None:
+            region, closure_location = closure_key
+            epoch_starts, epoch_policies = self.closures[region][closure_location]
+            closures = (epoch_starts.tolist(), epoch_policies)
+        self.location_closures[location] = closures
+        return closures
+
+    def getPolicy(self, location, date_index):
+        """
+        Returns (is_blacklist, countries) for the border closure in place at
+        location on the date index, otherwise None if the borders are open.
+        """
+        closures = self.getClosures(location)
+        if closures is None:
+            return None
+        epoch_starts, epoch_policies = closures
+        epoch = bisect.bisect_right(epoch_starts, date_index) - 1
+        if epoch < 0:
+            return None
+        return epoch_policies[epoch]
+
+    def disallows(self, location, other_country, date_index):
+        """
+        Returns True if location does not allow travel from other_country
+        on the date index.
+        """
+        policy = self.getPolicy(location, date_index)
+        if policy is None:
+            return False
+        is_blacklist, countries = policy
+        if is_blacklist:
+            return other_country in countries
+        return not other_country in countries
+
+    def isBlocked(self, loc0, loc1, date_index):
+        """
+        Returns True if either location has closed its borders to the other
+        location's country on the date index.
+        """
+        country0 = loc0.rsplit(':', 1)[-1]
+        country1 = loc1.rsplit(':', 1)[-1]
+        return self.disallows(loc0, country1, date_index) or self.disallows(loc1, country0, date_index)
+
+    def getEdgeIds(self, locs0, locs1):
+        """
+        Returns the closure IDs and country IDs of both locations of every
+        edge, as the arrays (closure_ids0, country_ids0, closure_ids1,
+        country_ids1), so the same edges can be checked on many dates with
+        blockedEdgeIds.
+
+        parameters:
+            locs0: list of location names.
+
+            locs1: list of location names, same length as locs0.
+        """
+        locations = list(locs0) + list(locs1)
+        if len(locations) < BorderClosureIndex.FACTORIZE_MIN_LOCATIONS:
+            known_ids = self.location_ids.get
+            location_ids = np.array([known_ids(location) or self.getLocationIds(location) for location in locations], dtype=np.int64)
+        else:
+            codes, unique_locations = pd.factorize(np.asarray(locations, dtype=object))
+            location_ids = np.array([self.getLocationIds(location) for location in unique_locations], dtype=np.int64)[codes]
+        location_ids = location_ids.reshape(-1, 2)
+        num_edges = len(locs0)
+        return location_ids[:num_edges, 0], location_ids[:num_edges, 1], location_ids[num_edges:, 0], location_ids[num_edges:, 1]
+
+    def blockedEdgeIds(self, edge_ids, date_index):
+        """
+        Returns a numpy boolean array which is True where the edge is blocked
+        on the date index, for the edges from getEdgeIds.
+        """
+        closure_ids0, country_ids0, closure_ids1, country_ids1 = edge_ids
+        if len(closure_ids0) == 0 or date_index < 0:
+            return np.zeros(len(closure_ids0), dtype=bool)
+        # The policies do not change after the last date
+        epochs = self.epoch_table[min(date_index, self.epoch_table.shape[0] - 1)]
+        return self.disallowed[epochs[closure_ids0], country_ids1] | self.disallowed[epochs[closure_ids1], country_ids0]
+
+    def blockedEdges(self, locs0, locs1, date_index):
+        """
+        Batched version of isBlocked for checking many candidate edges on the
+        same date index, using the closure and country IDs of the locations.
+
+        parameters:
+            locs0:      list of location names.
+
+            locs1:      list of location names, same length as locs0.
+
+            date_index: index of the date in the dates list.
+
+        returns:
+            A numpy boolean array which is True where the edge between
+            locs0[ii] and locs1[ii] is blocked.
+        """
+        return self.blockedEdgeIds(self.getEdgeIds(locs0, locs1), date_index)
+
+    def forDates(self, dates):
+        """
+        Returns an index compiled for a different list of dates (or self if
+        the dates are the same).
+        """
+        dates = list(dates)
+        if dates == self.dates:
+            return self
+        return BorderClosureIndex(self.border_closures, dates)
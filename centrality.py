@@ -0,0 +1,659 @@
+import os
+import json
+import random
+import hashlib
+import heapq
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import networkx as nx
+from locations import get_location_names
+from snapshot_store import GraphSnapshotStore
+
+def route_graph(routes, bin_region_column, distance=True):
+    """
+    Builds the undirected flight graph of the routes between locations.
+
+    parameters:
+        routes:            a routes dataframe from
+                           CovidData.routesToWeightedEdges.
+
+        bin_region_column: Is either 'county', 'state' or 'country'.
+
+        distance:          If True the weight of an edge is the distance
+                           used by the timeline notebook, the maximum number
+                           of routes minus the number of routes plus 1, so
+                           busy routes are short. If False the weight is the
+                           number of routes.
+
+    returns:
+        A networkx Graph with the location names as nodes.
+    """
+    departs = get_location_names(routes, bin_region_column, prefix='Depart')
+    arrivals = get_location_names(routes, bin_region_column, prefix='Arrival')
+    num_routes = routes['NumberOfRoutes'].tolist()
+    if distance and len(num_routes) > 0:
+        max_routes = max(num_routes)
+        weights = [max_routes - routes_num + 1 for routes_num in num_routes]
+    else:
+        weights = num_routes
+
+    graph = nx.Graph()
+    graph.add_weighted_edges_from(zip(departs, arrivals, weights))
+    return graph
+
+def graph_adjacency(graph, weight):
+    """
+    Returns the nodes of graph and, for every node, the list of
+    (neighbour index, edge weight) pairs. The weight is 1 if weight is None.
+    """
+    nodes = list(graph)
+    index = {node : ii for ii, node in enumerate(nodes)}
+    adjacency = []
+    for node in nodes:
+        neighbours = []
+        for neighbour, edge_data in graph[node].items():
+            cost = 1 if weight is None else edge_data.get(weight, 1)
+            neighbours.append((index[neighbour], cost))
+        adjacency.append(neighbours)
+    return nodes, adjacency
+
+def shortest_paths(adjacency, source, weighted):
+    """
+    Brandes' single source shortest paths, Dijkstra if weighted otherwise a
+    breadth first search, visiting nodes in the same order as networkx.
+
+    returns:
+        The nodes in order of distance, the predecessors and number of
+        shortest paths of every node and the distances of the visited nodes.
+    """
+    num_nodes = len(adjacency)
+    order = []
+    preds = [[] for _ii in range(num_nodes)]
+    sigma = [0.0] * num_nodes
+    dist = {}
+    sigma[source] = 1.0
+
+    if not weighted:
+        dist[source] = 0
+        queue = [source]
+        for v in queue:
+            order.append(v)
+            v_dist = dist[v] + 1
+            for w, _cost in adjacency[v]:
+                if not w in dist:
+                    queue.append(w)
+                    dist[w] = v_dist
+                if dist[w] == v_dist:
+                    sigma[w] += sigma[v]
+                    preds[w].append(v)
+        return order, preds, sigma, dist
+
+    seen = {source : 0}
+    counter = 0
+    heap = [(0, counter, source, source)]
+    while heap:
+        v_dist, _count, pred, v = heapq.heappop(heap)
+        if v in dist:
+            continue
+        if not v == source:
+            sigma[v] += sigma[pred]
+        order.append(v)
+        dist[v] = v_dist
+        for w, cost in adjacency[v]:
+            w_dist = v_dist + cost
+            if not w in dist and (not w in seen or w_dist < seen[w]):
+                seen[w] = w_dist
+                counter += 1
+                heapq.heappush(heap, (w_dist, counter, v, w))
+                sigma[w] = 0.0
+                preds[w] = [v]
+            elif w_dist == seen[w]:
+                sigma[w] += sigma[v]
+                preds[w].append(v)
+    return order, preds, sigma, dist
+
+_worker_adjacency = None
+
+def _init_worker(adjacency):
+    global _worker_adjacency
+    _worker_adjacency = adjacency
+
+def source_centralities(sources, weighted, squares=False, adjacency=None):
+    """
+    Computes the betweenness dependencies and closeness of a partition of
+    the sources so the sources can be split over processes.
+
+    parameters:
+        sources:   the indexes of the source nodes.
+
+        weighted:  if True Dijkstra is used, otherwise breadth first search.
+
+        squares:   if True the sum of the squared dependencies is returned
+                   for the error of approximate betweenness.
+
+        adjacency: the adjacency from graph_adjacency, the adjacency of the
+                   worker process is used if None.
+
+    returns:
+        The summed dependencies of every node (unscaled betweenness), the
+        summed squared dependencies (None if squares is False) and the
+        closeness of each source.
+    """
+    if adjacency is None:
+        adjacency = _worker_adjacency
+    num_nodes = len(adjacency)
+    betweenness = np.zeros(num_nodes, dtype=np.float64)
+    squared = np.zeros(num_nodes, dtype=np.float64) if squares else None
+    closeness = []
+
+    for source in sources:
+        order, preds, sigma, dist = shortest_paths(adjacency, source, weighted)
+
+        total_dist = sum(dist[v] for v in order)
+        _closeness = 0.0
+        if total_dist > 0.0 and num_nodes > 1:
+            _closeness = (len(order) - 1.0) / total_dist
+            _closeness *= (len(order) - 1.0) / (num_nodes - 1)
+        closeness.append(_closeness)
+
+        delta = dict.fromkeys(order, 0.0)
+        for w in reversed(order):
+            coeff = (1.0 + delta[w]) / sigma[w]
+            for v in preds[w]:
+                delta[v] += sigma[v] * coeff
+        delta[source] = 0.0
+
+        visited = np.fromiter(delta.keys(), dtype=np.int64, count=len(delta))
+        dependencies = np.fromiter(delta.values(), dtype=np.float64, count=len(delta))
+        betweenness[visited] += dependencies
+        if squares:
+            squared[visited] += dependencies * dependencies
+
+    return betweenness, squared, closeness
+
+def betweenness_scale(num_nodes, normalized, k=None):
+    """
+    The scale networkx applies to the summed dependencies of an undirected
+    graph.
+    """
+    if normalized:
+        if num_nodes <= 2:
+            return 1.0
+        scale = 1 / ((num_nodes - 1) * (num_nodes - 2))
+    else:
+        scale = 0.5
+    if not k is None:
+        scale = scale * num_nodes / k
+    return scale
+
+class CentralityService:
+
+    def __init__(self, processes=None, cache_folder='dataset/centrality_cache/', cache=True, chunks_per_process=4):
+        """
+        Computes degree, closeness and betweenness centrality of route graphs
+        by splitting the shortest path sources over a pool of processes.
+        Results are cached on disk, keyed by a hash of the edge list.
+
+        parameters:
+            processes:          the number of worker processes, defaults to
+                                the number of CPUs. 1 runs in this process.
+
+            cache_folder:       the folder of the cached results.
+
+            cache:              if False results are always recomputed.
+
+            chunks_per_process: the number of partitions of the sources
+                                given to each process, more partitions
+                                balance the work better.
+        """
+        self.processes = os.cpu_count() if processes is None else processes
+        self.cache_folder = cache_folder
+        self.cache = cache
+        self.chunks_per_process = chunks_per_process
+
+    def getCacheKey(self, graph, measure, **params):
+        """
+        Returns the sha1 hash of the nodes, edge list and parameters.
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps([measure, sorted(params.items())], default=str).encode('utf-8'))
+        for node in graph:
+            sha1.update("{}\n".format(node).encode('utf-8'))
+        for u, v, data in graph.edges(data=True):
+            sha1.update("{}\t{}\t{}\n".format(u, v, sorted(data.items())).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def loadCached(self, key):
+        filename = os.path.join(self.cache_folder, key + '.json')
+        if not self.cache or not os.path.isfile(filename):
+            return None
+        with open(filename, 'r') as fp:
+            return json.load(fp)
+
+    def saveCached(self, key, result):
+        if not self.cache:
+            return
+        os.makedirs(self.cache_folder, exist_ok=True)
+        filename = os.path.join(self.cache_folder, key + '.json')
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as fp:
+            json.dump(result, fp)
+        os.replace(tmp_filename, filename)
+
+    def runSources(self, graph, sources, weight, squares=False):
+        """
+        Runs source_centralities over the sources, in partitions over the
+        process pool if there is more than one process.
+
+        returns:
+            The nodes of graph, the summed dependencies, the summed squared
+            dependencies and the closeness of each source.
+        """
+        nodes, adjacency = graph_adjacency(graph, weight)
+        weighted = not weight is None
+        num_chunks = max(1, min(len(sources), self.processes * self.chunks_per_process))
+        chunks = [sources[ii::num_chunks] for ii in range(num_chunks)]
+
+        if self.processes > 1 and num_chunks > 1:
+            with Pool(self.processes, initializer=_init_worker, initargs=(adjacency,)) as pool:
+                results = pool.starmap(source_centralities, [(chunk, weighted, squares) for chunk in chunks])
+        else:
+            results = [source_centralities(chunk, weighted, squares, adjacency) for chunk in chunks]
+
+        betweenness = np.zeros(len(nodes), dtype=np.float64)
+        squared = np.zeros(len(nodes), dtype=np.float64) if squares else None
+        closeness = [0.0] * len(sources)
+        for chunk_index, (chunk_betweenness, chunk_squared, chunk_closeness) in enumerate(results):
+            betweenness += chunk_betweenness
+            if squares:
+                squared += chunk_squared
+            # Chunks take every num_chunks-th source
+            closeness[chunk_index::num_chunks] = chunk_closeness
+        return nodes, betweenness, squared, closeness
+
+    def degree(self, graph):
+        """
+        Returns the degree centrality of every node, same as
+        networkx.degree_centrality.
+        """
+        return nx.degree_centrality(graph)
+
+    def closeness(self, graph, distance='weight'):
+        """
+        Returns the closeness centrality of every node, same as
+        networkx.closeness_centrality.
+
+        parameters:
+            graph:    an undirected networkx Graph, like from route_graph.
+
+            distance: the edge attribute used as the distance, or None for
+                      the number of edges.
+        """
+        assert not graph.is_directed(), "Only undirected graphs are supported"
+        key = self.getCacheKey(graph, 'closeness', distance=distance)
+        cached = self.loadCached(key)
+        if not cached is None:
+            return dict(zip(cached['nodes'], cached['closeness']))
+
+        nodes, _betweenness, _squared, closeness = self.runSources(graph, list(range(len(graph))), distance)
+        self.saveCached(key, {'nodes' : nodes, 'closeness' : closeness})
+        return dict(zip(nodes, closeness))
+
+    def betweenness(self, graph, weight='weight', normalized=True, k=None, seed=None):
+        """
+        Returns the betweenness centrality of every node, same as
+        networkx.betweenness_centrality.
+
+        parameters:
+            graph:      an undirected networkx Graph, like from route_graph.
+
+            weight:     the edge attribute used as the distance, or None for
+                        the number of edges.
+
+            normalized: if True the betweenness is divided by the number of
+                        pairs of other nodes.
+
+            k:          if not None the betweenness is estimated from k
+                        sampled sources, see approximateBetweenness.
+
+            seed:       the seed used to sample the k sources.
+        """
+        if not k is None:
+            return self.approximateBetweenness(graph, k, seed=seed, weight=weight, normalized=normalized)[0]
+
+        assert not graph.is_directed(), "Only undirected graphs are supported"
+        key = self.getCacheKey(graph, 'betweenness', weight=weight, normalized=normalized)
+        cached = self.loadCached(key)
+        if not cached is None:
+            return dict(zip(cached['nodes'], cached['betweenness']))
+
+        nodes, betweenness, _squared, _closeness = self.runSources(graph, list(range(len(graph))), weight)
+        betweenness = (betweenness * betweenness_scale(len(nodes), normalized)).tolist()
+        self.saveCached(key, {'nodes' : nodes, 'betweenness' : betweenness})
+        return dict(zip(nodes, betweenness))
+
+    def approximateBetweenness(self, graph, k, seed=None, weight='weight', normalized=True):
+        """
+        Estimates the betweenness centrality from k sources sampled the same
+        way as networkx.betweenness_centrality(graph, k=k, seed=seed), so the
+        estimates are the same as networkx for the same seed.
+
+        returns:
+            The estimated betweenness of every node and the standard error of
+            each estimate, from the variance of the dependencies of the
+            sampled sources.
+        """
+        assert not graph.is_directed(), "Only undirected graphs are supported"
+        num_nodes = len(graph)
+        assert 0 < k <= num_nodes, "k needs to be between 1 and the number of nodes ({})".format(num_nodes)
+        key = self.getCacheKey(graph, 'approximate_betweenness', k=k, seed=seed, weight=weight, normalized=normalized)
+        cached = self.loadCached(key)
+        if not cached is None:
+            return dict(zip(cached['nodes'], cached['betweenness'])), dict(zip(cached['nodes'], cached['errors']))
+
+        rand = seed if isinstance(seed, random.Random) else random.Random(seed)
+        index = {node : ii for ii, node in enumerate(graph)}
+        sources = [index[node] for node in rand.sample(list(graph.nodes()), k)]
+        nodes, betweenness, squared, _closeness = self.runSources(graph, sources, weight, squares=True)
+
+        scale = betweenness_scale(num_nodes, normalized, k)
+        estimates = betweenness * scale
+
+        # Standard error of the mean dependency, sampled without replacement
+        errors = np.zeros(num_nodes, dtype=np.float64)
+        if k > 1:
+            mean = betweenness / k
+            variance = np.maximum(squared - k * mean * mean, 0.0) / (k - 1)
+            correction = (num_nodes - k) / (num_nodes - 1) if num_nodes > 1 else 0.0
+            errors = np.sqrt(variance / k * correction) * k * scale
+
+        self.saveCached(key, {'nodes' : nodes, 'betweenness' : estimates.tolist(), 'errors' : errors.tolist()})
+        return dict(zip(nodes, estimates.tolist())), dict(zip(nodes, errors.tolist()))
+
+    def getCentralities(self, routes, bin_region_column, k=None, seed=None, distance=True):
+        """
+        Computes the degree, closeness and betweenness centrality of the
+        locations in the routes from CovidData.routesToWeightedEdges.
+
+        parameters:
+            routes:            a routes dataframe from
+                               CovidData.routesToWeightedEdges.
+
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            k:                 if not None betweenness is estimated from k
+                               sampled sources.
+
+            seed:              the seed used to sample the k sources.
+
+            distance:          passed to route_graph.
+
+        returns:
+            A dataframe with the columns 'Location', 'Degree', 'Closeness'
+            and 'Betweenness', and 'BetweennessError' if k is not None.
+        """
+        graph = route_graph(routes, bin_region_column, distance=distance)
+        nodes = list(graph)
+        degree = self.degree(graph)
+        closeness = self.closeness(graph)
+        centralities = {
+            'Location'  : nodes,
+            'Degree'    : [degree[node] for node in nodes],
+            'Closeness' : [closeness[node] for node in nodes]
+        }
+
+        if k is None:
+            betweenness = self.betweenness(graph)
+            centralities['Betweenness'] = [betweenness[node] for node in nodes]
+        else:
+            betweenness, errors = self.approximateBetweenness(graph, k, seed=seed)
+            centralities['Betweenness'] = [betweenness[node] for node in nodes]
+            centralities['BetweennessError'] = [errors[node] for node in nodes]
+
+        return pd.DataFrame(centralities)
+
+class UnionFind:
+
+    def __init__(self):
+        """
+        Connected components of a graph that only gains nodes and edges,
+        with the members of every component.
+        """
+        self.parents = []
+        self.members = []
+
+    def add(self):
+        """
+        Adds a node in its own component and returns its index.
+        """
+        node = len(self.parents)
+        self.parents.append(node)
+        self.members.append([node])
+        return node
+
+    def find(self, node):
+        parents = self.parents
+        while not parents[node] == node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    def union(self, node_0, node_1):
+        """
+        Merges the components of the nodes and returns the root.
+        """
+        root_0 = self.find(node_0)
+        root_1 = self.find(node_1)
+        if root_0 == root_1:
+            return root_0
+        if len(self.members[root_0]) < len(self.members[root_1]):
+            root_0, root_1 = root_1, root_0
+        self.parents[root_1] = root_0
+        self.members[root_0].extend(self.members[root_1])
+        self.members[root_1] = None
+        return root_0
+
+    def getMembers(self, node):
+        return self.members[self.find(node)]
+
+def graph_deltas(infect_graphs):
+    """
+    Yields the date, added nodes, added edges and removed nodes of every
+    date of the infection graphs, in date order.
+
+    parameters:
+        infect_graphs: the GraphSnapshotStore from get_infection_path, or a
+                       dictionary of date to graph like the notebook.
+    """
+    if isinstance(infect_graphs, GraphSnapshotStore):
+        for date, (added_nodes, added_edges, removed_nodes, _confirmed) in zip(infect_graphs.dates, infect_graphs.deltas):
+            yield date, [node for node, _attributes in added_nodes], added_edges, removed_nodes
+        return
+
+    previous = nx.Graph()
+    for date in infect_graphs:
+        graph = infect_graphs[date]
+        added_nodes = [node for node in graph if not node in previous]
+        added_edges = [(u, v) for u, v in graph.edges if not previous.has_edge(u, v)]
+        removed_nodes = [node for node in previous if not node in graph]
+        yield date, added_nodes, added_edges, removed_nodes
+        previous = graph
+
+def component_centralities(adjacency, members, k=None, rand=None):
+    """
+    Computes the unscaled betweenness and closeness of the nodes of one
+    connected component.
+
+    parameters:
+        adjacency: the neighbours of every node of the graph.
+
+        members:   the nodes of the component in graph order.
+
+        k:         if not None and the component has more than k nodes,
+                   both are estimated from k sampled sources.
+
+        rand:      the random.Random used to sample the sources.
+
+    returns:
+        The summed dependencies of the members and the closeness of the
+        members before it is scaled by the size of the graph, the
+        (component size - 1) / total distance of networkx.
+    """
+    size = len(members)
+    local = {node : ii for ii, node in enumerate(members)}
+    local_adjacency = [[(local[neighbour], 1) for neighbour in adjacency[node]] for node in members]
+
+    if k is None or size <= k:
+        betweenness, _squared, closeness = source_centralities(list(range(size)), False, adjacency=local_adjacency)
+        return betweenness, np.asarray(closeness, dtype=np.float64)
+
+    # Distances are symmetric so the distances from k sampled sources also
+    # estimate the total distance to every node
+    sources = rand.sample(range(size), k)
+    betweenness, _squared, _closeness = source_centralities(sources, False, adjacency=local_adjacency)
+    total_dist = np.zeros(size, dtype=np.float64)
+    for source in sources:
+        _order, _preds, _sigma, dist = shortest_paths(local_adjacency, source, False)
+        total_dist[list(dist.keys())] += list(dist.values())
+
+    closeness = np.zeros(size, dtype=np.float64)
+    reached = total_dist > 0
+    closeness[reached] = (size - 1.0) / (total_dist[reached] * size / k)
+    return betweenness * size / k, closeness
+
+def centrality_series(infect_graphs, metrics=('degree', 'closeness', 'betweenness'), k=None, seed=None):
+    """
+    Computes the centrality of every location on every date of the infection
+    graphs without recomputing each graph from scratch. The nodes and edges
+    added on each date update the degrees and a union find of the connected
+    components, and closeness and betweenness are only recomputed for the
+    components that changed. The other components keep their values, only
+    rescaled by the size of the graph. Edges added to a node removed on the
+    same date are dropped with it, like networkx.
+
+    The values are the same as networkx.degree_centrality,
+    networkx.closeness_centrality and networkx.betweenness_centrality of the
+    graph of each date.
+
+    parameters:
+        infect_graphs: the GraphSnapshotStore from get_infection_path, or a
+                       dictionary of date to graph like the notebook.
+
+        metrics:       the centralities to compute out of 'degree',
+                       'closeness' and 'betweenness'.
+
+        k:             if not None closeness and betweenness of components
+                       with more than k nodes are estimated from k sampled
+                       sources each time they change.
+
+        seed:          the seed used to sample the sources.
+
+    returns:
+        A dictionary of metric to a locations x dates dataframe, NaN where a
+        location is not in the graph on that date.
+    """
+    rand = random.Random(seed)
+    paths_needed = 'closeness' in metrics or 'betweenness' in metrics
+
+    components = UnionFind()
+    node_index = {}
+    adjacency = []
+    degree = []
+    raw_betweenness = []
+    raw_closeness = []
+    component_size = []
+    node_rows = []
+    location_rows = {}
+
+    dates = []
+    columns = {metric : [] for metric in metrics}
+    for date, added_nodes, added_edges, removed_nodes in graph_deltas(infect_graphs):
+        dates.append(date)
+        changed = set()
+        for node in added_nodes:
+            index = components.add()
+            node_index[node] = index
+            adjacency.append([])
+            degree.append(0)
+            raw_betweenness.append(0.0)
+            raw_closeness.append(0.0)
+            component_size.append(1)
+            node_rows.append(location_rows.setdefault(node, len(location_rows)))
+
+        # Nodes can be removed on the date they are added, with the edges
+        # added to them that date
+        removed = set(removed_nodes)
+        for u, v in added_edges:
+            if u in removed or v in removed:
+                continue
+            index_u = node_index[u]
+            index_v = node_index[v]
+            if index_v in adjacency[index_u]:
+                continue
+            adjacency[index_u].append(index_v)
+            adjacency[index_v].append(index_u)
+            degree[index_u] += 1
+            degree[index_v] += 1
+            components.union(index_u, index_v)
+            changed.add(index_u)
+
+        split = False
+        for node in removed_nodes:
+            index = node_index.pop(node)
+            for neighbour in adjacency[index]:
+                adjacency[neighbour].remove(index)
+                degree[neighbour] -= 1
+                changed.add(neighbour)
+                split = True
+            adjacency[index] = []
+            degree[index] = 0
+        if split:
+            # A removed node had edges from an earlier date so its component
+            # may have split, the components are found again
+            components = UnionFind()
+            for index in range(len(adjacency)):
+                components.add()
+            for index, neighbours in enumerate(adjacency):
+                for neighbour in neighbours:
+                    components.union(index, neighbour)
+
+        if paths_needed:
+            roots = sorted(set(components.find(index) for index in changed))
+            for root in roots:
+                members = sorted(components.members[root])
+                betweenness, closeness = component_centralities(adjacency, members, k, rand)
+                for ii, member in enumerate(members):
+                    raw_betweenness[member] = betweenness[ii]
+                    raw_closeness[member] = closeness[ii]
+                    component_size[member] = len(members)
+
+        indexes = np.fromiter(node_index.values(), dtype=np.int64, count=len(node_index))
+        num_nodes = len(indexes)
+        values = {}
+        if 'degree' in metrics:
+            if num_nodes <= 1:
+                values['degree'] = np.ones(num_nodes, dtype=np.float64)
+            else:
+                values['degree'] = np.asarray(degree, dtype=np.float64)[indexes] * (1.0 / (num_nodes - 1.0))
+        if 'closeness' in metrics:
+            if num_nodes <= 1:
+                values['closeness'] = np.zeros(num_nodes, dtype=np.float64)
+            else:
+                sizes = np.asarray(component_size, dtype=np.float64)[indexes]
+                values['closeness'] = np.asarray(raw_closeness, dtype=np.float64)[indexes] * ((sizes - 1.0) / (num_nodes - 1))
+        if 'betweenness' in metrics:
+            values['betweenness'] = np.asarray(raw_betweenness, dtype=np.float64)[indexes] * betweenness_scale(num_nodes, True)
+
+        rows = np.asarray(node_rows, dtype=np.int64)[indexes]
+        for metric in metrics:
+            columns[metric].append((rows, values[metric]))
+
+    locations = list(location_rows)
+    series = {}
+    for metric in metrics:
+        matrix = np.full((len(locations), len(dates)), np.nan)
+        for date_index, (rows, values) in enumerate(columns[metric]):
+            matrix[rows, date_index] = values
+        series[metric] = pd.DataFrame(matrix, index=locations, columns=dates)
+    return series
@@ -1,8 +1,13 @@
-import os, subprocess
+import os, subprocess, tempfile, shutil
 import pandas as pd
 import numpy as np
 import json
 from datasetmanager import *
+from instrumentation import span, traced, get_tracer, TRACE_ENV_VARIABLE
+from border_closures import BorderClosureIndex
+from lru_cache import LRUCache
+from timeseries_store import TimeSeriesStore, aggregate_locations
+from route_aggregates import RouteAggregates
 
 class CovidData:
 
@@ -10,7 +15,7 @@ class CovidData:
                  border_closures_csv='dataset/border_closures.csv',
                  border_closures_json='dataset/border_closures.json',
                  eu_countries_csv='dataset/eu_countries.csv',
-                 thread_num=20):
+                 thread_num=20, cache_size=32):
         """
         A wrapper class for organising all of the data for the COVID-19 project.
 
@@ -21,24 +26,285 @@ class CovidData:
 
             thread_num:       the number of threads to use when running
                               download_route_dataset.py
+
+            cache_size:       the number of getData and routesToWeightedEdges
+                              results to keep in memory.
+
+        The datasets are loaded when they are first used, call warm() to load
+        all of them straight away.
         """
+        self.routes_locations = routes_locations
         self.border_closures_csv = border_closures_csv
         self.border_closures_json = border_closures_json
         self.eu_countries_csv = eu_countries_csv
-        covid_manager = CovidManager()
-        datasets = covid_manager.getDatasets()
-        self.confirmed_df = datasets['full']['confirmed']
-        self.deaths_df = datasets['full']['deaths']
-        # Important Note! Recovered can only be used for global data!
-        self.recovered_df = datasets['covid_recovered']
-        airport_manager = AirportToLocation(datasets['full']['confirmed'])
-        airport_manager.getDataset()
+        self.thread_num = thread_num
+        self.aggregation_cache = LRUCache(cache_size)
+        # Counts the times the cached results were cleared, so results kept
+        # outside of CovidData know when they are out of date
+        self.cache_generation = 0
+        self.unloadDatasets()
+
+    def unloadDatasets(self):
+        """
+        Forgets the loaded datasets and cached results so each dataset is
+        (re)loaded the next time it is used.
+        """
+        self.covid_manager = None
+        # Whether the COVID datasets can be loaded one at a time
+        self.covid_up_to_date = None
+        self._confirmed_df = None
+        self._deaths_df = None
+        self._recovered_df = None
+        self._routes_df = None
+        self.airport_df = None
+        self.border_closure_index = None
+        self.clearCache()
+
+    @traced('CovidData.loadDatasets')
+    def loadDatasets(self):
+        """
+        (Re)loads the COVID and routes datasets and clears the cached results
+        of getData and routesToWeightedEdges.
+        """
+        self.unloadDatasets()
+        self.warm()
+
+    def warm(self):
+        """
+        Loads every dataset that has not been loaded yet instead of waiting
+        until it is first used, for example before a server starts handling
+        requests. The border closures are only loaded if their dataset
+        exists.
+
+        returns:
+            self
+        """
+        with span('CovidData.warm'):
+            self.loadCovidDatasets(['confirmed', 'deaths', 'recovered'])
+            self.getAirportToLocation()
+            if self._routes_df is None:
+                self.loadRoutes()
+            if os.path.isfile(self.border_closures_json) or os.path.isfile(self.border_closures_csv):
+                self.getBorderClosureIndex()
+        return self
+
+    def getCovidManager(self):
+        if self.covid_manager is None:
+            self.covid_manager = CovidManager()
+        return self.covid_manager
+
+    def loadCovidDatasets(self, data_types):
+        """
+        Loads the COVID datasets in data_types ('confirmed', 'deaths' and
+        'recovered') that have not been loaded yet. If the datasets need to
+        be downloaded then all of them are refreshed and loaded at once,
+        otherwise only the files of data_types are read.
+        """
+        data_types = [data_type for data_type in data_types if getattr(self, '_' + data_type + '_df') is None]
+        if len(data_types) == 0:
+            return
+
+        covid_manager = self.getCovidManager()
+        if self.covid_up_to_date is None:
+            self.covid_up_to_date = covid_manager.isUpToDate()
+
+        if not self.covid_up_to_date:
+            datasets = covid_manager.getDatasets()
+            self._confirmed_df = datasets['full']['confirmed']
+            self._deaths_df = datasets['full']['deaths']
+            # Important Note! Recovered can only be used for global data!
+            self._recovered_df = datasets['covid_recovered']
+            self.covid_up_to_date = True
+            return
+
+        full_labels = [data_type for data_type in data_types if not data_type == 'recovered']
+        if len(full_labels) > 0:
+            try:
+                full_datasets = covid_manager.loadFullDataset(full_labels)
+            except:
+                # The full datasets are built from the other datasets if they are missing
+                full_datasets = covid_manager.loadDatasets()['full']
+            for full_label in full_datasets:
+                setattr(self, '_' + full_label + '_df', full_datasets[full_label])
+        if 'recovered' in data_types:
+            self._recovered_df = covid_manager.readDataset(covid_manager.getFileName('covid_recovered'))
+
+    @property
+    def confirmed_df(self):
+        if self._confirmed_df is None:
+            self.loadCovidDatasets(['confirmed'])
+        return self._confirmed_df
+
+    @confirmed_df.setter
+    def confirmed_df(self, df):
+        self._confirmed_df = df
+
+    @property
+    def deaths_df(self):
+        if self._deaths_df is None:
+            self.loadCovidDatasets(['deaths'])
+        return self._deaths_df
+
+    @deaths_df.setter
+    def deaths_df(self, df):
+        self._deaths_df = df
+
+    @property
+    def recovered_df(self):
+        if self._recovered_df is None:
+            self.loadCovidDatasets(['recovered'])
+        return self._recovered_df
+
+    @recovered_df.setter
+    def recovered_df(self, df):
+        self._recovered_df = df
+
+    @property
+    def routes_df(self):
+        if self._routes_df is None:
+            self.loadRoutes()
+        return self._routes_df
+
+    @routes_df.setter
+    def routes_df(self, df):
+        self._routes_df = df
+
+    def getAirportToLocation(self):
+        """
+        Returns the dataframe mapping airports to locations in the COVID
+        datasets, created by AirportToLocation if it does not exist yet.
+        """
+        if self.airport_df is None:
+            airport_df = AirportToLocation(self.confirmed_df).getDataset()
+            if not airport_df is None:
+                airport_df['LocationID'] = self.getCovidManager().registerLocations(airport_df)
+            self.airport_df = airport_df
+        return self.airport_df
+
+    def loadRoutes(self):
+        """
+        Loads the routes dataset, running download_route_dataset.py to create
+        it if it does not exist. The routes are kept in the binary dataset
+        cache so they do not need to be parsed again. The location IDs of
+        each route are added as the DepartLocationID and ArrivalLocationID
+        columns.
+        """
+        if not os.path.isfile(self.routes_locations):
+            # The route downloader needs the airport to location dataset
+            self.getAirportToLocation()
+            self.downloadRoutes()
+
+        covid_manager = self.getCovidManager()
+        with span('CovidData.readRoutes') as stage:
+            routes_df = covid_manager.readDataset(self.routes_locations)
+            for side in ['Depart', 'Arrival']:
+                routes_df[side + 'LocationID'] = covid_manager.registerLocations(routes_df, side)
+            self._routes_df = routes_df
+            stage.count('rows', routes_df.shape[0])
+        self.filled_routes_df = None
+        self.route_aggregates = None
+        return self._routes_df
+
+    def downloadRoutes(self):
+        """
+        Runs download_route_dataset.py to create the routes dataset. If
+        tracing is enabled the spans of the downloader are added to the trace.
+        """
+        tracer = get_tracer()
+        with span('CovidData.downloadRoutes'):
+            if tracer is None:
+                subprocess.run(['python3', 'download_route_dataset.py', '-t', str(self.thread_num)], capture_output=True)
+                return
+
+            trace_folder = tempfile.mkdtemp()
+            trace_prefix = os.path.join(trace_folder, 'download_route_dataset')
+            env = dict(os.environ)
+            env[TRACE_ENV_VARIABLE] = trace_prefix
+            subprocess.run(['python3', 'download_route_dataset.py', '-t', str(self.thread_num)], capture_output=True, env=env)
+            try:
+                tracer.mergeTrace(trace_prefix + '.trace.json')
+            except (IOError, ValueError):
+                print("Unable to load the trace of download_route_dataset.py")
+            shutil.rmtree(trace_folder, ignore_errors=True)
+
+    def clearCache(self):
+        """
+        Clears the cached results, needs to be called if the dataframes are
+        changed.
+        """
+        self.aggregation_cache.clear()
+        self.cache_generation += 1
+        self.filled_datasets = {}
+        self.filled_routes_df = None
+        self.route_aggregates = None
+        self.location_ids = {}
+
+    def getCacheInfo(self):
+        """
+        Returns the hits, misses and size of the getData and
+        routesToWeightedEdges cache.
+        """
+        return self.aggregation_cache.info()
 
-        if not os.path.isfile(routes_locations):
-            subprocess.run(['python3', 'download_route_dataset.py', '-t', str(thread_num)], capture_output=True)
+    def getFilledDatasets(self):
+        """
+        Returns the COVID dataframes with missing values filled with "none".
+        The dataframes are shared so they should not be modified.
+        """
+        for data_type in ['confirmed', 'deaths', 'recovered']:
+            self.getFilledDataset(data_type)
+        return self.filled_datasets
+
+    def getFilledDataset(self, data_type):
+        """
+        Returns one of the dataframes from getFilledDatasets, only loading and
+        filling that dataset.
+        """
+        if not data_type in self.filled_datasets:
+            self.filled_datasets[data_type] = getattr(self, data_type + '_df').fillna("none")
+        return self.filled_datasets[data_type]
+
+    def getFilledRoutes(self):
+        """
+        Returns the routes dataframe with missing values filled with "none".
+        The dataframe is shared so it should not be modified.
+        """
+        if self.filled_routes_df is None:
+            self.filled_routes_df = self.routes_df.fillna("none")
+        return self.filled_routes_df
 
-        self.routes_df = pd.read_csv(routes_locations)
+    def getLocationRegistry(self):
+        """
+        Returns the LocationRegistry giving every location in the datasets an
+        integer ID.
+        """
+        return self.getCovidManager().getLocationRegistry()
 
+    def getLocationIDs(self, data_type, bin_region_column='county'):
+        """
+        Returns the location ID of every row of the confirmed, deaths or
+        recovered dataset at the bin_region_column level. The IDs are kept
+        beside the datasets instead of in a column since the date columns are
+        found by position.
+        """
+        if not data_type in self.location_ids:
+            self.location_ids[data_type] = self.getCovidManager().registerLocations(getattr(self, data_type + '_df'))
+        if bin_region_column == 'county':
+            return self.location_ids[data_type]
+        return self.getLocationRegistry().getRollup('county', bin_region_column)[self.location_ids[data_type]]
+
+    def getRouteAggregates(self):
+        """
+        Returns the RouteAggregates of the routes dataset, the number of
+        routes between locations at every level computed once per load.
+        """
+        if self.route_aggregates is None:
+            with span('CovidData.getRouteAggregates') as stage:
+                self.route_aggregates = RouteAggregates(self.routes_df, self.getLocationRegistry())
+                stage.count('rows', self.route_aggregates.num_routes)
+        return self.route_aggregates
+
+    @traced('CovidData.createBorderDataset')
     def createBorderDataset(self):
         border_closure_df = pd.read_csv(self.border_closures_csv, delimiter=':').fillna('none')
         eu_countries_str = '|'.join(pd.read_csv(self.eu_countries_csv)['Country'].tolist())
@@ -106,11 +372,46 @@ class CovidData:
         with open(self.border_closures_json, 'w') as fp:
             json.dump(border_closures, fp)
 
+        self.border_closure_index = BorderClosureIndex(border_closures, self.getDates())
+        return self.border_closure_index
+
     def loadBorderDataset(self):
+        """
+        Loads the border closures dataset created by createBorderDataset and
+        compiles it into self.border_closure_index.
+
+        returns:
+            The border closures as a dictionary.
+        """
         with open(self.border_closures_json, 'r') as fp:
             data = json.load(fp)
+        self.border_closure_index = BorderClosureIndex(data, self.getDates())
         return data
 
+    def getBorderClosureIndex(self):
+        """
+        Returns the compiled BorderClosureIndex of the border closures
+        dataset, loading the dataset if it has not been loaded yet.
+        """
+        if self.border_closure_index is None:
+            if os.path.isfile(self.border_closures_json):
+                self.loadBorderDataset()
+            else:
+                self.createBorderDataset()
+        return self.border_closure_index
+
+    def getDates(self):
+        """
+        Returns the list of dates in the COVID datasets. If the confirmed
+        dataset has not been loaded yet the dates are read from its header.
+        """
+        if self._confirmed_df is None and self.canReadWindows():
+            try:
+                return self.getCovidManager().getFullDates()
+            except IOError:
+                pass
+        return self.confirmed_df.columns[5:].to_list()
+
 
     def routesToWeightedEdges(self, bin_region_column, country):
         """
@@ -135,34 +436,53 @@ class CovidData:
 
         returns:
             A dataframe specifying the number of routes between locations
-            specified by the parameters.
+            specified by the parameters. The dataframe shares its values with
+            the cached result so it must not be modified, call copy() on it
+            first to change it.
         """
-        new_routes_df = self.routes_df.copy(deep=True).fillna("none")
+        cache_key = ('routes', bin_region_column, country)
+        with span('CovidData.routesToWeightedEdges', bin_region_column=bin_region_column) as stage:
+            routes = self.aggregation_cache.get(cache_key)
+            if routes is None:
+                stage.count('cache_misses')
+                stage.count('rows', self.routes_df.shape[0])
+                routes = self._routesToWeightedEdges(bin_region_column, country)
+                self.aggregation_cache.put(cache_key, routes)
+            else:
+                stage.count('cache_hits')
+        return routes.copy(deep=False)
 
-        if not country == None:
-            new_routes_df = new_routes_df.loc[(new_routes_df['DepartCountry/Region'] == country) & (new_routes_df['ArrivalCountry/Region'] == country)]
+    def _routesToWeightedEdges(self, bin_region_column, country):
+        return self.getRouteAggregates().getEdges(bin_region_column, country)
 
-        new_routes_df['NumberOfRoutes'] = 1
-        agg_dict = {'NumberOfRoutes' : ['sum']}
-        new_column = ['NumberOfRoutes']
+    def routesToAdjacency(self, bin_region_column, country=None):
+        """
+        Returns the number of routes between locations as a sparse matrix,
+        for graph algorithms that do not need a dataframe or networkx graph.
 
-        if bin_region_column == 'county':
-            return new_routes_df.groupby([ 'DepartCounty',
-                                           'DepartProvince/State',
-                                           'DepartCountry/Region',
-                                           'ArrivalCounty',
-                                           'ArrivalProvince/State',
-                                           'ArrivalCountry/Region'])['NumberOfRoutes'].sum().reset_index()
-        if bin_region_column == 'state':
-            return new_routes_df.groupby([ 'DepartProvince/State',
-                                           'DepartCountry/Region',
-                                           'ArrivalProvince/State',
-                                           'ArrivalCountry/Region'])['NumberOfRoutes'].sum().reset_index()
-        if bin_region_column == 'country':
-            return new_routes_df.groupby([ 'DepartCountry/Region',
-                                           'ArrivalCountry/Region'])['NumberOfRoutes'].sum().reset_index()
-
-    def getData(self, bin_region_column='county', country=None, specific_date=None):
+        parameters:
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            country:           If None then all routes between countries are
+                               used. If not None then only looks at routes
+                               within that country.
+
+        returns:
+            A scipy.sparse csr_matrix where entry (ii, jj) is the number of
+            routes departing location ii and arriving at location jj, and the
+            list of location names ("County:State:Country", "State:Country"
+            or "Country") of the rows and columns. The matrix is cached so it
+            should not be modified.
+        """
+        cache_key = ('adjacency', bin_region_column, country)
+        adjacency = self.aggregation_cache.get(cache_key)
+        if adjacency is None:
+            matrix, locations = self.getRouteAggregates().getAdjacency(bin_region_column, country)
+            adjacency = (matrix, tuple(locations))
+            self.aggregation_cache.put(cache_key, adjacency)
+        return adjacency[0], list(adjacency[1])
+
+    def getData(self, bin_region_column='county', country=None, specific_date=None, start_date=None, end_date=None, metrics=None):
         """
         Gets the COVID data and routes inbetween locations based on the
         parameters of the function.
@@ -190,59 +510,137 @@ class CovidData:
                                specific date.
                                If set to 'latest' then returns the data from the
                                latest date of recording.
+                               With bin_region_column='county' it is only
+                               checked and every date is returned.
+
+            start_date:        If not None then only the dates from start_date
+                               are returned. Can not be used with
+                               specific_date.
+
+            end_date:          If not None then only the dates up to end_date
+                               are returned. Can not be used with
+                               specific_date.
+
+            metrics:           The datasets to return, a list of 'confirmed',
+                               'deaths' and 'recovered'. If None then
+                               confirmed and deaths are returned, and recovered
+                               as well if bin_region_column='country'.
+
+        If a dataset has not been loaded yet and only some of the dates or one
+        country are asked for, only those dates and rows are read from the
+        dataset instead of loading all of it.
 
         returns:
             Returns a dictionary stores the COVID data as dataframes based on
             the parameters and a dataframe storing the routes between locations
-            in the COVID dataframes.
+            in the COVID dataframes. The dataframes share their values with the
+            cached results so they must not be modified, call copy() on them
+            first to change them.
         """
         assert (bin_region_column == 'county') or (bin_region_column == 'state') or (bin_region_column == 'country'), "Invalid region parsed to bin_region_column! Needs to be county, state or country"
+        assert specific_date is None or (start_date is None and end_date is None), "specific_date can not be used with start_date or end_date"
+        if metrics is None:
+            metrics = ['confirmed', 'deaths'] + (['recovered'] if bin_region_column == 'country' else [])
+        metrics = tuple(metrics)
+        assert all(metric in ('confirmed', 'deaths', 'recovered') for metric in metrics), "Invalid metrics! Needs to be confirmed, deaths or recovered"
+        assert bin_region_column == 'country' or not 'recovered' in metrics, "The recovered dataset can only be used with bin_region_column='country'"
+        if bin_region_column == 'county' and not specific_date is None:
+            # The county data has always been returned with every date
+            self._selectDates(self.getDates(), specific_date, None, None)
+            specific_date = None
+
+        cache_key = ('data', bin_region_column, country, specific_date, start_date, end_date, metrics)
+        with span('CovidData.getData', bin_region_column=bin_region_column) as stage:
+            cached = self.aggregation_cache.get(cache_key)
+            if cached is None:
+                stage.count('cache_misses')
+                datasets, dates = self._selectDatasets(metrics, country, specific_date, start_date, end_date)
+                stage.count('rows', datasets[metrics[0]].shape[0] if len(metrics) > 0 else 0)
+                data = self._aggregateData(bin_region_column, datasets, dates)
+                cached = data
+                self.aggregation_cache.put(cache_key, cached)
+            else:
+                stage.count('cache_hits')
 
-        data = {
-            'confirmed' : self.confirmed_df.copy(deep=True).fillna("none"),
-            'deaths'    : self.deaths_df.copy(deep=True).fillna("none")
-        }
+        data = {data_type : cached[data_type].copy(deep=False) for data_type in cached}
+        return data, self.routesToWeightedEdges(bin_region_column, country)
 
-        if bin_region_column == 'country':
-            data['recovered'] = self.recovered_df.copy(deep=True).fillna("none")
+    def getTimeSeriesStore(self, bin_region_column='county', country=None):
+        """
+        Returns the COVID data from getData as a TimeSeriesStore of
+        locations x dates matrices for fast lookups by location and date.
+        """
+        cache_key = ('store', bin_region_column, country)
+        store = self.aggregation_cache.get(cache_key)
+        if store is None:
+            store = TimeSeriesStore.fromCovidData(self, bin_region_column, country)
+            self.aggregation_cache.put(cache_key, store)
+        return store
+
+    def _selectDates(self, dates, specific_date, start_date, end_date):
+        if not specific_date is None:
+            if specific_date == 'latest':
+                return dates[-1:]
+            assert (specific_date in dates), "{} is not a valid date. Check the covid .csv files for what a valid dates look like!".format(specific_date)
+            return [specific_date]
+        return select_date_columns(dates, start_date, end_date)
 
-        if not country == None:
-            for data_type in data:
-                data[data_type] = data[data_type].loc[data[data_type]['Country/Region'] == country]
+    def canReadWindows(self):
+        """
+        Returns True if the COVID datasets are up to date, so some of their
+        dates and rows can be read without loading all of them.
+        """
+        if self.covid_up_to_date is None:
+            self.covid_up_to_date = self.getCovidManager().isUpToDate()
+        return self.covid_up_to_date
+
+    def _readDatasetWindows(self, metrics, dates, country):
+        """
+        Reads only the dates and rows of the COVID datasets in metrics that
+        getData needs, returns None if they can not be read one at a time.
+        """
+        covid_manager = self.getCovidManager()
+        filters = None if country == None else {'Country/Region' : country}
+        full_labels = [metric for metric in metrics if not metric == 'recovered']
+        try:
+            datasets = covid_manager.loadFullDataset(full_labels, dates, filters) if len(full_labels) > 0 else {}
+        except IOError:
+            return None
+        if 'recovered' in metrics:
+            datasets['recovered'] = covid_manager.readDataset(covid_manager.getFileName('covid_recovered'), dates, filters)
+        return {metric : datasets[metric].fillna("none") for metric in metrics}
+
+    def _selectDatasets(self, metrics, country, specific_date, start_date, end_date):
+        """
+        Returns the filled COVID datasets in metrics with only the rows of
+        country and the dates asked for by getData.
+        """
+        all_dates = self.getDates()
+        dates = self._selectDates(all_dates, specific_date, start_date, end_date)
 
-        dates = data['confirmed'].columns[5:].to_list()
-        new_columns = ['Lat', 'Long'] + dates
+        narrowed = not (len(dates) == len(all_dates) and country == None)
+        if narrowed and any(getattr(self, '_' + metric + '_df') is None for metric in metrics) and self.canReadWindows():
+            datasets = self._readDatasetWindows(metrics, dates, country)
+            if not datasets is None:
+                return datasets, dates
 
-        # Order is required so Lat and Long are before dates
-        agg_dict = {}
-        agg_dict['Lat'] = ['mean']
-        agg_dict['Long'] = ['mean']
+        data = {metric : self.getFilledDataset(metric) for metric in metrics}
 
-        if specific_date == None:
-            for date in dates: agg_dict[date] = ['sum']
-        elif not specific_date == 'latest':
-            assert (specific_date in dates), "{} is not a valid date. Check the covid .csv files for what a valid dates look like!".format(specific_date)
-            agg_dict[specific_date] = ['sum']
-            new_columns = ['Lat', 'Long'] + [specific_date]
-        else:
-            latest_date = dates[-1]
-            agg_dict[latest_date] = ['sum']
-            new_columns = ['Lat', 'Long'] + [latest_date]
+        if not country == None:
+            for data_type in data:
+                data[data_type] = data[data_type].loc[data[data_type]['Country/Region'] == country]
 
+        if not len(dates) == len(all_dates):
+            # Only keep the selected dates so the county dataset has the
+            # same columns as one read from the dataset files
+            for data_type in data:
+                columns = [column for column in data[data_type].columns if not is_date_column(column)] + dates
+                data[data_type] = data[data_type][columns]
+        return data, dates
 
+    def _aggregateData(self, bin_region_column, data, agg_dates):
+        # County specific dataset is just the full COVID dataset
         for data_type in data:
-            df = data[data_type]
-            # County specific dataset is just the full COVID dataset
-            if bin_region_column == 'county': continue
-            if bin_region_column == 'state':
-                new_df = df.groupby(['Province/State', 'Country/Region']).agg(agg_dict)
-                new_df.columns = new_columns
-                new_df = new_df.reset_index()
-                data[data_type] = new_df
-            if bin_region_column == 'country':
-                new_df = df.groupby(['Country/Region']).agg(agg_dict)
-                new_df.columns = new_columns
-                new_df = new_df.reset_index()
-                data[data_type] = new_df
+            data[data_type] = aggregate_locations(data[data_type], bin_region_column, agg_dates)
 
-        return data, self.routesToWeightedEdges(bin_region_column, country)
+        return data
@@ -0,0 +1,217 @@
+import numpy as np
+import pandas as pd
+from locations import get_location_names
+
+def get_case_matrix(df, dates):
+    """
+    Returns the cases of df for dates as a locations x dates array.
+    """
+    return df[list(dates)].to_numpy()
+
+def get_dates(df):
+    """
+    Returns the date columns of a COVID dataframe, every column after Long.
+    """
+    columns = df.columns.tolist()
+    return columns[columns.index('Long') + 1:]
+
+def day_over_day_ratios(cases, thresh=50):
+    """
+    Returns the ratio of the cases on each date to the cases on the date
+    before it for every location.
+
+    parameters:
+        cases:  a locations x dates array of cases.
+
+        thresh: ratios from dates with less than thresh cases are set to 0,
+                small numbers would show an artificial spike in change.
+
+    returns:
+        A locations x (dates - 1) array where column ii is the ratio of the
+        cases on date ii + 1 to date ii.
+    """
+    cases = np.asarray(cases)
+    current = cases[:, :-1]
+    following = cases[:, 1:]
+    counted = current >= thresh
+    ratios = np.zeros(current.shape, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(following, current, out=ratios, where=counted)
+    return ratios
+
+def max_percent_changes(cases, thresh=50):
+    """
+    Returns the largest day over day ratio of every location, 0 if no date
+    has at least thresh cases.
+    """
+    ratios = day_over_day_ratios(cases, thresh)
+    if ratios.shape[1] == 0:
+        return np.zeros(ratios.shape[0], dtype=np.float64)
+    return ratios.max(axis=1)
+
+def get_location_labels(df, bin_region_column):
+    """
+    Returns the location labels used by the timeline plots, for example
+    " New York US" or " Italy", for every row of df.
+    """
+    labels = pd.Series([""] * df.shape[0], index=df.index)
+    if bin_region_column == 'county':
+        counties = df['County'].astype(str)
+        labels = counties.where(counties != 'none', "") + " " + df['Province/State'].astype(str)
+    if bin_region_column == 'state':
+        states = df['Province/State'].astype(str)
+        labels = labels.where(states == 'none', labels + " " + states)
+    return (labels + " " + df['Country/Region'].astype(str)).tolist()
+
+def get_max_percent_changes(df, bin_region_column, thresh=50, limit=None):
+    """
+    Computes the largest day over day ratio of cases for every location in
+    df, the values plotted by plot_max_percent_changes in the timeline
+    notebook.
+
+    parameters:
+        df:                a COVID dataframe from CovidData.getData.
+
+        bin_region_column: Is either 'county', 'state' or 'country'.
+
+        thresh:            dates with less than thresh cases are ignored.
+
+        limit:             if not None only the limit largest changes are
+                           returned.
+
+    returns:
+        A dataframe with the columns 'Locations' and 'Max Percent Change'
+        sorted by 'Max Percent Change'. Locations without a date with at
+        least thresh cases are left out.
+    """
+    dates = get_dates(df)
+    max_changes = max_percent_changes(get_case_matrix(df, dates), thresh)
+    keep = max_changes != 0
+    labels = np.asarray(get_location_labels(df, bin_region_column), dtype=object)
+
+    new_df = pd.DataFrame({'Locations' : labels[keep].tolist(), 'Max Percent Change': max_changes[keep]})
+    new_df = new_df.sort_values('Max Percent Change')
+
+    if not limit == None:
+        new_df = new_df.tail(limit)
+    return new_df
+
+def infection_rates(cases, ignore_thresh=1):
+    """
+    Returns the ratio of cases between consecutive dates for every
+    location, the r coefficients of the infection path notebook.
+
+    parameters:
+        cases:         a locations x dates array of confirmed cases.
+
+        ignore_thresh: dates with less than ignore_thresh cases have a rate
+                       of 0.
+
+    returns:
+        A locations x dates array. The first date has a rate of 0 and a date
+        following a date with no cases has a rate of 1.
+    """
+    cases = np.asarray(cases)
+    rates = np.zeros(cases.shape, dtype=np.float64)
+    previous = cases[:, :-1]
+    current = cases[:, 1:]
+    counted = current >= ignore_thresh
+
+    after_cases = counted & (previous != 0)
+    np.divide(current, previous, out=rates[:, 1:], where=after_cases)
+    rates[:, 1:][counted & (previous == 0)] = 1
+    return rates
+
+def rolling_growth_rate(rates, consecutive_days=5, r_ceil=2.0):
+    """
+    Returns the average of the rates capped at r_ceil over each window of
+    consecutive_days dates.
+
+    parameters:
+        rates:            a locations x dates array from infection_rates.
+
+        consecutive_days: the number of dates in each window.
+
+        r_ceil:           rates larger than r_ceil count as r_ceil so a
+                          single spike does not dominate the average.
+
+    returns:
+        A locations x (dates - consecutive_days) array where column ii is the
+        average over the dates ii to ii + consecutive_days - 1.
+    """
+    rates = np.asarray(rates, dtype=np.float64)
+    num_windows = max(rates.shape[1] - consecutive_days, 0)
+    capped = np.where(rates < r_ceil, rates, r_ceil)
+
+    # Adding the dates one at a time sums in the same order as sum() would
+    totals = np.zeros((rates.shape[0], num_windows), dtype=np.float64)
+    for offset in range(consecutive_days):
+        totals += capped[:, offset:offset + num_windows]
+    return totals / consecutive_days
+
+def community_spread_start(rates, consecutive_days=5, r_threshold=3, r_step=0.01, r_ceil=2.0):
+    """
+    Finds the first date each location had community spread, when both the
+    rate on that date and the rolling growth rate from that date exceed a
+    threshold. The threshold starts at r_threshold and is lowered by r_step
+    until every location has a date with community spread.
+
+    parameters:
+        rates:            a locations x dates array from infection_rates.
+
+        consecutive_days: the number of dates averaged for the growth rate.
+
+        r_threshold:      the starting threshold.
+
+        r_step:           how much the threshold is lowered each step.
+
+        r_ceil:           rates are capped at r_ceil in the growth rate.
+
+    returns:
+        The index of the onset date of every location and the threshold
+        that was used.
+    """
+    rates = np.asarray(rates, dtype=np.float64)
+    num_windows = max(rates.shape[1] - consecutive_days, 0)
+    assert num_windows > 0 or rates.shape[0] == 0, "There needs to be more than {} dates to find community spread".format(consecutive_days)
+
+    # A date has community spread for every threshold below its score
+    scores = np.minimum(rolling_growth_rate(rates, consecutive_days, r_ceil), rates[:, :num_windows])
+    # Dates with a NaN score are ignored
+    lowest_best = np.nanmin(np.nanmax(scores, axis=1)) if rates.shape[0] > 0 else np.inf
+
+    # Lowered one step at a time to find the same threshold as the notebook,
+    # unless a location has no scores to find a threshold for
+    if np.isfinite(lowest_best):
+        while not r_threshold < lowest_best:
+            r_threshold = r_threshold - r_step
+
+    onsets = (scores > r_threshold).argmax(axis=1)
+    return onsets, r_threshold
+
+def get_infection_rate(data_confirmed, dates, location_list, bin_region_column, ignore_thresh=1):
+    """
+    Same as get_infection_rate in the infection path notebook, the rates of
+    every location in location_list as {location : {date : rate}}.
+    """
+    names = get_location_names(data_confirmed, bin_region_column)
+    row_index = {}
+    for ii, name in enumerate(names):
+        row_index.setdefault(name, ii)
+
+    rows = [row_index[location] for location in location_list]
+    rates = infection_rates(get_case_matrix(data_confirmed, dates)[rows], ignore_thresh)
+    return {location : dict(zip(dates, rates[ii].tolist())) for ii, location in enumerate(location_list)}
+
+def get_when_community_spread_start(r_coefficients, dates, consecutive_days=5, r_threshold=3, r_step=0.01, r_ceil=2.0):
+    """
+    Same as get_when_community_spread_start in the infection path notebook,
+    takes the result of get_infection_rate and returns the onset date of
+    every location and the threshold that was used.
+    """
+    locations = list(r_coefficients)
+    if len(locations) == 0:
+        return {}, r_threshold
+    rates = np.array([list(r_coefficients[location].values()) for location in locations], dtype=np.float64)
+    onsets, r_threshold = community_spread_start(rates, consecutive_days, r_threshold, r_step, r_ceil)
+    return {location : dates[onsets[ii]] for ii, location in enumerate(locations)}, r_threshold
@@ -1,12 +1,522 @@
-import requests, json, math, os, datetime, io, time, shutil
+import json, math, os, datetime, io, time, shutil, re, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from instrumentation import span, traced
+from location_registry import LocationRegistry
+
+DATE_COLUMN_REGEX = re.compile(r'^\d{1,2}/\d{1,2}/\d{2,4}$')
+
+def is_date_column(column):
+    return isinstance(column, str) and DATE_COLUMN_REGEX.match(column) is not None
+
+def select_date_columns(date_columns, start_date=None, end_date=None):
+    """
+    Returns the date columns between start_date and end_date (inclusive),
+    in the order of date_columns.
+
+    parameters:
+        date_columns: the date columns of a COVID dataset, like '1/22/20'.
+
+        start_date:   the first date to keep, either a date column, a date
+                      string or a datetime. If None then the dates start
+                      from the first date.
+
+        end_date:     the last date to keep, if None then the dates go up to
+                      the latest date.
+    """
+    if start_date is None and end_date is None:
+        return list(date_columns)
+    parsed = pd.to_datetime(pd.Series(list(date_columns), dtype=object))
+    keep = np.ones(len(date_columns), dtype=bool)
+    if not start_date is None:
+        keep &= (parsed >= pd.Timestamp(start_date)).to_numpy()
+    if not end_date is None:
+        keep &= (parsed <= pd.Timestamp(end_date)).to_numpy()
+    return [date for date, keep_date in zip(date_columns, keep) if keep_date]
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class DatasetCache:
+    CACHE_VERSION = 1
+    META_FILENAME = "meta.json"
+    DATES_FILENAME = "dates.npy"
+
+    def __init__(self, cache_folder):
+        """
+        Typed binary cache of the wide COVID .csv files so they do not need to
+        be parsed again every time they are loaded.
+
+        Each .csv file is cached in its own folder inside cache_folder:
+            dates.npy     - the date columns as a (dates x rows) int32 matrix
+                            (float64 if a date column has missing values)
+            column_N.npy  - the other columns, text columns are stored as
+                            int32 category codes
+            meta.json     - the column names, categories and the size,
+                            modification time and sha1 hash of the .csv file
+
+        parameters:
+            cache_folder: the folder to store the cached datasets in.
+        """
+        self.cache_folder = cache_folder
+
+    def getCacheFolder(self, filename):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.cache_folder, name)
+
+    def _sourceInfo(self, filename):
+        stat = os.stat(filename)
+        return {'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns}
+
+    def _loadMeta(self, folder):
+        try:
+            with open(os.path.join(folder, DatasetCache.META_FILENAME), 'r') as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if not meta.get('version', None) == DatasetCache.CACHE_VERSION:
+            return None
+        return meta
+
+    def isFresh(self, filename):
+        """
+        Returns True if there is a cached copy of filename that matches the
+        current contents of the file.
+        """
+        if not os.path.isfile(filename):
+            return False
+        folder = self.getCacheFolder(filename)
+        meta = self._loadMeta(folder)
+        if meta is None:
+            return False
+
+        source_info = self._sourceInfo(filename)
+        if source_info['size'] == meta['source']['size'] and source_info['mtime_ns'] == meta['source']['mtime_ns']:
+            return True
+        if not source_info['size'] == meta['source']['size']:
+            return False
+
+        # The file was touched but may not have changed
+        if not file_hash(filename) == meta['source']['sha1']:
+            return False
+        meta['source'].update(source_info)
+        self._saveMeta(folder, meta)
+        return True
+
+    def _saveMeta(self, folder, meta):
+        with open(os.path.join(folder, DatasetCache.META_FILENAME), 'w') as fp:
+            json.dump(meta, fp)
+
+    def save(self, filename, df):
+        """
+        Caches df as the parsed contents of filename. Returns False if df has
+        columns that can not be cached.
+        """
+        folder = self.getCacheFolder(filename)
+        columns = df.columns.tolist()
+        date_columns = [column for column in columns if is_date_column(column)]
+        date_set = set(date_columns)
+
+        meta = {
+            'version'      : DatasetCache.CACHE_VERSION,
+            'columns'      : columns,
+            'date_columns' : date_columns,
+            'kinds'        : [],
+            'categories'   : {},
+            'dtypes'       : {},
+            'num_rows'     : int(df.shape[0]),
+        }
+
+        arrays = {}
+        for column_index, column in enumerate(columns):
+            if column in date_set:
+                meta['kinds'].append('date')
+                continue
+            series = df[column]
+            if series.dtype == object:
+                codes, categories = pd.factorize(series)
+                if not all(isinstance(category, str) for category in categories):
+                    return False
+                meta['kinds'].append('category')
+                meta['categories'][str(column_index)] = list(categories)
+                arrays['column_{}.npy'.format(column_index)] = codes.astype(np.int32)
+            elif series.dtype.kind in 'biuf':
+                meta['kinds'].append('numeric')
+                arrays['column_{}.npy'.format(column_index)] = series.to_numpy()
+            else:
+                return False
+
+        if len(date_columns) > 0:
+            values = df[date_columns].to_numpy()
+            meta['dtypes']['dates'] = str(values.dtype)
+            if values.dtype.kind in 'iu' and (values.size == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max)):
+                values = values.astype(np.int32)
+            arrays[DatasetCache.DATES_FILENAME] = np.ascontiguousarray(values.T)
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        for array_filename, array in arrays.items():
+            np.save(os.path.join(folder, array_filename), array, allow_pickle=False)
+
+        meta['source'] = self._sourceInfo(filename)
+        meta['source']['sha1'] = file_hash(filename)
+        self._saveMeta(folder, meta)
+        return True
+
+    def getColumns(self, filename):
+        """
+        Returns the columns of the cached copy of filename without loading
+        it, or None if the cache is missing or out of date.
+        """
+        if not self.isFresh(filename):
+            return None
+        meta = self._loadMeta(self.getCacheFolder(filename))
+        return None if meta is None else meta['columns']
+
+    def updateSource(self, filename):
+        """
+        Records the current size, modification time and hash of filename in
+        the cache meta, after filename was written with the cached contents.
+
+        returns:
+            False if there is no cached copy of filename to update.
+        """
+        folder = self.getCacheFolder(filename)
+        meta = self._loadMeta(folder)
+        if meta is None:
+            return False
+        meta['source'] = self._sourceInfo(filename)
+        meta['source']['sha1'] = file_hash(filename)
+        self._saveMeta(folder, meta)
+        return True
+
+    def load(self, filename, date_columns=None, filters=None):
+        """
+        Returns the cached dataframe of filename, or None if the cache is
+        missing or out of date.
+
+        parameters:
+            date_columns: if not None then only these date columns are loaded.
+                          The date matrix is memory mapped so only the rows of
+                          these dates are read.
+
+            filters:      dictionary of column to value, if not None then only
+                          the rows where every column equals its value are
+                          loaded and the dataframe keeps their row numbers as
+                          its index.
+        """
+        if not self.isFresh(filename):
+            return None
+        folder = self.getCacheFolder(filename)
+        meta = self._loadMeta(folder)
+
+        try:
+            rows = None
+            if not filters is None:
+                keep = np.ones(meta['num_rows'], dtype=bool)
+                for column, value in filters.items():
+                    column_index = meta['columns'].index(column)
+                    array = np.load(os.path.join(folder, 'column_{}.npy'.format(column_index)), mmap_mode='r', allow_pickle=False)
+                    if meta['kinds'][column_index] == 'category':
+                        categories = meta['categories'][str(column_index)]
+                        code = categories.index(value) if value in categories else -2
+                        keep &= np.asarray(array) == code
+                    else:
+                        keep &= np.asarray(array) == value
+                rows = np.flatnonzero(keep)
+
+            data = {}
+            for column_index, column in enumerate(meta['columns']):
+                kind = meta['kinds'][column_index]
+                if kind == 'date':
+                    continue
+                array = np.load(os.path.join(folder, 'column_{}.npy'.format(column_index)), allow_pickle=False)
+                if not rows is None:
+                    array = array[rows]
+                if kind == 'category':
+                    categories = np.array(meta['categories'][str(column_index)] + [np.nan], dtype=object)
+                    array = categories[array]
+                data[column] = array
+            df = pd.DataFrame(data, columns=[column for column in meta['columns'] if not column in meta['date_columns']],
+                              index=rows)
+
+            if date_columns is None:
+                date_columns = meta['date_columns']
+            if len(date_columns) > 0:
+                date_positions = {date : position for position, date in enumerate(meta['date_columns'])}
+                if date_columns == meta['date_columns'] and rows is None:
+                    values = np.load(os.path.join(folder, DatasetCache.DATES_FILENAME), allow_pickle=False)
+                else:
+                    stored = np.load(os.path.join(folder, DatasetCache.DATES_FILENAME), mmap_mode='r', allow_pickle=False)
+                    values = stored[[date_positions[date] for date in date_columns]]
+                    if not rows is None:
+                        values = values[:, rows]
+                    del stored
+                dates_df = pd.DataFrame(values.T.astype(meta['dtypes']['dates']), columns=date_columns, index=rows)
+                df = pd.concat([df, dates_df], axis=1)
+                wanted_dates = set(date_columns)
+                columns = [column for column, kind in zip(meta['columns'], meta['kinds']) if not kind == 'date' or column in wanted_dates]
+                if not df.columns.tolist() == columns:
+                    df = df[columns]
+        except (IOError, ValueError, KeyError, IndexError):
+            return None
+        return df
+
+    def updateDates(self, filename, df, revised_dates=()):
+        """
+        Updates the cached copy of filename in place to df, where df is the
+        cached dataframe with new date columns added to the end and the
+        values of the date columns revised_dates changed. Only the new and
+        revised dates are written so the cost depends on the size of the
+        change rather than the whole dataset.
+
+        The source information of the cache is left alone so the cache is
+        still used while filename has not been written again.
+
+        returns:
+            False if the cache can not be updated in place (it is missing, the
+            rows or other columns changed or the values need a different
+            dtype) and needs to be saved again.
+        """
+        folder = self.getCacheFolder(filename)
+        meta = self._loadMeta(folder)
+        if meta is None or not meta['num_rows'] == df.shape[0]:
+            return False
+
+        columns = df.columns.tolist()
+        old_columns = meta['columns']
+        if not columns[:len(old_columns)] == old_columns or len(meta['date_columns']) == 0:
+            return False
+        new_dates = columns[len(old_columns):]
+        if not all(is_date_column(column) for column in new_dates):
+            return False
+
+        dates_fn = os.path.join(folder, DatasetCache.DATES_FILENAME)
+        date_columns = meta['date_columns'] + new_dates
+        values_dtype = np.result_type(*df.dtypes[date_columns].tolist())
+        if not str(values_dtype) == meta['dtypes']['dates']:
+            return False
+
+        try:
+            stored = np.load(dates_fn, mmap_mode='r+', allow_pickle=False)
+        except (IOError, ValueError):
+            return False
+        stored_dtype = stored.dtype
+
+        def to_stored(columns_to_store):
+            values = np.ascontiguousarray(df[columns_to_store].to_numpy().T)
+            if values.dtype == stored_dtype:
+                return values
+            if values.dtype.kind in 'iu' and stored_dtype.kind in 'iu' and (values.size == 0 or (values.min() >= np.iinfo(stored_dtype).min and values.max() <= np.iinfo(stored_dtype).max)):
+                return values.astype(stored_dtype)
+            return None
+
+        date_positions = {date : position for position, date in enumerate(meta['date_columns'])}
+        revised_dates = [date for date in revised_dates if date in date_positions]
+        revised_values = to_stored(revised_dates) if len(revised_dates) > 0 else None
+        new_values = to_stored(new_dates) if len(new_dates) > 0 else None
+        if (len(revised_dates) > 0 and revised_values is None) or (len(new_dates) > 0 and new_values is None):
+            del stored
+            return False
+
+        for date, values in zip(revised_dates, [] if revised_values is None else revised_values):
+            stored[date_positions[date]] = values
+        stored.flush()
+        num_stored_dates = stored.shape[0]
+        del stored
+
+        if not new_values is None and not self._appendRows(dates_fn, num_stored_dates, new_values):
+            return False
+
+        meta['columns'] = columns
+        meta['date_columns'] = date_columns
+        meta['kinds'] = meta['kinds'] + ['date' for _date in new_dates]
+        self._saveMeta(folder, meta)
+        return True
+
+    def _appendRows(self, npy_fn, num_rows, values):
+        """
+        Appends values to the first axis of the C ordered array in npy_fn by
+        rewriting the header and writing the new rows to the end of the file.
+        """
+        with open(npy_fn, 'r+b') as fp:
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            header_length = fp.tell()
+            if fortran_order or not shape[0] == num_rows or not shape[1:] == values.shape[1:]:
+                return False
+
+            header = io.BytesIO()
+            header_dict = {'descr' : np.lib.format.dtype_to_descr(dtype),
+                           'fortran_order' : False,
+                           'shape' : (shape[0] + values.shape[0],) + shape[1:]}
+            if version == (1, 0):
+                np.lib.format.write_array_header_1_0(header, header_dict)
+            else:
+                np.lib.format.write_array_header_2_0(header, header_dict)
+            if not len(header.getvalue()) == header_length:
+                # The header grew past its padding, save the whole array again
+                fp.seek(0)
+                array = np.load(fp, allow_pickle=False)
+                fp.seek(0)
+                fp.truncate()
+                np.save(fp, np.concatenate([array, values]), allow_pickle=False)
+                return True
+
+            fp.seek(0)
+            fp.write(header.getvalue())
+            fp.seek(0, os.SEEK_END)
+            fp.write(values.astype(dtype, copy=False).tobytes())
+        return True
+
+class DatasetDelta:
+
+    def __init__(self, key_columns, added_dates, revised_cells, new_locations, removed_locations):
+        """
+        The changes between two versions of a COVID dataset.
+
+        parameters:
+            key_columns:       the columns identifying a location.
+
+            added_dates:       list of the date columns only in the new version.
+
+            revised_cells:     dataframe of the cells with a different value,
+                               the key columns, 'Column', 'Old' and 'New'.
+
+            new_locations:     dataframe of the key columns of the locations
+                               only in the new version.
+
+            removed_locations: dataframe of the key columns of the locations
+                               only in the old version.
+        """
+        self.key_columns = key_columns
+        self.added_dates = added_dates
+        self.revised_cells = revised_cells
+        self.new_locations = new_locations
+        self.removed_locations = removed_locations
+
+    def isEmpty(self):
+        return len(self.added_dates) == 0 and self.revised_cells.empty and self.new_locations.empty and self.removed_locations.empty
+
+    def getRevisedDates(self):
+        return [column for column in self.revised_cells['Column'].unique().tolist() if is_date_column(column)]
+
+    def summary(self):
+        return "{} added dates, {} revised cells, {} new locations, {} removed locations".format(
+            len(self.added_dates), self.revised_cells.shape[0], self.new_locations.shape[0], self.removed_locations.shape[0])
+
+def compute_dataset_delta(old_df, new_df, key_columns):
+    """
+    Compares two versions of a COVID dataset with a row per location.
+
+    parameters:
+        old_df:      the dataset stored locally.
+
+        new_df:      the updated dataset.
+
+        key_columns: the columns identifying a location, missing values are
+                     treated as equal.
+
+    returns:
+        A DatasetDelta of the changes.
+    """
+    def location_keys(df):
+        return list(zip(*[df[column].fillna('').astype(str).to_list() for column in key_columns]))
+
+    old_keys = location_keys(old_df)
+    new_keys = location_keys(new_df)
+    old_rows = {key : row for row, key in enumerate(old_keys)}
+    new_rows = {key : row for row, key in enumerate(new_keys)}
+
+    common_keys = [key for key in new_keys if key in old_rows]
+    common_old_rows = np.array([old_rows[key] for key in common_keys], dtype=int)
+    common_new_rows = np.array([new_rows[key] for key in common_keys], dtype=int)
+
+    added_dates = [column for column in new_df.columns if is_date_column(column) and not column in old_df.columns]
+    value_columns = [column for column in old_df.columns if column in new_df.columns and not column in key_columns]
+
+    revised = {column : [] for column in key_columns + ['Column', 'Old', 'New']}
+    def add_revised(columns, old_values, new_values):
+        changed = ~((old_values == new_values) | (pd.isnull(old_values) & pd.isnull(new_values)))
+        for index, column_index in zip(*np.nonzero(changed)):
+            for key_index, key_column in enumerate(key_columns):
+                revised[key_column].append(common_keys[index][key_index])
+            revised['Column'].append(columns[column_index])
+            revised['Old'].append(old_values[index, column_index])
+            revised['New'].append(new_values[index, column_index])
+
+    # The date columns are compared together, the other columns one at a time
+    # so their values keep their dtype
+    date_columns = [column for column in value_columns if is_date_column(column)]
+    other_columns = [column for column in value_columns if not is_date_column(column)]
+    for column in other_columns:
+        add_revised([column], old_df[column].to_numpy()[common_old_rows, np.newaxis], new_df[column].to_numpy()[common_new_rows, np.newaxis])
+    if len(date_columns) > 0:
+        add_revised(date_columns, old_df[date_columns].to_numpy()[common_old_rows], new_df[date_columns].to_numpy()[common_new_rows])
+
+    new_locations = pd.DataFrame([key for key in new_keys if not key in old_rows], columns=key_columns)
+    removed_locations = pd.DataFrame([key for key in old_keys if not key in new_rows], columns=key_columns)
+    return DatasetDelta(key_columns, added_dates, pd.DataFrame(revised), new_locations, removed_locations)
 
 class CovidManager:
     CONFIRMED_FULL_FILENAME = "covid_full_confirmed.csv"
     DEATHS_FULL_FILENAME = "covid_full_deaths.csv"
-
-    def __init__(self, dataset_folder='dataset/', dataset_urls_csv='dataset/dataset_urls.csv', update=True, update_time=86400, backup=True, backup_folder='dataset/backup_covid/'):
+    VALIDATORS_FILENAME = "dataset_validators.json"
+    LOCATION_REGISTRY_FILENAME = "location_registry.json"
+    # The datasets used by constructFullDataset
+    FULL_DATASET_SOURCES = ('covid_confirmed', 'covid_deaths', 'covid_us_confirmed', 'covid_us_deaths')
+    # The global and US datasets each full dataset is made from
+    FULL_DATASETS = {'confirmed' : ('covid_confirmed', 'covid_us_confirmed'),
+                     'deaths'    : ('covid_deaths', 'covid_us_deaths')}
+    FULL_KEY_COLUMNS = ['County', 'Province/State', 'Country/Region']
+    # Saved in the validators when the full .csv files are behind the binary cache
+    FULL_CSV_PENDING = "full_dataset_csv_pending"
+    # The number of rows parsed at a time when only some rows of a .csv file are read
+    CSV_CHUNK_ROWS = 10000
+
+    def __init__(self, dataset_folder='dataset/', dataset_urls_csv='dataset/dataset_urls.csv', update=True, update_time=86400, backup=True, backup_folder='dataset/backup_covid/', cache=True, cache_folder=None, verbose=False, download_threads=6, delta_ingest=True, export_full_csv=False):
+        """
+        Downloads, backs up and loads the COVID datasets listed in
+        dataset_urls_csv.
+
+        Datasets are refreshed with conditional requests using the ETag and
+        Last-Modified headers of the previous download, which are saved in
+        dataset_validators.json in dataset_folder along with a hash of the
+        downloaded content. Datasets that have not changed are not parsed or
+        saved again and the full dataset is only rebuilt if one of its
+        sources changed.
+
+        parameters:
+            cache:        if True the parsed datasets are stored in a binary
+                          cache next to the .csv files and loaded from it
+                          while it is up to date.
+
+            cache_folder: where to store the cache, defaults to the folder
+                          'cache/' inside dataset_folder.
+
+            verbose:      prints where each dataset was loaded from and how
+                          long it took.
+
+            download_threads: the number of datasets downloaded at once.
+
+            delta_ingest: if True the full datasets are updated with only the
+                          dates added and the values revised since the last
+                          refresh instead of being rebuilt. The binary cache is
+                          updated in place and the full .csv files are only
+                          written by exportFullDataset.
+
+            export_full_csv: if True the full .csv files are written at the
+                          end of every refresh that only updated the binary
+                          cache, which costs as much as rebuilding them.
+        """
         self.COLUMN_NAMES = ("dataset_label", "url")
         self.dataset_folder = dataset_folder
         self.dataset_urls = dataset_urls_csv
@@ -14,29 +524,244 @@ class CovidManager:
         self.update = update
         self.backup = backup
         self.backup_folder = backup_folder
+        self.verbose = verbose
+        self.dataset_cache = None
+        if cache:
+            self.dataset_cache = DatasetCache(cache_folder if not cache_folder is None else os.path.join(dataset_folder, 'cache'))
+        # Where each dataset was loaded from ('cache' or 'csv') and how long it took
+        self.load_times = {}
+        self.download_threads = download_threads
+        self.validators_fn = os.path.join(dataset_folder, CovidManager.VALIDATORS_FILENAME)
+        # Time taken, bytes downloaded and the status of each dataset for the last refresh
+        self.refresh_metrics = {}
+        self.delta_ingest = delta_ingest
+        self.export_full_csv = export_full_csv
+        # The changes made to the full datasets by the last refresh
+        self.change_report = {}
+        self.location_registry = None
 
     def getFileName(self, data_label):
         return self.dataset_folder + data_label + ".csv"
 
-    def backupDataset(self, df_urls):
-        if self.backup:
-            if not os.path.exists(self.backup_folder):
-                os.mkdir(self.backup_folder)
+    def getLocationRegistry(self):
+        """
+        Returns the LocationRegistry shared by the datasets. It is saved in
+        dataset_folder so locations keep the same IDs every time the datasets
+        are loaded.
+        """
+        if self.location_registry is None:
+            registry_fn = os.path.join(self.dataset_folder, CovidManager.LOCATION_REGISTRY_FILENAME)
+            try:
+                self.location_registry = LocationRegistry.load(registry_fn)
+            except (IOError, ValueError, KeyError, AssertionError):
+                self.location_registry = LocationRegistry()
+        return self.location_registry
+
+    def registerLocations(self, df, prefix=''):
+        """
+        Registers the locations of a dataset in the location registry, saving
+        the registry if new locations were added.
+
+        returns:
+            The county level location ID of every row of df.
+        """
+        registry = self.getLocationRegistry()
+        num_locations = len(registry)
+        location_ids = registry.register(df, prefix)
+        if len(registry) > num_locations:
+            try:
+                registry.save(os.path.join(self.dataset_folder, CovidManager.LOCATION_REGISTRY_FILENAME))
+            except IOError:
+                print("Error occurred trying to save the location registry to {}".format(self.dataset_folder))
+        return location_ids
+
+    def readDataset(self, filename, date_columns=None, filters=None):
+        """
+        Reads a dataset .csv file, using the binary cache if it is up to date.
+
+        parameters:
+            date_columns: if not None then only these date columns are read,
+                          the other columns are always read.
+
+            filters:      dictionary of column to value, if not None then only
+                          the rows where every column equals its value are
+                          kept, with their row numbers in the file as the
+                          index.
+
+        When date_columns or filters are given and the cache is out of date
+        only those columns are parsed from the .csv file, in chunks of
+        CSV_CHUNK_ROWS rows that are filtered before they are joined. The
+        cache is not saved from a partial read.
+        """
+        start_time = time.time()
+        partial = not date_columns is None or not filters is None
+        with span('CovidManager.readDataset', filename=os.path.basename(filename)) as stage:
+            df = None
+            source = 'cache'
+            if not self.dataset_cache is None:
+                df = self.dataset_cache.load(filename, date_columns, filters)
+            if df is None and partial:
+                source = 'csv'
+                df = self._readCsvColumns(filename, date_columns, filters)
+                stage.count('bytes_read', os.path.getsize(filename))
+            elif df is None:
+                source = 'csv'
+                df = pd.read_csv(filename)
+                stage.count('bytes_read', os.path.getsize(filename))
+                if not self.dataset_cache is None:
+                    self.dataset_cache.save(filename, df)
+            stage.count('dataset_cache_hits' if source == 'cache' else 'dataset_cache_misses')
+            stage.count('rows', df.shape[0])
+            stage.count('columns', df.shape[1])
+
+        load_time = time.time() - start_time
+        self.load_times[os.path.basename(filename)] = {'source' : source, 'seconds' : load_time}
+        if self.verbose:
+            print("Loaded {} from {} in {:.3f}s".format(filename, source, load_time))
+        return df
+
+    def _readCsvColumns(self, filename, date_columns, filters):
+        if date_columns is None:
+            usecols = None
+        else:
+            wanted_dates = set(date_columns)
+            usecols = lambda column : not is_date_column(column) or column in wanted_dates
+        if filters is None:
+            return pd.read_csv(filename, usecols=usecols)
+
+        chunks = []
+        for chunk in pd.read_csv(filename, usecols=usecols, chunksize=CovidManager.CSV_CHUNK_ROWS):
+            keep = np.ones(chunk.shape[0], dtype=bool)
+            for column, value in filters.items():
+                keep &= (chunk[column] == value).to_numpy()
+            chunks.append(chunk.loc[keep])
+        if len(chunks) == 0:
+            return pd.read_csv(filename, usecols=usecols)
+        return pd.concat(chunks)
+
+    def getDatasetColumns(self, filename):
+        """
+        Returns the columns of a dataset .csv file from the binary cache if it
+        is up to date, otherwise from the header of the file.
+        """
+        columns = None
+        if not self.dataset_cache is None:
+            columns = self.dataset_cache.getColumns(filename)
+        if columns is None:
+            columns = pd.read_csv(filename, nrows=0).columns.tolist()
+        return columns
+
+    def getLoadTimes(self):
+        """
+        Returns a dataframe of where each dataset was loaded from and how
+        long it took.
+        """
+        return pd.DataFrame.from_dict(self.load_times, orient='index')
+
+    def backupDataset(self, df_urls, data_labels=None, backup_full=True):
+        """
+        Copies the datasets into the backup folder before they are replaced.
+
+        parameters:
+            data_labels: the datasets to back up, if None all of them are.
 
-            get_backup_filename = lambda data_label : self.backup_folder + data_label + ".csv"
-            for index, row in df_urls.iterrows():
-                data_label = row[self.COLUMN_NAMES[0]]
-                filename = self.getFileName(data_label)
-                if os.path.isfile(filename):
-                    shutil.copyfile(filename, get_backup_filename(data_label))
+            backup_full: if True the full datasets are backed up as well.
+        """
+        if not self.backup:
+            return
+        if not os.path.exists(self.backup_folder):
+            os.mkdir(self.backup_folder)
+
+        get_backup_filename = lambda data_label : self.backup_folder + data_label + ".csv"
+        for index, row in df_urls.iterrows():
+            data_label = row[self.COLUMN_NAMES[0]]
+            if not data_labels is None and not data_label in data_labels:
+                continue
+            filename = self.getFileName(data_label)
+            if os.path.isfile(filename):
+                shutil.copyfile(filename, get_backup_filename(data_label))
+
+        if not backup_full:
+            return
+
+        # The full .csv files are out of date if the last refresh was not
+        # exported, they are not backed up since loadLatestBackup rebuilds
+        # the full datasets from the other datasets
+        if self.isFullCsvPending():
+            return
 
         if os.path.isfile(self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME):
             shutil.copyfile(self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME, self.backup_folder + CovidManager.CONFIRMED_FULL_FILENAME)
 
         if os.path.isfile(self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME):
             shutil.copyfile(self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME, self.backup_folder + CovidManager.DEATHS_FULL_FILENAME)
-        self.clearDatasets()
 
+    def loadValidators(self):
+        """
+        Returns the ETag, Last-Modified header, content hash and the last time
+        each dataset was checked, keyed by data_label.
+        """
+        try:
+            with open(self.validators_fn, 'r') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def saveValidators(self, validators):
+        with open(self.validators_fn, 'w') as fp:
+            json.dump(validators, fp, indent=1)
+
+    def getRefreshMetrics(self):
+        """
+        Returns the metrics of the last refresh: the time it took, the bytes
+        downloaded and whether each dataset was 'not_modified', 'unchanged'
+        (downloaded but the content hash matched) or 'changed'.
+        """
+        return self.refresh_metrics
+
+    def parseDownloadedDataset(self, data_label, content):
+        data_df = pd.read_csv(io.StringIO(content.decode('utf-8').replace('\r', '')))
+
+        # Make columns of US dataset iso code table to be consistent with global covid dataset
+        if 'us' in data_label or 'iso' in data_label:
+            data_df = data_df.rename(columns={'Province_State' : 'Province/State',
+                                              'Country_Region' : 'Country/Region',
+                                              'Admin2' : 'County',
+                                              'Long_' : 'Long'})
+            # Get rid of useless rows that are in the US dataset
+            # Will result in US showing less numbers than global dataset, but we need locations of where these cases are.
+            if 'us' in data_label:
+                data_df = data_df.loc[data_df['Lat'] != 0.0]
+                data_df = data_df.loc[data_df['Lat'].notnull()]
+        return data_df
+
+    def fetchDataset(self, get_session, data_label, url, validator):
+        """
+        Downloads a dataset unless it has not been modified since the last
+        download.
+
+        parameters:
+            get_session: returns the requests.Session of the calling thread.
+
+        returns:
+            (status code, content or None, ETag, Last-Modified)
+        """
+        headers = {}
+        if os.path.isfile(self.getFileName(data_label)) and validator.get('url', None) == url:
+            if not validator.get('etag', None) is None:
+                headers['If-None-Match'] = validator['etag']
+            if not validator.get('last_modified', None) is None:
+                headers['If-Modified-Since'] = validator['last_modified']
+
+        with span('CovidManager.fetchDataset', data_label=data_label) as stage:
+            response = get_session().get(url, headers=headers)
+            stage.count('bytes_downloaded', len(response.content))
+        if response.status_code == 304:
+            return 304, None, validator.get('etag', None), validator.get('last_modified', None)
+        response.raise_for_status()
+        return response.status_code, response.content, response.headers.get('ETag', None), response.headers.get('Last-Modified', None)
+
+    @traced('CovidManager.downloadDataset')
     def downloadDataset(self):
         try:
             df_urls = pd.read_csv(self.dataset_urls, header=None, names=self.COLUMN_NAMES)
@@ -44,33 +769,89 @@ class CovidManager:
             print("There is no csv file at {} to specify where to download the dataset from".format(self.dataset_urls))
             return {}
 
-        self.backupDataset(df_urls)
+        start_time = time.time()
+        validators = self.loadValidators()
+        data_labels = df_urls[self.COLUMN_NAMES[0]].to_list()
+        urls = df_urls[self.COLUMN_NAMES[1]].to_list()
+
+        # Only imported when downloading since it is slow to import
+        import requests
+
+        # Download everything before touching the datasets so a failed
+        # download leaves the current datasets alone
+        # requests.Session is not thread safe so each download thread keeps
+        # its own, reusing its connections for the datasets it downloads
+        thread_sessions = threading.local()
+        sessions = []
+        def get_session():
+            if not hasattr(thread_sessions, 'session'):
+                thread_sessions.session = requests.Session()
+                sessions.append(thread_sessions.session)
+            return thread_sessions.session
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(self.download_threads, 1)) as executor:
+                futures = [executor.submit(self.fetchDataset, get_session, data_label, url, validators.get(data_label, {}))
+                           for data_label, url in zip(data_labels, urls)]
+                responses = [future.result() for future in futures]
+        finally:
+            for session in sessions:
+                session.close()
+
+        checked_time = time.time()
+        metrics = {'datasets' : {}, 'bytes_downloaded' : 0, 'full_rebuilt' : False}
+        changed = {}
+        for data_label, url, (status, content, etag, last_modified) in zip(data_labels, urls, responses):
+            validator = validators.get(data_label, {})
+            content_hash = validator.get('sha1', None)
+            if status == 304:
+                dataset_status = 'not_modified'
+            else:
+                metrics['bytes_downloaded'] += len(content)
+                content_hash = hashlib.sha1(content).hexdigest()
+                if content_hash == validator.get('sha1', None) and os.path.isfile(self.getFileName(data_label)):
+                    dataset_status = 'unchanged'
+                else:
+                    dataset_status = 'changed'
+                    changed[data_label] = content
+            metrics['datasets'][data_label] = {'status' : dataset_status, 'bytes' : 0 if content is None else len(content)}
+            validators[data_label] = {'url'           : url,
+                                      'etag'          : etag,
+                                      'last_modified' : last_modified,
+                                      'sha1'          : content_hash,
+                                      'checked'       : checked_time}
+
+        rebuild_full = any(data_label in changed for data_label in CovidManager.FULL_DATASET_SOURCES) or not self.datasetsExist()
+        if len(changed) > 0 or rebuild_full:
+            self.backupDataset(df_urls, data_labels=set(changed), backup_full=rebuild_full)
+
         datasets = {}
+        for data_label in data_labels:
+            if data_label in changed:
+                data_df = self.parseDownloadedDataset(data_label, changed[data_label])
+                data_df.to_csv(self.getFileName(data_label), index=False, header=True)
+                datasets[data_label] = data_df
+            else:
+                datasets[data_label] = self.readDataset(self.getFileName(data_label))
 
-        for index, row in df_urls.iterrows():
-            data_label = row[self.COLUMN_NAMES[0]]
-            url = row[self.COLUMN_NAMES[1]]
-            dwnld = requests.get(url).content
-            data_df = pd.read_csv(io.StringIO(dwnld.decode('utf-8').replace('\r', '')))
-
-            # Make columns of US dataset iso code table to be consistent with global covid dataset
-            if 'us' in data_label or 'iso' in data_label:
-                data_df = data_df.rename(columns={'Province_State' : 'Province/State',
-                                                  'Country_Region' : 'Country/Region',
-                                                  'Admin2' : 'County',
-                                                  'Long_' : 'Long'})
-                # Get rid of useless rows that are in the US dataset
-                # Will result in US showing less numbers than global dataset, but we need locations of where these cases are.
-                if 'us' in data_label:
-                    data_df = data_df.loc[data_df['Lat'] != 0.0]
-                    data_df = data_df.loc[data_df['Lat'].notnull()]
-            datasets[data_label] = data_df
-
-            data_df.to_csv(self.getFileName(data_label), index=False, header=True)
-
-        datasets['full'] = self.constructFullDataset(datasets)
+        if rebuild_full and self.delta_ingest:
+            datasets['full'] = self.ingestFullDataset(datasets)
+            rebuild_full = self.change_report['mode'] == 'rebuild'
+        elif rebuild_full:
+            datasets['full'] = self.constructFullDataset(datasets)
+        else:
+            datasets['full'] = self.loadFullDataset()
+        metrics['full_rebuilt'] = rebuild_full
+        validators[CovidManager.FULL_CSV_PENDING] = self.isFullCsvPending()
+
+        self.saveValidators(validators)
+        metrics['seconds'] = time.time() - start_time
+        self.refresh_metrics = metrics
+        if self.verbose:
+            print("Refreshed datasets in {:.3f}s, downloaded {} bytes, {} changed".format(metrics['seconds'], metrics['bytes_downloaded'], len(changed)))
         return datasets
 
+    @traced('CovidManager.loadDatasets')
     def loadDatasets(self):
         try:
             df_urls = pd.read_csv(self.dataset_urls, header=None, names=self.COLUMN_NAMES)
@@ -81,7 +862,7 @@ class CovidManager:
         datasets = {}
         for index, row in df_urls.iterrows():
             data_label = row[self.COLUMN_NAMES[0]]
-            datasets[data_label] = pd.read_csv(self.getFileName(data_label))
+            datasets[data_label] = self.readDataset(self.getFileName(data_label))
 
         try:
             datasets['full'] = self.loadFullDataset()
@@ -116,12 +897,15 @@ class CovidManager:
             print("There is no csv file at {} to specify the names of the files".format(self.dataset_urls))
             return False
 
+        validators = self.loadValidators()
         for index, row in df_urls.iterrows():
             data_label = row[self.COLUMN_NAMES[0]]
             filename = self.getFileName(data_label)
             if not os.path.isfile(filename):
                 return True
-            modification_time = os.path.getmtime(filename)
+            # Datasets that were not modified upstream are not saved again so
+            # use when they were last checked if it is known
+            modification_time = validators.get(data_label, {}).get('checked', os.path.getmtime(filename))
             mod_time = datetime.datetime.fromtimestamp(modification_time)
             current_time = datetime.datetime.now()
 
@@ -132,11 +916,60 @@ class CovidManager:
 
         return False
 
-    def loadFullDataset(self):
-        full_dataset_dict = {'confirmed' : pd.read_csv(self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME),
-                             'deaths' : pd.read_csv(self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME)}
+    def isFullCsvPending(self):
+        """
+        Returns True if the full datasets were updated by ingestFullDataset
+        but the .csv files have not been written yet.
+        """
+        return self.loadValidators().get(CovidManager.FULL_CSV_PENDING, False)
+
+    def setFullCsvPending(self, pending):
+        validators = self.loadValidators()
+        if not validators.get(CovidManager.FULL_CSV_PENDING, False) == pending:
+            validators[CovidManager.FULL_CSV_PENDING] = pending
+            self.saveValidators(validators)
+
+    def getChangeReport(self):
+        """
+        Returns the changes made to the full datasets by the last refresh,
+        'mode' is 'delta' or 'rebuild' and 'confirmed' and 'deaths' are
+        DatasetDelta of the added dates, revised cells and new locations
+        (None if there was no previous full dataset).
+        """
+        return self.change_report
+
+    def getFullFileName(self, full_label):
+        return self.dataset_folder + {'confirmed' : CovidManager.CONFIRMED_FULL_FILENAME,
+                                      'deaths'    : CovidManager.DEATHS_FULL_FILENAME}[full_label]
+
+    def loadFullDataset(self, full_labels=('confirmed', 'deaths'), date_columns=None, filters=None):
+        """
+        Loads the full datasets named in full_labels ('confirmed' and/or
+        'deaths'), raises an IOError if they can not be loaded.
+
+        date_columns and filters are passed to readDataset to only load some
+        of the dates and rows.
+        """
+        if self.isFullCsvPending():
+            # The .csv files are out of date so only the cache can be used
+            for full_label in full_labels:
+                filename = self.getFullFileName(full_label)
+                if self.dataset_cache is None or not self.dataset_cache.isFresh(filename):
+                    raise IOError("The full datasets were updated but {} has not been exported".format(filename))
+        full_dataset_dict = {full_label : self.readDataset(self.getFullFileName(full_label), date_columns, filters) for full_label in full_labels}
         return full_dataset_dict
 
+    def getFullDates(self):
+        """
+        Returns the date columns of the full confirmed dataset without loading
+        it, raises an IOError if it can not be read.
+        """
+        filename = self.getFullFileName('confirmed')
+        if self.isFullCsvPending() and (self.dataset_cache is None or not self.dataset_cache.isFresh(filename)):
+            raise IOError("The full datasets were updated but {} has not been exported".format(filename))
+        return [column for column in self.getDatasetColumns(filename) if is_date_column(column)]
+
+    @traced('CovidManager.constructFullDataset')
     def constructFullDataset(self, downloaded_df_dict):
         try:
             df_urls = pd.read_csv(self.dataset_urls, header=None, names=self.COLUMN_NAMES)
@@ -162,11 +995,190 @@ class CovidManager:
         full_dataset_dict['confirmed'] = pd.concat([full_dataset_dict['confirmed'], downloaded_df_dict['covid_us_confirmed']], ignore_index=True, join="inner")
         full_dataset_dict['deaths'] = pd.concat([full_dataset_dict['deaths'], downloaded_df_dict['covid_us_deaths']], ignore_index=True, join="inner")
 
-        full_dataset_dict['confirmed'].to_csv(self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME, index=False, header=True)
-        full_dataset_dict['deaths'].to_csv(self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME, index=False, header=True)
+        # The cache is saved now so the next delta refresh does not have to
+        # parse the .csv files again
+        for filename, df in [(self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME, full_dataset_dict['confirmed']),
+                             (self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME, full_dataset_dict['deaths'])]:
+            df.to_csv(filename, index=False, header=True)
+            if not self.dataset_cache is None:
+                self.dataset_cache.save(filename, df)
+        self.setFullCsvPending(False)
 
         return full_dataset_dict
 
+    def applyFullDatasetDelta(self, old_full_df, global_df, us_df, copy=True):
+        """
+        Returns the full dataset constructFullDataset would build from
+        global_df and us_df by only adding the new date columns to old_full_df
+        and replacing the columns with revised values. Returns None if the
+        locations or the other columns changed, then the full dataset needs to
+        be rebuilt.
+
+        parameters:
+            copy: if False old_full_df is updated in place instead of being
+                  copied, so the cost depends on the size of the change
+                  rather than the whole dataset. old_full_df is only changed
+                  if the delta can be applied.
+
+        returns:
+            The full dataset and a DatasetDelta of the changes, or None.
+        """
+        global_df = global_df.loc[global_df['Country/Region'] != 'US']
+        # Columns are joined the same way as the inner join in constructFullDataset
+        full_columns = [column for column in ['County'] + global_df.columns.tolist() if column in us_df.columns]
+        old_columns = old_full_df.columns.tolist()
+        if not full_columns[:len(old_columns)] == old_columns:
+            return None
+        new_dates = full_columns[len(old_columns):]
+        if not all(is_date_column(column) for column in new_dates):
+            return None
+
+        def location_keys(df):
+            return [df[column].fillna('').astype(str).to_numpy() if column in df.columns else np.full(df.shape[0], '', dtype=object)
+                    for column in CovidManager.FULL_KEY_COLUMNS]
+        old_keys = location_keys(old_full_df)
+        for key_column, old_key, global_key, us_key in zip(CovidManager.FULL_KEY_COLUMNS, old_keys, location_keys(global_df), location_keys(us_df)):
+            if not len(old_key) == len(global_key) + len(us_key) or not np.array_equal(old_key, np.concatenate([global_key, us_key])):
+                return None
+
+        # The columns with different values and their new values
+        replaced = {}
+        other_columns = [column for column in old_columns if not column in CovidManager.FULL_KEY_COLUMNS and not is_date_column(column)]
+        for column in other_columns:
+            values = np.concatenate([global_df[column].to_numpy(), us_df[column].to_numpy()])
+            old_values = old_full_df[column].to_numpy()
+            if not values.dtype == old_values.dtype or not ((old_values == values) | (pd.isnull(old_values) & pd.isnull(values))).all():
+                replaced[column] = values
+
+        old_dates = [column for column in old_columns if is_date_column(column)]
+        if len(old_dates) > 0:
+            old_values = old_full_df[old_dates].to_numpy()
+            values = np.concatenate([global_df[old_dates].to_numpy(), us_df[old_dates].to_numpy()])
+            if not values.dtype == old_values.dtype:
+                return None
+            revised = ~((old_values == values) | (pd.isnull(old_values) & pd.isnull(values))).all(axis=0)
+            for column_index in np.flatnonzero(revised).tolist():
+                replaced[old_dates[column_index]] = values[:, column_index]
+
+        # Only the changed columns are compared for the delta
+        key_columns = [column for column in CovidManager.FULL_KEY_COLUMNS if column in old_columns]
+        old_changed_df = old_full_df[key_columns + list(replaced)].copy()
+
+        new_full_df = old_full_df.copy() if copy else old_full_df
+        for column, values in replaced.items():
+            new_full_df[column] = values
+        if len(new_dates) > 0:
+            values = np.concatenate([global_df[new_dates].to_numpy(), us_df[new_dates].to_numpy()])
+            new_full_df = pd.concat([new_full_df, pd.DataFrame(values, columns=new_dates, index=new_full_df.index)], axis=1, copy=False)
+
+        delta = compute_dataset_delta(old_changed_df, new_full_df[key_columns + list(replaced) + new_dates], CovidManager.FULL_KEY_COLUMNS)
+        return new_full_df, delta
+
+    @traced('CovidManager.ingestFullDataset')
+    def ingestFullDataset(self, datasets):
+        """
+        Updates the full datasets with the dates added and the values revised
+        in the global and US datasets, falling back to constructFullDataset if
+        locations were added or removed. The binary cache is updated in place
+        with only the changes and the .csv files are written later by
+        exportFullDataset.
+
+        parameters:
+            datasets: the downloaded datasets keyed by data_label.
+
+        returns:
+            The full datasets.
+        """
+        try:
+            old_full = self.loadFullDataset()
+        except:
+            old_full = None
+
+        new_full = None
+        deltas = {}
+        if not old_full is None:
+            new_full = {}
+            for full_label, (global_label, us_label) in CovidManager.FULL_DATASETS.items():
+                # The old datasets were only loaded for this so they are updated in place
+                applied = self.applyFullDatasetDelta(old_full[full_label], datasets[global_label], datasets[us_label], copy=False)
+                if applied is None:
+                    new_full = None
+                    break
+                new_full[full_label], deltas[full_label] = applied
+
+        if new_full is None:
+            self.change_report = {'mode' : 'rebuild'}
+            if len(deltas) > 0:
+                # Some of the old datasets were already updated
+                old_full = self.loadFullDataset()
+            new_full = self.constructFullDataset(datasets)
+            if not old_full is None:
+                deltas = {full_label : compute_dataset_delta(old_full[full_label], new_full[full_label], CovidManager.FULL_KEY_COLUMNS)
+                          for full_label in CovidManager.FULL_DATASETS}
+        else:
+            self.change_report = {'mode' : 'delta'}
+
+        for full_label in CovidManager.FULL_DATASETS:
+            delta = deltas.get(full_label, None)
+            self.change_report[full_label] = delta
+            if self.verbose and not delta is None:
+                print("{} ({}): {}".format(full_label, self.change_report['mode'], delta.summary()))
+
+        if self.change_report['mode'] == 'rebuild':
+            return new_full
+
+        full_filenames = {'confirmed' : self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME,
+                          'deaths'    : self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME}
+        if self.dataset_cache is None:
+            for full_label, filename in full_filenames.items():
+                new_full[full_label].to_csv(filename, index=False, header=True)
+            return new_full
+
+        for full_label, filename in full_filenames.items():
+            delta = self.change_report[full_label]
+            if delta.isEmpty():
+                continue
+            only_dates = all(is_date_column(column) for column in delta.revised_cells['Column'].unique().tolist())
+            if not only_dates or not self.dataset_cache.updateDates(filename, new_full[full_label], delta.getRevisedDates()):
+                self.dataset_cache.save(filename, new_full[full_label])
+            self.setFullCsvPending(True)
+        return new_full
+
+    @traced('CovidManager.exportFullDataset')
+    def exportFullDataset(self, full_dataset_dict=None):
+        """
+        Writes the full datasets to their .csv files if they were only updated
+        in the binary cache by ingestFullDataset.
+
+        parameters:
+            full_dataset_dict: the full datasets if they are already loaded,
+                               otherwise they are loaded from the cache.
+        """
+        if not self.isFullCsvPending():
+            return
+        if full_dataset_dict is None:
+            full_dataset_dict = self.loadFullDataset()
+        for filename, df in [(self.dataset_folder + CovidManager.CONFIRMED_FULL_FILENAME, full_dataset_dict['confirmed']),
+                             (self.dataset_folder + CovidManager.DEATHS_FULL_FILENAME, full_dataset_dict['deaths'])]:
+            df.to_csv(filename, index=False, header=True)
+            # The cache already has these contents, only the file it matches changed
+            if not self.dataset_cache is None and not self.dataset_cache.updateSource(filename):
+                self.dataset_cache.save(filename, df)
+        self.setFullCsvPending(False)
+
+    def refreshDatasets(self):
+        """
+        Downloads the datasets, and writes the full .csv files if they were
+        only updated in the binary cache and export_full_csv is True.
+        """
+        datasets = self.downloadDataset()
+        if self.export_full_csv and self.isFullCsvPending():
+            try:
+                self.exportFullDataset(datasets.get('full', None))
+            except IOError:
+                print("Error occurred trying to write the full datasets to {}".format(self.dataset_folder))
+        return datasets
+
     def loadLatestBackup(self):
         print("Unable to download datasets from online. Loading backup datasets instead!")
         if not os.path.exists(self.backup):
@@ -216,11 +1228,21 @@ class CovidManager:
         return True
 
 
+    def isUpToDate(self):
+        """
+        Returns True if getDatasets would load the datasets from disk instead
+        of downloading them, so they can be loaded one at a time.
+        """
+        if self.update:
+            return not self.needsUpdating()
+        return self.datasetsExist()
+
+    @traced('CovidManager.getDatasets')
     def getDatasets(self):
         if self.update:
             if self.needsUpdating():
                 try:
-                    return self.downloadDataset()
+                    return self.refreshDatasets()
                 except:
                     return self.loadLatestBackup()
             else:
@@ -230,7 +1252,7 @@ class CovidManager:
                 return self.loadDatasets()
             else:
                 try:
-                    return self.downloadDataset()
+                    return self.refreshDatasets()
                 except:
                     return self.loadLatestBackup()
 
@@ -246,6 +1268,14 @@ class AirportToLocation:
         self.iso_df = pd.read_csv(iso_location_dataset)
 
     def generateNewAirportToLocationDataset(self):
+        with span('AirportToLocation.generateNewAirportToLocationDataset') as stage:
+            airport_df = self._generateNewAirportToLocationDataset()
+            if not airport_df is None:
+                stage.count('bytes_read', os.path.getsize(self.airport_dataset_fn))
+                stage.count('rows', airport_df.shape[0])
+        return airport_df
+
+    def _generateNewAirportToLocationDataset(self):
         EARTH_RADIUS = 6371 # km
 
         def haversine_formula(lat0, long0, lat1, long1):
@@ -269,15 +1299,29 @@ class AirportToLocation:
                    closest["Province/State"] = np.nan
             return closest
 
-
-        airport_dataset = {
-            'codeIataAirport' : [],
-            'County'          : [],
-            'Province/State'  : [],
-            'Country/Region'  : [],
-            'LatAirport'      : [],
-            'LongAirport'     : [],
-        }
+        def closest_locations(airport_lats, airport_longs, location_lats, location_longs, chunk_size=1024):
+            """
+            Returns the index of the closest location to each airport. Ties
+            are broken the same way as sorting the distances with
+            DataFrame.sort_values and locations with a NaN distance are
+            only picked if every distance is NaN.
+            """
+            closest = np.zeros(len(airport_lats), dtype=int)
+            for start in range(0, len(airport_lats), chunk_size):
+                end = start + chunk_size
+                distances = haversine_formula(airport_lats[start:end, np.newaxis], airport_longs[start:end, np.newaxis],
+                                              location_lats[np.newaxis, :], location_longs[np.newaxis, :])
+                for offset, airport_distances in enumerate(distances):
+                    not_nan = np.flatnonzero(~np.isnan(airport_distances))
+                    if len(not_nan) == 0:
+                        continue
+                    valid_distances = airport_distances[not_nan]
+                    min_distance = valid_distances.min()
+                    if np.count_nonzero(valid_distances == min_distance) == 1:
+                        closest[start + offset] = not_nan[np.argmin(valid_distances)]
+                    else:
+                        closest[start + offset] = not_nan[np.argsort(valid_distances, kind='quicksort')[0]]
+            return closest
 
         try:
             with open(self.airport_dataset_fn, 'r') as json_file:
@@ -286,33 +1330,74 @@ class AirportToLocation:
             print("Error occurred trying to load the Airport Dataset at {}".format(self.airport_dataset_fn))
             return None
 
-        for airport_json in airport_data:
-            # Get the country name from the the iso code table
-            country_or_state_df = self.iso_df.loc[self.iso_df['iso2'] == airport_json['codeIso2Country']]
-            if country_or_state_df.empty:
-                del country_or_state_df
+        # Each country has a unique iso2 code, the first row of the table is used.
+        # Covid datset lumps some countries inside of another one. So need to sort by state/province as well.
+        iso_to_location = {}
+        for iso2, country_name, state_name in zip(self.iso_df['iso2'].to_list(),
+                                                  self.iso_df['Country/Region'].to_list(),
+                                                  self.iso_df['Province/State'].to_list()):
+            iso_to_location.setdefault(iso2, (country_name, state_name))
+
+        country_rows = {}
+        for row, country_name in enumerate(self.covid_df['Country/Region'].to_list()):
+            country_rows.setdefault(country_name, []).append(row)
+        state_rows = {}
+        for row, state_name in enumerate(self.covid_df['Province/State'].to_list()):
+            state_rows.setdefault(state_name, []).append(row)
+
+        # Group the airports by the rows of the covid dataset they can be
+        # mapped to so the distances can be calculated in bulk
+        airport_groups = {}
+        for airport_index, airport_json in enumerate(airport_data):
+            location = iso_to_location.get(airport_json['codeIso2Country'], None)
+            if location is None:
                 continue
+            country_name, state_name = location
 
-            # Each country has a unique iso2 code.
-            # Covid datset lumps some countries inside of another one. So need to sort by state/province as well.
-            country_name, state_name = country_or_state_df['Country/Region'].to_list()[0], country_or_state_df['Province/State'].to_list()[0]
-
-
-            possible_locations_df = self.covid_df.loc[self.covid_df['Country/Region'] == country_name]
-
+            candidates = ('country', country_name)
             # If the country has multiple provinces and state_name isn't NaN then it is one of the weird edge cases.
-            if possible_locations_df.shape[0] > 1 and type(state_name) == str:
-                del possible_locations_df
-                possible_locations_df = self.covid_df.loc[self.covid_df['Province/State'] == state_name]
+            if len(country_rows.get(country_name, [])) > 1 and type(state_name) == str:
+                candidates = ('state', state_name)
+            airport_groups.setdefault(candidates, []).append(airport_index)
+
+        lats = self.covid_df['Lat'].to_numpy(dtype=float)
+        longs = self.covid_df['Long'].to_numpy(dtype=float)
+        closest_rows = {}
+        for (candidate_type, candidate_name), airport_indexes in airport_groups.items():
+            if candidate_type == 'country':
+                rows = np.array(country_rows.get(candidate_name, []), dtype=int)
+            else:
+                rows = np.array(state_rows.get(candidate_name, []), dtype=int)
+            if len(rows) == 0:
+                continue
 
-            distances_arr = haversine_formula(airport_json['latitudeAirport'], airport_json['longitudeAirport'], possible_locations_df['Lat'].to_numpy(), possible_locations_df['Long'].to_numpy())
-            possible_locations_df['distance'] = distances_arr
+            airport_lats = np.array([airport_data[ii]['latitudeAirport'] for ii in airport_indexes], dtype=float)
+            airport_longs = np.array([airport_data[ii]['longitudeAirport'] for ii in airport_indexes], dtype=float)
+            closest = closest_locations(airport_lats, airport_longs, lats[rows], longs[rows])
+            for airport_index, closest_index in zip(airport_indexes, closest.tolist()):
+                closest_rows[airport_index] = rows[closest_index]
 
-            try:
-                closest = possible_locations_df.sort_values('distance').iloc[0]
-            except:
+        airport_dataset = {
+            'codeIataAirport' : [],
+            'County'          : [],
+            'Province/State'  : [],
+            'Country/Region'  : [],
+            'LatAirport'      : [],
+            'LongAirport'     : [],
+        }
+
+        counties = self.covid_df['County'].to_list()
+        states = self.covid_df['Province/State'].to_list()
+        countries = self.covid_df['Country/Region'].to_list()
+        for airport_index, airport_json in enumerate(airport_data):
+            if not airport_index in closest_rows:
                 continue
-            closest = edge_cases(closest)
+            row = closest_rows[airport_index]
+            closest = edge_cases({
+                'County'         : counties[row],
+                'Province/State' : states[row],
+                'Country/Region' : countries[row]
+            })
 
             airport_dataset['codeIataAirport'].append(airport_json['codeIataAirport'])
             airport_dataset['County'].append(closest['County'])
@@ -321,10 +1406,6 @@ class AirportToLocation:
             airport_dataset['LatAirport'].append(airport_json['latitudeAirport'])
             airport_dataset['LongAirport'].append(airport_json['longitudeAirport'])
 
-            del closest
-            del possible_locations_df
-            del country_or_state_df
-
         airport_df = pd.DataFrame(airport_dataset, columns=['codeIataAirport', 'County', 'Province/State', 'Country/Region', 'LatAirport', 'LongAirport'])
 
         try:
@@ -333,6 +1414,7 @@ class AirportToLocation:
             print("Error occurred trying to save Airport to Location Dataset to {}".format(self.airport_loc_fn))
         return airport_df
 
+    @traced('AirportToLocation.getDataset')
     def getDataset(self):
         if os.path.isfile(self.airport_loc_fn):
             return pd.read_csv(self.airport_loc_fn)
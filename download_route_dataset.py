@@ -1,5 +1,7 @@
-import requests, json, threading, queue, argparse, sys, random
+import asyncio, json, argparse, sys, random, os, shutil
+import aiohttp
 import pandas as pd
+from instrumentation import span, count
 
 # SECURITY RISK IF WE PUBLICALLY POST REPO!
 # NEED TO CLEAR GITHUB COMMITS TOO SINCE IT WILL BE SAVED THERE AS WELL
@@ -7,27 +9,33 @@ API_KEY = "NOT_AN_ACTUAL_API_KEY!"
 AIRPORT_DATASET = "dataset/airport_to_location.csv"
 ROUTES_DATASET = "dataset/airport_routes.csv"
 API_CALL = "http://aviation-edge.com/v2/public/routes?key={api_key}&departureIata={depart_codeIata}&limit=30000"
-NUM_OF_THREADS = 8
+MAX_CONCURRENT_REQUESTS = 8
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0 # seconds, doubled after each retry
+REQUEST_TIMEOUT = 120 # seconds
 NO_API_CALLS = False
 
 # Used instead of requesting from API to see code functions normally if NO_API_CALLS == True
 TEST_JSON = [{'arrivalIata': 'AAA'}]
 TEST_RESET_CONN = 0.001
 DEBUG_PRINT = False
-
-airport_route_dict = {
-    'DepartcodeIataAirport' : [],
-    'DepartCounty'          : [],
-    'DepartProvince/State'  : [],
-    'DepartCountry/Region'  : [],
-    'ArrivalcodeIataAirport': [],
-    'ArrivalCounty'         : [],
-    'ArrivalProvince/State' : [],
-    'ArrivalCountry/Region' : [],
-}
-
-depart_call_q = queue.Queue()
-push_to_dict_q = queue.Queue()
+CHUNK_SIZE = 20000 # routes written to each part file
+
+ROUTE_COLUMNS = ['DepartcodeIataAirport',
+                 'DepartCounty',
+                 'DepartProvince/State',
+                 'DepartCountry/Region',
+                 'ArrivalcodeIataAirport',
+                 'ArrivalCounty',
+                 'ArrivalProvince/State',
+                 'ArrivalCountry/Region']
+
+class RetryableError(Exception):
+    """
+    Raised when an API call failed in a way that is worth trying again, such
+    as a reset connection, a timeout or the server being overloaded.
+    """
+    pass
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Downloads the routes between locations from https://aviation-edge.com/")
@@ -49,8 +57,23 @@ def parse_args():
                         default="http://aviation-edge.com/v2/public/routes?key={api_key}&departureIata={depart_codeIata}&limit=30000")
     parser.add_argument("-t", "--thread_num",
                         type=int,
-                        help="the number of threads to run (avoid making this too large and DOS the server)",
+                        help="the maximum number of API requests running at once (avoid making this too large and DOS the server)",
                         default=8)
+    parser.add_argument("--retries",
+                        type=int,
+                        help="the number of times a failed API request is retried before giving up on the airport",
+                        default=5)
+    parser.add_argument("--retry_backoff",
+                        type=float,
+                        help="seconds to wait before the first retry, doubled after every retry",
+                        default=1.0)
+    parser.add_argument("-s", "--chunk_size",
+                        type=int,
+                        help="the number of routes buffered in memory before they are written to disk",
+                        default=20000)
+    parser.add_argument("-u", "--update_routes",
+                        action="store_true",
+                        help="only download the routes of airports that have been added to the airport dataset since the route dataset was built")
     parser.add_argument("-n", "--no_api_calls",
                         type=bool,
                         help="tests the program and does not make any API requests, only prints what the API call would be",
@@ -61,16 +84,59 @@ def parse_args():
 
     return parser.parse_args()
 
-def get_info_from_iata(iata_code, airport_df):
+def build_iata_lookup(airport_df):
+    """
+    Maps each Iata code in airport_df to the (County, Province/State,
+    Country/Region) of the first airport with that code.
+    """
+    iata_lookup = {}
+    for iata_code, county, state, country in zip(airport_df['codeIataAirport'].to_list(),
+                                                 airport_df['County'].to_list(),
+                                                 airport_df['Province/State'].to_list(),
+                                                 airport_df['Country/Region'].to_list()):
+        iata_lookup.setdefault(iata_code, (county, state, country))
+    return iata_lookup
+
+def get_info_from_iata(iata_code, iata_lookup):
+    return iata_lookup.get(iata_code, (None, None, None))
+
+def get_departures(airport_df):
+    """
+    Returns a list of (Iata code, County, Province/State, Country/Region) for
+    every airport in airport_df.
+    """
+    return list(zip(airport_df['codeIataAirport'].to_list(),
+                    airport_df['County'].to_list(),
+                    airport_df['Province/State'].to_list(),
+                    airport_df['Country/Region'].to_list()))
+
+def routes_to_rows(departure, routes, iata_lookup):
     """
-    NOTE: Not Thread Safe! Only call for the thread that puts data into dictionary
+    Converts the routes returned by the API for a departure airport into rows
+    of the routes dataset. Arrivals without a known location are ignored.
     """
-    airport = airport_df.loc[airport_df['codeIataAirport'] == iata_code]
-    for _index, row in airport.iterrows():
-        return row['County'], row['Province/State'], row['Country/Region']
-    return None, None, None
+    depart_iata_airport, depart_county, depart_state, depart_country = departure
+    rows = []
+    for route in routes:
+        arrival_iata_airport = route['arrivalIata']
+
+        arrival_county, arrival_state, arrival_country = get_info_from_iata(arrival_iata_airport, iata_lookup)
+        # If we do not have a record of that iata code ignore it
+        if arrival_state == None and arrival_country == None: continue
 
-def call_api(iata_airport):
+        rows.append((depart_iata_airport, depart_county, depart_state, depart_country,
+                     arrival_iata_airport, arrival_county, arrival_state, arrival_country))
+    return rows
+
+async def call_api(session, iata_airport):
+    """
+    Requests the routes departing iata_airport.
+
+    returns:
+        The list of routes, which is empty if the API returned an error
+        message (no routes for that airport). Raises RetryableError if the
+        request should be tried again.
+    """
     current_api_call = API_CALL.format(api_key = API_KEY, depart_codeIata=iata_airport)
     if DEBUG_PRINT:
         print(iata_airport)
@@ -78,118 +144,294 @@ def call_api(iata_airport):
     if NO_API_CALLS:
         if random.random() < TEST_RESET_CONN:
             print("Test reset has been triggered for {}".format(iata_airport))
-            return "reset"
+            raise RetryableError("Test reset for Iata Code {}".format(iata_airport))
         return TEST_JSON
 
+    count('route_requests')
     try:
-        response = requests.get(url=current_api_call)
-    except:
-        print("Error connecting to server for Iata Code {}".format(iata_airport))
-        return "reset"
-    json_data = response.json()
-    print(json_data)
+        async with session.get(current_api_call) as response:
+            if response.status == 429 or response.status >= 500:
+                raise RetryableError("Server responded with {} for Iata Code {}".format(response.status, iata_airport))
+            body = await response.read()
+            count('bytes_downloaded', len(body))
+            json_data = json.loads(body)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        raise RetryableError("Error connecting to server for Iata Code {}".format(iata_airport))
+    except ValueError:
+        raise RetryableError("Invalid JSON returned for Iata Code {}".format(iata_airport))
+
+    if DEBUG_PRINT:
+        print(json_data)
+    # Errors are returned as a dictionary
     if type(json_data) == type({}):
-        return None
+        return []
     return json_data
 
-def worker_api_call():
-    while True:
-        depart_iata_airport, depart_county, depart_state, depart_country = depart_call_q.get()
-        if depart_iata_airport == None: break
-
-        routes = call_api(depart_iata_airport)
-
-        # If the connection is reset then put it back onto the queue
-        if routes == "reset":
-            depart_call_q.put((depart_iata_airport, depart_county, depart_state, depart_country))
-            depart_call_q.task_done()
-            continue
-        # Error handling json errors
-        if routes == None:
-            depart_call_q.task_done()
-            continue
-
-        push_to_dict_q.put((depart_iata_airport, depart_county, depart_state, depart_country, routes))
-
-        depart_call_q.task_done()
-
-def worker_process():
-    while True:
-        depart_iata_airport, depart_county, depart_state, depart_country, routes = push_to_dict_q.get()
-        if depart_country == None: break
-
-        for route in routes:
-            arrival_iata_airport = route['arrivalIata']
-
-            arrival_county, arrival_state, arrival_country = get_info_from_iata(arrival_iata_airport, AIRPORT_DF)
-            # If we do not have a record of that iata code ignore it
-            if arrival_state == None and arrival_country == None: continue
-
-            airport_route_dict['DepartcodeIataAirport'].append(depart_iata_airport)
-            airport_route_dict['DepartCounty'].append(depart_county)
-            airport_route_dict['DepartProvince/State'].append(depart_state)
-            airport_route_dict['DepartCountry/Region'].append(depart_country)
-            airport_route_dict['ArrivalcodeIataAirport'].append(arrival_iata_airport)
-            airport_route_dict['ArrivalCounty'].append(arrival_county)
-            airport_route_dict['ArrivalProvince/State'].append(arrival_state)
-            airport_route_dict['ArrivalCountry/Region'].append(arrival_country)
-
-        push_to_dict_q.task_done()
-
-def main():
-    if NUM_OF_THREADS < 2:
-        print("{} is not enough threads to download the dataset".format(NUM_OF_THREADS))
-        return
-    threads = []
-    print("Using the Aviation Edge API to create dataset for airplane routes!")
+async def call_api_with_retries(session, semaphore, iata_airport, max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF):
+    """
+    Calls the API for iata_airport, retrying with exponential backoff (and a
+    bit of jitter) if the request fails. The semaphore is not held while
+    waiting to retry.
 
-    for t_num in range(NUM_OF_THREADS - 1):
-        thread = threading.Thread(target=worker_api_call, daemon=True)
-        thread.start()
-        threads.append(thread)
+    returns:
+        The list of routes or None if every retry failed.
+    """
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            try:
+                return await call_api(session, iata_airport)
+            except RetryableError as error:
+                last_error = error
+        if attempt < max_retries:
+            count('route_retries')
+            await asyncio.sleep(retry_backoff * (2 ** attempt) * (1 + random.random()))
+
+    print("{}, giving up after {} retries".format(last_error, max_retries))
+    return None
+
+async def download_routes(departures, iata_lookup, max_concurrent=MAX_CONCURRENT_REQUESTS, max_retries=MAX_RETRIES,
+                          retry_backoff=RETRY_BACKOFF, on_complete=None):
+    """
+    Downloads the routes departing every airport using a single pooled HTTP
+    session with at most max_concurrent requests running at once.
 
-    processing_thread = threading.Thread(target=worker_process, daemon=True)
-    processing_thread.start()
+    parameters:
+        departures:     list of (Iata code, County, Province/State,
+                        Country/Region) from get_departures.
 
-    for _index, row in AIRPORT_DF.iterrows():
-        depart_iata_airport = row['codeIataAirport']
-        depart_county = row['County']
-        depart_state = row['Province/State']
-        depart_country = row['Country/Region']
+        iata_lookup:    dictionary from build_iata_lookup used to find the
+                        location of the arrival airports.
 
-        depart_call_q.put((depart_iata_airport, depart_county, depart_state, depart_country))
+        max_concurrent: the maximum number of API requests running at once.
 
-    print("Completing all of the API calls...")
+        max_retries:    the number of times a failed request is retried.
+
+        retry_backoff:  seconds to wait before the first retry.
 
-    depart_call_q.join()
+        on_complete:    if not None, called as on_complete(departure, rows)
+                        once the routes of a departure airport are
+                        downloaded. rows is None if the download failed.
 
-    for thread in threads:
-        depart_call_q.put((None, None, None, None))
+    returns:
+        The rows of the routes dataset in the same order as departures. If
+        on_complete is given the rows are only passed to on_complete so they
+        do not need to be kept in memory and an empty list is returned.
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+    connector = aiohttp.TCPConnector(limit=max_concurrent)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def download_departure(departure):
+            routes = await call_api_with_retries(session, semaphore, departure[0], max_retries, retry_backoff)
+            rows = None if routes is None else routes_to_rows(departure, routes, iata_lookup)
+            if not on_complete is None:
+                on_complete(departure, rows)
+                return None
+            return rows
+
+        departure_rows = await asyncio.gather(*[download_departure(departure) for departure in departures])
+
+    return [row for rows in departure_rows if not rows is None for row in rows]
+
+class RouteDatasetBuilder:
+    JOURNAL_FILENAME = "journal.txt"
+
+    def __init__(self, routes_dataset, chunk_size=CHUNK_SIZE):
+        """
+        Streams the downloaded routes to disk in part files so that an
+        interrupted download can be resumed and only chunk_size routes are
+        kept in memory.
+
+        The part files are kept in the folder <routes_dataset>.parts with an
+        append only journal. Each line of the journal is the Iata code of a
+        departure airport and the part file holding its routes. A line is
+        only written once its part file is on disk, so the airports in the
+        journal do not need to be downloaded again.
+
+        parameters:
+            routes_dataset: where the merged route dataset is saved.
+
+            chunk_size:     the number of routes buffered before they are
+                            written to a part file.
+        """
+        self.routes_dataset = routes_dataset
+        self.chunk_size = chunk_size
+        self.parts_folder = routes_dataset + ".parts"
+        self.journal_fn = os.path.join(self.parts_folder, RouteDatasetBuilder.JOURNAL_FILENAME)
+        self.completed = self._loadJournal()
+        self.buffer = []
+        self.buffered_airports = []
+        self.num_failed = 0
+        self.next_part = 1
+
+    def _loadJournal(self):
+        completed = {}
+        if not os.path.isfile(self.journal_fn):
+            return completed
+        with open(self.journal_fn, 'r') as fp:
+            for line in fp:
+                line = line.rstrip('\n')
+                if line.count('\t') == 1:
+                    iata_code, part_name = line.split('\t')
+                    completed[iata_code] = part_name
+        return completed
+
+    def getCompleted(self):
+        """
+        Returns the set of Iata codes already downloaded.
+        """
+        return set(self.completed)
+
+    def addRoutes(self, departure, rows):
+        """
+        Callback for download_routes, buffers the routes of a departure airport
+        and writes them to a part file once the buffer is full.
+        """
+        if rows is None:
+            self.num_failed += 1
+            return
+        self.buffer.extend(rows)
+        self.buffered_airports.append(str(departure[0]))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered routes to a new part file and then records their
+        departure airports in the journal.
+        """
+        if len(self.buffered_airports) == 0:
+            return
+        if not os.path.exists(self.parts_folder):
+            os.makedirs(self.parts_folder)
+
+        # Part files from a crash before the journal was written are not reused
+        while os.path.exists(os.path.join(self.parts_folder, "part_{:05d}.csv".format(self.next_part))):
+            self.next_part += 1
+        part_name = "part_{:05d}.csv".format(self.next_part)
+        part_fn = os.path.join(self.parts_folder, part_name)
+        count('route_rows', len(self.buffer))
+        pd.DataFrame(self.buffer, columns=ROUTE_COLUMNS).to_csv(part_fn, index=False, header=True)
+
+        with open(self.journal_fn, 'a') as fp:
+            for iata_code in self.buffered_airports:
+                fp.write('{}\t{}\n'.format(iata_code, part_name))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        for iata_code in self.buffered_airports:
+            self.completed[iata_code] = part_name
+        self.buffer = []
+        self.buffered_airports = []
+
+    def merge(self, update=False):
+        """
+        Merges the part files into the routes dataset and removes them.
+
+        Only the routes of an airport from the part file recorded last in the
+        journal are used, so airports downloaded more than once (e.g. the
+        download was interrupted before the journal was written) are not
+        duplicated. If update is True the routes of the airports that were not
+        downloaded again are kept from the existing routes dataset.
+        """
+        self.flush()
+        read_kwargs = {'dtype' : str, 'keep_default_na' : False, 'na_filter' : False}
+        downloaded_airports = set(self.completed)
+        temp_fn = self.routes_dataset + ".tmp"
+
+        pd.DataFrame(columns=ROUTE_COLUMNS).to_csv(temp_fn, index=False, header=True)
+        if update and os.path.isfile(self.routes_dataset):
+            downloaded_airports |= get_downloaded_airports(self.routes_dataset)
+            for chunk in pd.read_csv(self.routes_dataset, chunksize=self.chunk_size, **read_kwargs):
+                chunk = chunk.loc[~chunk['DepartcodeIataAirport'].isin(list(self.completed))]
+                chunk[ROUTE_COLUMNS].to_csv(temp_fn, mode='a', index=False, header=False)
+
+        for part_name in sorted(set(self.completed.values())):
+            part_df = pd.read_csv(os.path.join(self.parts_folder, part_name), **read_kwargs)
+            part_iata = part_df['DepartcodeIataAirport'].to_list()
+            keep = [self.completed.get(iata_code, None) == part_name for iata_code in part_iata]
+            part_df.loc[keep, ROUTE_COLUMNS].to_csv(temp_fn, mode='a', index=False, header=False)
+
+        os.replace(temp_fn, self.routes_dataset)
+        with open(downloaded_airports_file(self.routes_dataset), 'w') as fp:
+            for iata_code in sorted(downloaded_airports):
+                fp.write('{}\n'.format(iata_code))
+
+        if os.path.exists(self.parts_folder):
+            shutil.rmtree(self.parts_folder)
+        self.completed = {}
+
+def downloaded_airports_file(routes_dataset):
+    return os.path.splitext(routes_dataset)[0] + "_airports.txt"
+
+def get_downloaded_airports(routes_dataset):
+    """
+    Returns the set of Iata codes of the airports whose routes are in
+    routes_dataset (including airports without any routes).
+    """
+    airports_fn = downloaded_airports_file(routes_dataset)
+    if os.path.isfile(airports_fn):
+        with open(airports_fn, 'r') as fp:
+            return set(line.rstrip('\n') for line in fp if len(line.strip()) > 0)
+    if os.path.isfile(routes_dataset):
+        # Older datasets do not have the airports file, airports without routes
+        # will be downloaded again.
+        depart_df = pd.read_csv(routes_dataset, usecols=['DepartcodeIataAirport'], dtype=str, keep_default_na=False)
+        return set(depart_df['DepartcodeIataAirport'].to_list())
+    return set()
+
+def update_routes_from_airportdf(airport_df, routes_dataset):
+    """
+    Returns the departures (see get_departures) of the airports in airport_df
+    that have been added since routes_dataset was built.
 
-    for thread in threads:
-        thread.join()
+    Routes from the airports already in routes_dataset to the new airports
+    were ignored when they were downloaded, but the routes departing the new
+    airports normally cover them in the other direction.
+    """
+    downloaded_airports = get_downloaded_airports(routes_dataset)
+    return [departure for departure in get_departures(airport_df) if not str(departure[0]) in downloaded_airports]
 
-    print("Completed making the API calls, just processing it to a dictionary")
+def main(update_routes=False):
+    if MAX_CONCURRENT_REQUESTS < 1:
+        print("{} is not enough concurrent requests to download the dataset".format(MAX_CONCURRENT_REQUESTS))
+        return
+    print("Using the Aviation Edge API to create dataset for airplane routes!")
 
-    push_to_dict_q.join()
+    iata_lookup = build_iata_lookup(AIRPORT_DF)
+    if update_routes and os.path.isfile(ROUTES_DATASET):
+        departures = update_routes_from_airportdf(AIRPORT_DF, ROUTES_DATASET)
+        print("Updating the routes of {} new airports".format(len(departures)))
+    else:
+        update_routes = False
+        departures = get_departures(AIRPORT_DF)
 
-    push_to_dict_q.put((None, None, None, None, None))
-    processing_thread.join()
-    print("Finished processing data, now saving to file.")
+    builder = RouteDatasetBuilder(ROUTES_DATASET, CHUNK_SIZE)
+    completed = builder.getCompleted()
+    if len(completed) > 0:
+        print("Resuming, {} airports have already been downloaded".format(len(completed)))
+        departures = [departure for departure in departures if not str(departure[0]) in completed]
 
-    route_df = pd.DataFrame(airport_route_dict, columns=['DepartcodeIataAirport',
-                                                         'DepartCounty',
-                                                         'DepartProvince/State',
-                                                         'DepartCountry/Region',
-                                                         'ArrivalcodeIataAirport',
-                                                         'ArrivalCounty',
-                                                         'ArrivalProvince/State',
-                                                         'ArrivalCountry/Region'])
+    print("Completing all of the API calls...")
+    with span('download_route_dataset.download_routes') as stage:
+        asyncio.run(download_routes(departures, iata_lookup, MAX_CONCURRENT_REQUESTS, MAX_RETRIES, RETRY_BACKOFF,
+                                    on_complete=builder.addRoutes))
+        builder.flush()
+        stage.count('departures', len(departures))
+        stage.count('failed_departures', builder.num_failed)
+
+    if builder.num_failed > 0:
+        print("Failed to download the routes of {} airports, run the script again to resume".format(builder.num_failed))
+        return
 
+    print("Finished downloading routes, now merging the routes into one file.")
     try:
-        route_df.to_csv(ROUTES_DATASET, index=False, header=True)
-    except:
+        with span('download_route_dataset.merge'):
+            builder.merge(update=update_routes)
+    except IOError:
         print("Error occurred trying to save Routes to Location Dataset to {}".format(ROUTES_DATASET))
+        return
 
     print("DONE! Dataset saved to {}".format(ROUTES_DATASET))
 
@@ -200,12 +442,12 @@ if __name__ == "__main__":
     AIRPORT_DATASET = args.airport_dataset
     ROUTES_DATASET = args.route_dataset
     API_CALL = args.api_call
-    NUM_OF_THREADS = args.thread_num
+    MAX_CONCURRENT_REQUESTS = args.thread_num
+    MAX_RETRIES = args.retries
+    RETRY_BACKOFF = args.retry_backoff
+    CHUNK_SIZE = args.chunk_size
     NO_API_CALLS = args.no_api_calls
     DEBUG_PRINT = args.debug
     AIRPORT_DF = pd.read_csv(AIRPORT_DATASET)
 
-    if args.update_routes:
-        update_routes_from_airportdf(AIRPORT_DF, ROUTES_DATASET)
-
-    main()
+    main(args.update_routes)
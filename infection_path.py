@@ -0,0 +1,444 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from border_closures import BorderClosureIndex
+from instrumentation import span
+from locations import get_location_names
+
+def get_dates(data_confirmed, bin_region_column):
+    if bin_region_column == 'county':
+        return data_confirmed.columns.tolist()[5:]
+    if bin_region_column == 'state':
+        return data_confirmed.columns.tolist()[4:]
+    if bin_region_column == 'country':
+        return data_confirmed.columns.tolist()[3:]
+
+class RouteAdjacency:
+
+    def __init__(self, routes, bin_region_column):
+        """
+        Sparse adjacency structure of the routes between locations so that
+        checking for a route between two locations does not need to scan the
+        whole routes dataframe.
+
+        Every location found in the routes is given an integer ID and the
+        neighbours of each location are stored as a set of IDs. Routes are
+        treated as undirected since a route in either direction links the
+        locations in the infection graph.
+
+        parameters:
+            routes:            The dataframe returned by
+                               CovidData.routesToWeightedEdges (it can be
+                               cleaned beforehand).
+
+            bin_region_column: Is either 'county', 'state' or 'country' and
+                               needs to match the one given to
+                               routesToWeightedEdges.
+        """
+        self.bin_region_column = bin_region_column
+        with span('RouteAdjacency', bin_region_column=bin_region_column) as stage:
+            depart_names = get_location_names(routes, bin_region_column, 'Depart')
+            arrival_names = get_location_names(routes, bin_region_column, 'Arrival')
+
+            codes, locations = pd.factorize(depart_names + arrival_names)
+            self.locations = list(locations)
+            self.location_ids = {name : loc_id for loc_id, name in enumerate(self.locations)}
+            self.neighbours = [set() for _ii in range(len(self.locations))]
+            self.routes_between = {}
+
+            num_of_routes = routes['NumberOfRoutes'].tolist()
+            depart_ids = codes[:len(depart_names)].tolist()
+            arrival_ids = codes[len(depart_names):].tolist()
+            for depart_id, arrival_id, routes_num in zip(depart_ids, arrival_ids, num_of_routes):
+                self.neighbours[depart_id].add(arrival_id)
+                self.neighbours[arrival_id].add(depart_id)
+                self.routes_between[(depart_id, arrival_id)] = routes_num
+            stage.count('rows', len(num_of_routes))
+
+    def __len__(self):
+        return len(self.locations)
+
+    def toArrays(self):
+        """
+        Returns the adjacency as arrays that can be saved with numpy: the
+        neighbours of location ii are indices[indptr[ii]:indptr[ii + 1]] and
+        route_pairs[jj] has route_counts[jj] routes.
+        """
+        indptr = np.zeros(len(self.neighbours) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(neighbours) for neighbours in self.neighbours])
+        indices = np.fromiter((neighbour for neighbours in self.neighbours for neighbour in neighbours),
+                              dtype=np.int64, count=indptr[-1])
+        route_pairs = np.array(list(self.routes_between.keys()), dtype=np.int64).reshape(-1, 2)
+        route_counts = np.array(list(self.routes_between.values()), dtype=np.int64)
+        return indptr, indices, route_pairs, route_counts
+
+    @classmethod
+    def fromArrays(cls, locations, indptr, indices, route_pairs, route_counts, bin_region_column):
+        """
+        Rebuilds a RouteAdjacency from the location names and the arrays
+        returned by toArrays (which can be memory-mapped).
+        """
+        adjacency = cls.__new__(cls)
+        adjacency.bin_region_column = bin_region_column
+        adjacency.locations = list(locations)
+        adjacency.location_ids = {name : loc_id for loc_id, name in enumerate(adjacency.locations)}
+        indices = np.asarray(indices).tolist()
+        indptr = np.asarray(indptr).tolist()
+        adjacency.neighbours = [set(indices[indptr[ii]:indptr[ii + 1]]) for ii in range(len(adjacency.locations))]
+        adjacency.routes_between = dict(zip(map(tuple, np.asarray(route_pairs).tolist()), np.asarray(route_counts).tolist()))
+        return adjacency
+
+    def getID(self, name_loc):
+        return self.location_ids.get(name_loc, -1)
+
+    def hasRoute(self, name_loc_0, name_loc_1):
+        """
+        Returns True if there is a route going either way between the two
+        locations.
+        """
+        loc_id_0 = self.getID(name_loc_0)
+        loc_id_1 = self.getID(name_loc_1)
+        if loc_id_0 == -1 or loc_id_1 == -1:
+            return False
+        return loc_id_1 in self.neighbours[loc_id_0]
+
+    def getNeighbours(self, name_loc):
+        """
+        Returns the names of the locations that have a route to or from
+        name_loc.
+        """
+        loc_id = self.getID(name_loc)
+        if loc_id == -1:
+            return []
+        return [self.locations[neighbour_id] for neighbour_id in self.neighbours[loc_id]]
+
+    def getNumberOfRoutes(self, name_loc_0, name_loc_1):
+        """
+        Returns the number of routes departing name_loc_0 and arriving at
+        name_loc_1 (0 if there are none).
+        """
+        return self.routes_between.get((self.getID(name_loc_0), self.getID(name_loc_1)), 0)
+
+    def getMatrix(self, weighted=False):
+        """
+        Returns the routes as a scipy.sparse csr_matrix where entry (ii, jj)
+        is 1 (or the number of routes if weighted) if there is a route
+        departing location ii and arriving at location jj.
+        """
+        route_pairs = np.array(list(self.routes_between.keys()), dtype=np.int64).reshape(-1, 2)
+        if weighted:
+            values = np.array(list(self.routes_between.values()), dtype=np.int64)
+        else:
+            values = np.ones(route_pairs.shape[0], dtype=np.int64)
+        return sparse.csr_matrix((values, (route_pairs[:, 0], route_pairs[:, 1])), shape=(len(self.locations), len(self.locations)))
+
+
+class InfectionPathEngine:
+
+    def __init__(self, data_confirmed, routes, bin_region_column, adjacency=None):
+        """
+        Computes the infection graphs from the confirmed cases and the routes
+        between locations. Produces exactly the same results as the
+        get_infection_path function from coronavirus_infection_path.ipynb
+        but only checks the real neighbours of newly infected locations.
+
+        parameters:
+            data_confirmed:    The (cleaned) confirmed cases dataframe from
+                               CovidData.getData.
+
+            routes:            The (cleaned) routes dataframe from
+                               CovidData.getData or routesToWeightedEdges.
+
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            adjacency:         A RouteAdjacency of the routes if one has already
+                               been built, otherwise it is built from routes.
+        """
+        self.bin_region_column = bin_region_column
+        self.dates = get_dates(data_confirmed, bin_region_column)
+        self.location_names = get_location_names(data_confirmed, bin_region_column)
+        self.lats = data_confirmed['Lat'].to_numpy()
+        self.longs = data_confirmed['Long'].to_numpy()
+        self.cases = data_confirmed[self.dates].to_numpy()
+        self.adjacency = RouteAdjacency(routes, bin_region_column) if adjacency is None else adjacency
+
+    @classmethod
+    def fromArrays(cls, dates, location_names, lats, longs, cases, adjacency, bin_region_column):
+        """
+        Creates the engine from arrays instead of dataframes, for example the
+        memory-mapped arrays shared by the processes of a parameter sweep.
+
+        parameters:
+            dates:          The list of dates, the columns of cases.
+
+            location_names: The location name of each row of cases.
+
+            lats, longs:    The coordinates of each row of cases.
+
+            cases:          The locations x dates array of confirmed cases.
+
+            adjacency:      The RouteAdjacency of the routes.
+        """
+        engine = cls.__new__(cls)
+        engine.bin_region_column = bin_region_column
+        engine.dates = list(dates)
+        engine.location_names = list(location_names)
+        engine.lats = lats
+        engine.longs = longs
+        engine.cases = cases
+        engine.adjacency = adjacency
+        return engine
+
+    def run(self, infect_thresh, border_closures=None, key_locations=None, snapshot_cache_size=8):
+        """
+        Computes the infection graph for every date.
+
+        parameters:
+            infect_thresh:       The number of confirmed cases for a location
+                                 to be considered as infected.
+
+            border_closures:     The border closures from
+                                 CovidData.loadBorderDataset or the compiled
+                                 BorderClosureIndex. If None then border
+                                 closures are ignored.
+
+            key_locations:       If not None then new locations can only be
+                                 infected by these locations.
+
+            snapshot_cache_size: The number of infection graphs and infected
+                                 parents snapshots kept in memory at once.
+
+        returns:
+            infect_graphs, location_pos, max_confirmed, infected_parents,
+            new_locs, new_edges in the same format as the notebook.
+            infect_graphs and infected_parents are snapshot stores that only
+            save the changes made on each date and rebuild the snapshot of a
+            date when it is looked up.
+        """
+        with span('InfectionPathEngine.run', bin_region_column=self.bin_region_column) as stage:
+            return self._run(infect_thresh, border_closures, key_locations, snapshot_cache_size, stage)
+
+    def _run(self, infect_thresh, border_closures, key_locations, snapshot_cache_size, stage):
+        # networkx is slow to import and only needed here, so CovidData can
+        # be imported without it
+        import networkx as nx
+        from snapshot_store import GraphSnapshotStore, ParentsSnapshotStore
+
+        bin_region_column = self.bin_region_column
+        if not border_closures is None:
+            assert bin_region_column == 'state' or bin_region_column == 'country', "Can only use border closures for state and country analysis"
+        if not key_locations is None:
+            assert bin_region_column == 'state' or bin_region_column == 'country', "Can only use key locations for state and country analysis"
+            if bin_region_column == 'country':
+                key_locations = [loc.split(':')[-1] for loc in key_locations]
+            key_locations = set(key_locations)
+
+        dates = self.dates
+        border_closure_index = None
+        if isinstance(border_closures, BorderClosureIndex):
+            border_closure_index = border_closures.forDates(dates)
+        elif not border_closures is None:
+            border_closure_index = BorderClosureIndex(border_closures, dates)
+
+        adjacency = self.adjacency
+        location_names = self.location_names
+
+        infect_graph = nx.Graph()
+        # Insertion rank of the nodes in infect_graph, used to visit the
+        # infected neighbours in the same order as iterating over the graph.
+        node_rank = {}
+        next_rank = 0
+
+        case_zero_index = np.argsort(self.cases[:, 0], kind='quicksort')[-1]
+        case_zero_name = location_names[case_zero_index]
+        infect_graph.add_node(case_zero_name)
+        node_rank[case_zero_name] = next_rank
+        next_rank += 1
+
+        location_pos = {case_zero_name : (self.lats[case_zero_index], self.longs[case_zero_index])}
+        infect_graphs = GraphSnapshotStore(cache_size=snapshot_cache_size)
+        max_confirmed = {}
+        infected_parents = ParentsSnapshotStore(cache_size=snapshot_cache_size)
+        new_locs = {dates[0] : [case_zero_name]}
+        new_edges = {}
+
+        lats = self.lats.tolist()
+        longs = self.longs.tolist()
+        # The number of routes looked at, counted for the instrumentation
+        route_checks = 0
+
+        for date_index, date in enumerate(dates):
+            if date_index == 0:
+                added_nodes = [(case_zero_name, {})]
+            else:
+                added_nodes = []
+                new_locs[date] = []
+            new_edges[date] = []
+            added_children = []
+
+            date_cases = self.cases[:, date_index]
+            sorted_rows = np.argsort(date_cases, kind='quicksort')
+            day_rows = sorted_rows[date_cases[sorted_rows] >= infect_thresh]
+            if len(day_rows) > 0:
+                max_confirmed[date] = date_cases[day_rows[-1]]
+            else:
+                max_confirmed[date] = date_cases[case_zero_index]
+
+            for row in day_rows.tolist():
+                node_loc = location_names[row]
+                if not node_loc in node_rank:
+                    coords = (lats[row], longs[row])
+                    infect_graph.add_node(node_loc, pos=coords)
+                    added_nodes.append((node_loc, {'pos' : coords}))
+                    node_rank[node_loc] = next_rank
+                    next_rank += 1
+                    location_pos[node_loc] = coords
+                    new_locs[date].append(node_loc)
+
+            nodes_to_remove = []
+            for node_loc in new_locs[date]:
+                neighbours = adjacency.getNeighbours(node_loc)
+                route_checks += len(neighbours)
+                infected_neighbours = [infected for infected in neighbours
+                                       if infected in node_rank and not infected == node_loc]
+                if not key_locations is None:
+                    infected_neighbours = [infected for infected in infected_neighbours if infected in key_locations]
+                infected_neighbours.sort(key=node_rank.__getitem__)
+                if not border_closure_index is None:
+                    blocked = border_closure_index.blockedEdges([node_loc]*len(infected_neighbours),
+                                                                infected_neighbours, date_index)
+                    infected_neighbours = [infected for infected, is_blocked in zip(infected_neighbours, blocked)
+                                           if not is_blocked]
+
+                for infected in infected_neighbours:
+                    infect_graph.add_edge(infected, node_loc)
+                    new_edges[date].append((infected, node_loc))
+                    added_children.append((infected, node_loc))
+
+                if not key_locations is None:
+                    if infect_graph.degree(node_loc) == 0:
+                        nodes_to_remove.append(node_loc)
+
+            if not key_locations is None:
+                infect_graph.remove_nodes_from(nodes_to_remove)
+                new_locs[date] = list(set(new_locs[date]) - set(nodes_to_remove))
+
+                for node_remove in nodes_to_remove:
+                    del node_rank[node_remove]
+                    if node_remove in location_pos:
+                        del location_pos[node_remove]
+
+            # Only the confirmed cases that changed are saved in the snapshot
+            confirmed_changes = {}
+            for row, confirmed in zip(day_rows.tolist(), date_cases[day_rows].tolist()):
+                node_loc = location_names[row]
+                if node_loc in node_rank:
+                    node_attributes = infect_graph.nodes[node_loc]
+                    if not 'confirmed' in node_attributes or not node_attributes['confirmed'] == confirmed:
+                        node_attributes['confirmed'] = confirmed
+                        confirmed_changes[node_loc] = confirmed
+
+            infect_graphs.addSnapshot(date, added_nodes, list(new_edges[date]), nodes_to_remove, confirmed_changes)
+            infected_parents.addSnapshot(date, [node for node, _attributes in added_nodes], added_children,
+                                         nodes_to_remove)
+
+        stage.count('dates', len(dates))
+        stage.count('route_checks', route_checks)
+        stage.count('infected_locations', len(location_pos))
+        return infect_graphs, location_pos, max_confirmed, infected_parents, new_locs, new_edges
+
+
+def get_infection_path(data_confirmed, routes, infect_thresh, bin_region_column, border_closures=None,
+                       key_locations=None, snapshot_cache_size=8):
+    """
+    Drop in replacement for get_infection_path in
+    coronavirus_infection_path.ipynb using InfectionPathEngine.
+    """
+    engine = InfectionPathEngine(data_confirmed, routes, bin_region_column)
+    return engine.run(infect_thresh, border_closures=border_closures, key_locations=key_locations,
+                      snapshot_cache_size=snapshot_cache_size)
+
+
+def get_infected_indicators(infect_graphs, dates, locations):
+    """
+    Returns a locations x dates boolean matrix that is True where the
+    location is a node of the infection graph of the date.
+
+    parameters:
+        infect_graphs: the infection graphs of each date from
+                       get_infection_path.
+
+        dates:         the dates, the columns of the matrix.
+
+        locations:     the location names, the rows of the matrix.
+                       Infected locations that are not in the list are left
+                       out.
+    """
+    location_ids = {name_loc : loc_id for loc_id, name_loc in enumerate(locations)}
+    infected = np.zeros((len(location_ids), len(dates)), dtype=bool)
+    for date_index, date in enumerate(dates):
+        loc_ids = [location_ids.get(node_loc, -1) for node_loc in infect_graphs[date].nodes]
+        loc_ids = np.array(loc_ids, dtype=np.int64)
+        infected[loc_ids[loc_ids >= 0], date_index] = True
+    return infected
+
+def count_routes_from_infect_cluster_to_clean_cluster(infect_graphs, routes, dates, bin_region_column, weighted=False,
+                                                      adjacency=None):
+    """
+    Counts the routes between infected and uninfected locations on every
+    date with two sparse matrix products over the whole infected matrix.
+
+    Same count as get_num_routes_from_infect_cluster_to_clean_cluster in
+    coronavirus_infection_path.ipynb: every infected location counts its
+    routes departing to uninfected locations, or if it has none its routes
+    arriving from uninfected locations.
+
+    parameters:
+        infect_graphs:     the infection graphs of each date from
+                           get_infection_path.
+
+        routes:            the (cleaned) routes dataframe the infection graphs
+                           were computed with.
+
+        dates:             the dates to count.
+
+        bin_region_column: Is either 'county', 'state' or 'country'.
+
+        weighted:          if True the routes are counted by their
+                           NumberOfRoutes instead of once for every pair of
+                           locations.
+
+        adjacency:         a RouteAdjacency of routes if one has already
+                           been built.
+
+    returns:
+        The total number of routes on each date as a list, the form
+        plot_total_paths_from_infect_cluster plots, and a dataframe of the
+        number of routes of each infected location on each date with the
+        location names as the index and a column per date.
+    """
+    with span('count_routes_from_infect_cluster_to_clean_cluster', bin_region_column=bin_region_column) as stage:
+        adjacency = RouteAdjacency(routes, bin_region_column) if adjacency is None else adjacency
+        matrix = adjacency.getMatrix(weighted)
+        infected = get_infected_indicators(infect_graphs, dates, adjacency.locations)
+        uninfected = (~infected).astype(np.int64)
+
+        to_uninfected = np.asarray(matrix @ uninfected) * infected
+        from_uninfected = np.asarray(matrix.T @ uninfected) * infected
+        per_location = np.where(to_uninfected > 0, to_uninfected, from_uninfected)
+
+        rows = np.flatnonzero(per_location.any(axis=1))
+        by_location = pd.DataFrame(per_location[rows], index=[adjacency.locations[row] for row in rows.tolist()],
+                                   columns=list(dates))
+        stage.count('dates', len(dates))
+        stage.count('locations', len(adjacency.locations))
+    return per_location.sum(axis=0).tolist(), by_location
+
+def get_num_routes_from_infect_cluster_to_clean_cluster(infect_graphs, routes, dates, bin_region_column):
+    """
+    Drop in replacement for get_num_routes_from_infect_cluster_to_clean_cluster
+    in coronavirus_infection_path.ipynb.
+    """
+    total_infect_to_clean, _by_location = count_routes_from_infect_cluster_to_clean_cluster(infect_graphs, routes, dates,
+                                                                                            bin_region_column)
+    return total_infect_to_clean
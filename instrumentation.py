@@ -0,0 +1,255 @@
+import os, json, time, atexit, functools, threading
+
+# Set to a file prefix to trace the whole process, the summary is saved to
+# <prefix>.json and the Chrome trace to <prefix>.trace.json when it exits
+TRACE_ENV_VARIABLE = "COVID_TRACE"
+
+class Span:
+    __slots__ = ('tracer', 'name', 'category', 'args', 'counters', 'start', 'thread_id')
+
+    def __init__(self, tracer, name, category, args):
+        """
+        A named stage timed by Tracer.span, use it as a context manager.
+        """
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.counters = {}
+        self.start = None
+        self.thread_id = None
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._finishSpan(self, time.perf_counter(), exc_type)
+        return False
+
+    def count(self, counter, value=1):
+        """
+        Adds value to a counter of this span, for example the rows processed
+        or the bytes read. The counter is also added to the tracer's totals.
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def count(self, counter, value=1):
+        pass
+
+# Returned by span while tracing is disabled so it costs a single check
+NULL_SPAN = NullSpan()
+
+class Tracer:
+
+    def __init__(self):
+        """
+        Records the spans and counters of the instrumented stages of the
+        pipeline so they can be exported as a summary of each stage or as a
+        Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+
+        Spans can be recorded from several threads at once.
+        """
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # Timestamps are relative to the epoch so traces of other processes
+        # can be merged in
+        self.origin_wall = time.time()
+        self.origin_perf = time.perf_counter()
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets every span and counter recorded so far.
+        """
+        with self.lock:
+            self.events = []
+            self.stages = {}
+            self.counters = {}
+
+    def span(self, name, category='covid', **args):
+        """
+        Returns a Span timing the stage name, extra keyword arguments are
+        saved with the span in the trace.
+        """
+        return Span(self, name, category, args)
+
+    def count(self, counter, value=1):
+        """
+        Adds value to a counter that is not part of a span.
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def _toMicroseconds(self, perf_time):
+        return (self.origin_wall + perf_time - self.origin_perf)*1e6
+
+    def _finishSpan(self, span, end, exc_type):
+        seconds = end - span.start
+        args = dict(span.args)
+        args.update(span.counters)
+        if not exc_type is None:
+            args['error'] = exc_type.__name__
+        event = {'name' : span.name, 'cat' : span.category, 'ph' : 'X', 'ts' : self._toMicroseconds(span.start),
+                 'dur' : seconds*1e6, 'pid' : self.pid, 'tid' : span.thread_id, 'args' : args}
+
+        with self.lock:
+            self.events.append(event)
+            self._addToStage(span.name, seconds, span.counters)
+            for counter, value in span.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def _addToStage(self, name, seconds, counters):
+        stage = self.stages.get(name, None)
+        if stage is None:
+            stage = self.stages[name] = {'calls' : 0, 'seconds' : 0.0, 'max_seconds' : 0.0, 'counters' : {}}
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        stage['max_seconds'] = max(stage['max_seconds'], seconds)
+        for counter, value in counters.items():
+            stage['counters'][counter] = stage['counters'].get(counter, 0) + value
+
+    def getSummary(self):
+        """
+        Returns a dictionary with the number of calls, total and longest wall
+        time and the counters of every stage, and the totals of every
+        counter.
+        """
+        with self.lock:
+            stages = {name : {'calls'       : stage['calls'],
+                              'seconds'     : stage['seconds'],
+                              'max_seconds' : stage['max_seconds'],
+                              'counters'    : dict(stage['counters'])}
+                      for name, stage in self.stages.items()}
+            counters = dict(self.counters)
+        return {'pid' : self.pid, 'stages' : stages, 'counters' : counters}
+
+    def getChromeTrace(self):
+        """
+        Returns the spans in the Chrome trace event format.
+        """
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        end = self._toMicroseconds(time.perf_counter())
+        if len(counters) > 0:
+            events.append({'name' : 'counters', 'ph' : 'C', 'ts' : end, 'pid' : self.pid, 'tid' : 0, 'args' : counters})
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+    def writeSummary(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.getSummary(), fp, indent=2)
+
+    def writeChromeTrace(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.getChromeTrace(), fp)
+
+    def mergeTrace(self, filename):
+        """
+        Adds the spans of a Chrome trace written by another process, for
+        example the route downloader run by CovidData, to this tracer.
+        """
+        with open(filename, 'r') as fp:
+            trace = json.load(fp)
+
+        with self.lock:
+            for event in trace['traceEvents']:
+                if event['ph'] == 'X':
+                    self.events.append(event)
+                    counters = {key : value for key, value in event['args'].items()
+                                if isinstance(value, (int, float)) and not isinstance(value, bool)}
+                    self._addToStage(event['name'], event['dur']/1e6, counters)
+                # The counter totals of the other process include its spans
+                elif event['ph'] == 'C':
+                    for counter, value in event['args'].items():
+                        self.counters[counter] = self.counters.get(counter, 0) + value
+
+_tracer = None
+
+def enable_tracing(tracer=None):
+    """
+    Starts recording spans and counters, returns the Tracer they are
+    recorded to.
+    """
+    global _tracer
+    _tracer = Tracer() if tracer is None else tracer
+    return _tracer
+
+def disable_tracing():
+    """
+    Stops recording and returns the Tracer that was used, or None if tracing
+    was not enabled.
+    """
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    return tracer
+
+def get_tracer():
+    return _tracer
+
+def is_tracing():
+    return not _tracer is None
+
+def span(name, category='covid', **args):
+    """
+    Times the stage name if tracing is enabled:
+
+        with span('CovidData.getData', bin_region_column='state') as stage:
+            ...
+            stage.count('rows', df.shape[0])
+    """
+    if _tracer is None:
+        return NULL_SPAN
+    return _tracer.span(name, category, **args)
+
+def traced(name, category='covid'):
+    """
+    Decorator that times every call of a function as the stage name if
+    tracing is enabled.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(counter, value=1):
+    """
+    Adds value to a counter if tracing is enabled.
+    """
+    if not _tracer is None:
+        _tracer.count(counter, value)
+
+def write_trace(prefix, tracer=None):
+    """
+    Saves the summary to <prefix>.json and the Chrome trace to
+    <prefix>.trace.json.
+    """
+    tracer = _tracer if tracer is None else tracer
+    if tracer is None:
+        return
+    tracer.writeSummary(prefix + ".json")
+    tracer.writeChromeTrace(prefix + ".trace.json")
+
+def _trace_from_environment():
+    prefix = os.environ.get(TRACE_ENV_VARIABLE, None)
+    if prefix:
+        tracer = enable_tracing()
+        atexit.register(write_trace, prefix, tracer)
+
+_trace_from_environment()
@@ -0,0 +1,192 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from locations import LOCATION_COLUMNS
+
+REGISTRY_VERSION = 1
+# The location levels from largest to smallest set
+BIN_LEVELS = ['county', 'state', 'country']
+
+def location_keys(df, prefix=''):
+    """
+    Returns the County, Province/State and Country/Region columns of df (with
+    prefix, for example 'Depart') as strings with missing values as "none".
+    Dataframes without a County column, like the recovered dataset, have
+    "none" for every county.
+    """
+    keys = []
+    for column in LOCATION_COLUMNS['county']:
+        if prefix + column in df.columns:
+            keys.append(df[prefix + column].fillna("none").astype(str).to_numpy(dtype=object))
+        else:
+            keys.append(np.full(df.shape[0], "none", dtype=object))
+    return keys
+
+class LocationRegistry:
+
+    def __init__(self, locations=()):
+        """
+        Interns locations as integer IDs so datasets can be joined and
+        looked up by integers, the location names are only formatted when
+        they are displayed.
+
+        A location is a (County, Province/State, Country/Region) tuple with
+        "none" for missing levels. Each bin level has its own IDs, given in
+        the order locations are first registered, so IDs never change when
+        new locations are added. The county level ID of a location can be
+        rolled up to its state and country IDs with getRollup.
+
+        parameters:
+            locations: (County, Province/State, Country/Region) tuples to
+                       register in order.
+        """
+        self.locations = {bin_region_column : [] for bin_region_column in BIN_LEVELS}
+        self.location_ids = {bin_region_column : {} for bin_region_column in BIN_LEVELS}
+        # The ID of the location one level up of every county and state
+        self.parents = {'county' : [], 'state' : []}
+        self.arrays = {}
+        for location in locations:
+            self.add(location)
+
+    def __len__(self):
+        return len(self.locations['county'])
+
+    def getNumberOfLocations(self, bin_region_column):
+        return len(self.locations[bin_region_column])
+
+    def _intern(self, bin_region_column, key, parent_id=None):
+        location_id = self.location_ids[bin_region_column].get(key, None)
+        if location_id is None:
+            location_id = len(self.locations[bin_region_column])
+            self.locations[bin_region_column].append(key)
+            self.location_ids[bin_region_column][key] = location_id
+            if not parent_id is None:
+                self.parents[bin_region_column].append(parent_id)
+            self.arrays = {}
+        return location_id
+
+    def add(self, location):
+        """
+        Registers a (County, Province/State, Country/Region) tuple and
+        returns its county level ID.
+        """
+        county, state, country = location
+        country_id = self._intern('country', (country,))
+        state_id = self._intern('state', (state, country), country_id)
+        return self._intern('county', (county, state, country), state_id)
+
+    def register(self, df, prefix=''):
+        """
+        Registers the location of every row of df.
+
+        parameters:
+            df:     a dataframe with location columns, for example a COVID
+                    dataset or the routes dataset.
+
+            prefix: prefix of the location columns, 'Depart' or 'Arrival' for
+                    the routes dataset.
+
+        returns:
+            The county level ID of every row of df as an int64 array.
+        """
+        codes, uniques = pd.MultiIndex.from_arrays(location_keys(df, prefix)).factorize()
+        unique_ids = np.array([self.add(location) for location in uniques.tolist()], dtype=np.int64)
+        return unique_ids[codes]
+
+    def getID(self, location, bin_region_column='county'):
+        """
+        Returns the ID of a location, given as a tuple of its location columns
+        or a name like "State:Country", or -1 if it is not registered.
+        """
+        if isinstance(location, str):
+            location = tuple(location.split(':'))
+        return self.location_ids[bin_region_column].get(tuple(location), -1)
+
+    def getLocation(self, location_id, bin_region_column='county'):
+        return self.locations[bin_region_column][location_id]
+
+    def getRollup(self, from_bin_region_column, to_bin_region_column):
+        """
+        Returns an array mapping the IDs of from_bin_region_column to the IDs
+        of the locations they are in at to_bin_region_column, for example
+        county to state.
+        """
+        from_level = BIN_LEVELS.index(from_bin_region_column)
+        to_level = BIN_LEVELS.index(to_bin_region_column)
+        assert from_level <= to_level, "Can only roll up to a larger location, {} is inside {}".format(to_bin_region_column, from_bin_region_column)
+
+        key = ('rollup', from_bin_region_column, to_bin_region_column)
+        if not key in self.arrays:
+            rollup = np.arange(self.getNumberOfLocations(from_bin_region_column), dtype=np.int64)
+            for level in range(from_level, to_level):
+                rollup = np.array(self.parents[BIN_LEVELS[level]], dtype=np.int64)[rollup]
+            self.arrays[key] = rollup
+        return self.arrays[key]
+
+    def rollupSum(self, values, from_bin_region_column, to_bin_region_column):
+        """
+        Sums values indexed by the IDs of from_bin_region_column, or a matrix
+        with a row per ID, into the locations of to_bin_region_column.
+        """
+        values = np.asarray(values)
+        rollup = self.getRollup(from_bin_region_column, to_bin_region_column)
+        totals = np.zeros((self.getNumberOfLocations(to_bin_region_column),) + values.shape[1:], dtype=values.dtype)
+        np.add.at(totals, rollup, values)
+        return totals
+
+    def getColumns(self, bin_region_column):
+        """
+        Returns the values of each location column of bin_region_column as
+        object arrays indexed by ID.
+        """
+        key = ('columns', bin_region_column)
+        if not key in self.arrays:
+            locations = self.locations[bin_region_column]
+            self.arrays[key] = [np.array([location[ii] for location in locations], dtype=object)
+                                for ii in range(len(LOCATION_COLUMNS[bin_region_column]))]
+        return self.arrays[key]
+
+    def getSortRanks(self, bin_region_column):
+        """
+        Returns the rank of every ID when the locations are sorted by their
+        location columns, which is the order pandas groupby sorts them in.
+        """
+        key = ('ranks', bin_region_column)
+        if not key in self.arrays:
+            locations = self.locations[bin_region_column]
+            order = sorted(range(len(locations)), key=locations.__getitem__)
+            ranks = np.zeros(len(locations), dtype=np.int64)
+            ranks[order] = np.arange(len(locations), dtype=np.int64)
+            self.arrays[key] = ranks
+        return self.arrays[key]
+
+    def getNames(self, location_ids, bin_region_column='county'):
+        """
+        Returns the names of the locations ("County:State:Country",
+        "State:Country" or "Country") in the same format as
+        locations.get_location_names.
+        """
+        locations = self.locations[bin_region_column]
+        return [':'.join(locations[location_id]) for location_id in np.asarray(location_ids).tolist()]
+
+    def save(self, filename):
+        """
+        Saves the registered locations to a .json file. The file is replaced
+        in one step so other processes never read half of it.
+        """
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w') as fp:
+            json.dump({'version' : REGISTRY_VERSION, 'locations' : [list(location) for location in self.locations['county']]}, fp)
+        os.replace(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a registry saved by save, registering the locations in the same
+        order gives every level the same IDs.
+        """
+        with open(filename, 'r') as fp:
+            data = json.load(fp)
+        assert data.get('version', None) == REGISTRY_VERSION, "{} is not a location registry".format(filename)
+        return cls([tuple(location) for location in data['locations']])
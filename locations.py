@@ -0,0 +1,28 @@
+LOCATION_COLUMNS = {
+    'county'  : ['County', 'Province/State', 'Country/Region'],
+    'state'   : ['Province/State', 'Country/Region'],
+    'country' : ['Country/Region'],
+}
+
+def get_location_names(df, bin_region_column, prefix=''):
+    """
+    Builds the location names used as nodes in the infection graphs for every
+    row of df ("County:State:Country", "State:Country" or "Country").
+
+    parameters:
+        df:                A COVID dataframe from CovidData.getData or a routes
+                           dataframe from CovidData.routesToWeightedEdges.
+
+        bin_region_column: Is either 'county', 'state' or 'country'.
+
+        prefix:            Prefix of the location columns, 'Depart' or
+                           'Arrival' for the routes dataframe.
+
+    returns:
+        A list of location names in the same order as the rows of df.
+    """
+    columns = [prefix + column for column in LOCATION_COLUMNS[bin_region_column]]
+    names = df[columns[0]].astype(str)
+    for column in columns[1:]:
+        names = names + ':' + df[column].astype(str)
+    return names.tolist()
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+class LRUCache:
+
+    def __init__(self, maxsize=128):
+        """
+        A small least recently used cache that keeps track of how many
+        lookups were hits or misses.
+
+        parameters:
+            maxsize: the maximum number of entries kept before the least
+                     recently used entry is evicted. If None the cache is
+                     unbounded.
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """
+        Returns the entry stored for key and marks it as the most recently
+        used, otherwise returns default.
+        """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=None):
+        """
+        Returns the entry stored for key without counting it as a lookup or
+        changing the eviction order.
+        """
+        return self.entries.get(key, default)
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if not self.maxsize is None:
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def items(self):
+        return list(self.entries.items())
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return {'hits'    : self.hits,
+                'misses'  : self.misses,
+                'size'    : len(self.entries),
+                'maxsize' : self.maxsize}
@@ -0,0 +1,509 @@
+import json
+import numpy as np
+from instrumentation import span
+from locations import get_location_names
+
+BUNDLE_MAGIC = b'COVIDMAP'
+BUNDLE_VERSION = 1
+# Arrays in a bundle start on a multiple of this many bytes
+BUNDLE_ALIGNMENT = 64
+BUNDLE_ARRAYS = ['coordinates', 'route_locations', 'route_weights', 'cases', 'radii',
+                 'marker_changes_indptr', 'marker_changes', 'route_changes_indptr', 'route_changes']
+
+def _changes(values):
+    """
+    Returns the columns of each row of values that differ from the previous
+    row (every nonzero column for the first row) in CSR format.
+    """
+    changed = np.empty(values.shape, dtype=bool)
+    changed[:1] = values[:1] != 0
+    changed[1:] = values[1:] != values[:-1]
+    rows, columns = np.nonzero(changed)
+    indptr = np.zeros(values.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=values.shape[0]), out=indptr[1:])
+    return indptr, columns.astype(np.int32)
+
+class MapFrames:
+
+    def __init__(self, location_names, dates, coordinates, cases, route_locations, route_weights, scale=1.0,
+                 metric='confirmed', radii=None, changes=None):
+        """
+        Precomputed frames of the timeline maps, the markers, circle radii
+        and routes shown on every date, so a slider only updates the layers
+        that changed instead of rebuilding every widget from the dataframe.
+
+        A location is shown on the dates it has cases, with a circle radius
+        of round(cases*scale) like generateGraphTimeline in the timeline
+        notebook. A route is shown on the dates its departure location has
+        cases.
+
+        parameters:
+            location_names:  the names of the locations.
+
+            dates:           the dates of the frames.
+
+            coordinates:     a locations x 2 array of Lat and Long.
+
+            cases:           a dates x locations array of the cases of
+                             metric.
+
+            route_locations: a routes x 2 array of the departure and arrival
+                             location of each route.
+
+            route_weights:   the number of routes between the locations.
+
+            scale:           multiplies the cases to get the circle radius.
+
+            metric:          the name of the cases, for the marker titles.
+
+            radii, changes:  precomputed arrays, used by load.
+        """
+        self.location_names = list(location_names)
+        self.dates = list(dates)
+        self.date_index = {date : ii for ii, date in enumerate(self.dates)}
+        self.coordinates = coordinates
+        self.cases = cases
+        self.route_locations = route_locations
+        self.route_weights = route_weights
+        self.scale = scale
+        self.metric = metric
+
+        assert cases.shape == (len(self.dates), len(self.location_names)), "The cases do not match the dates and locations!"
+        assert coordinates.shape == (len(self.location_names), 2), "The coordinates do not match the locations!"
+
+        if radii is None:
+            radii = np.rint(np.asarray(cases, dtype=np.float64) * scale).astype(np.int32)
+        self.radii = radii
+        if changes is None:
+            marker_changes = _changes(cases)
+            route_changes = _changes(self.getRouteActivity())
+            changes = marker_changes + route_changes
+        self.marker_changes_indptr, self.marker_changes, self.route_changes_indptr, self.route_changes = changes
+
+    @classmethod
+    def fromTimeSeriesStore(cls, store, routes=None, metric='confirmed', scale=1.0, clean=True):
+        """
+        Builds the frames from a TimeSeriesStore and the routes between its
+        locations.
+
+        parameters:
+            store:  a TimeSeriesStore.
+
+            routes: a dataframe from CovidData.routesToWeightedEdges at the
+                    same bin_region_column as store, or None for no routes.
+
+            metric: the metric of store shown on the map.
+
+            scale:  multiplies the cases to get the circle radius.
+
+            clean:  if True locations without coordinates (Lat and Long of
+                    0) are left out like clean_data in the infection path
+                    notebook.
+        """
+        coordinates = np.asarray(store.coordinates[metric], dtype=np.float64)
+        keep = ~np.isnan(coordinates).any(axis=1)
+        if clean:
+            keep &= ~((coordinates[:, 0] == 0) & (coordinates[:, 1] == 0))
+        rows = np.flatnonzero(keep)
+        location_names = np.asarray(store.getLocationNames(), dtype=object)[rows].tolist()
+        cases = np.ascontiguousarray(np.asarray(store.getMatrix(metric))[rows].T, dtype=np.int32)
+
+        route_locations = np.zeros((0, 2), dtype=np.int32)
+        route_weights = np.zeros(0, dtype=np.int64)
+        if not routes is None and routes.shape[0] > 0:
+            location_index = {name : ii for ii, name in enumerate(location_names)}
+            route_locations = np.array([[location_index.get(name, -1) for name in get_location_names(routes, store.bin_region_column, side)]
+                                        for side in ['Depart', 'Arrival']], dtype=np.int32).T
+            # Routes within a location or to a location not on the map are
+            # not drawn
+            drawn = (route_locations >= 0).all(axis=1) & (route_locations[:, 0] != route_locations[:, 1])
+            route_locations = np.ascontiguousarray(route_locations[drawn])
+            route_weights = routes['NumberOfRoutes'].to_numpy(dtype=np.int64)[drawn]
+
+        return cls(location_names, store.getDates(), coordinates[rows], cases, route_locations, route_weights,
+                   scale, metric)
+
+    @classmethod
+    def fromCovidData(cls, covid_data, bin_region_column='state', country=None, metric='confirmed', scale=1.0,
+                      routes=True, clean=True):
+        """
+        Builds the frames from the COVID data and routes of a CovidData.
+
+        parameters:
+            covid_data:        a CovidData.
+
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            country:           If not None then only the locations within
+                               that country are shown.
+
+            routes:            if True the routes between the locations are
+                               included.
+        """
+        with span('MapFrames.fromCovidData', bin_region_column=bin_region_column) as stage:
+            store = covid_data.getTimeSeriesStore(bin_region_column, country)
+            route_df = covid_data.routesToWeightedEdges(bin_region_column, country) if routes else None
+            frames = cls.fromTimeSeriesStore(store, route_df, metric, scale, clean)
+            stage.count('frames', len(frames.dates))
+            stage.count('markers', len(frames.location_names))
+        return frames
+
+    def _toDateIndex(self, date):
+        if isinstance(date, (int, np.integer)):
+            return int(date)
+        try:
+            return self.date_index[date]
+        except KeyError:
+            raise ValueError("{} is not in the list of dates".format(date))
+
+    def getRouteActivity(self):
+        """
+        Returns a dates x routes boolean array that is True where the route
+        is shown.
+        """
+        return np.asarray(self.cases)[:, np.asarray(self.route_locations)[:, 0]] > 0
+
+    def getMaxRouteWeight(self):
+        return int(self.route_weights.max()) if len(self.route_weights) > 0 else 1
+
+    def getMarkerTitle(self, location_index, cases):
+        """
+        Returns the title of a marker like the timeline notebook, for example
+        "Tasmania:Australia - Confirmed: 12".
+        """
+        return "{} - {}: {}".format(self.location_names[location_index], self.metric.capitalize(), cases)
+
+    def getFrame(self, date):
+        """
+        Returns the layers shown on a date (or date index).
+
+        returns:
+            A dictionary with the date, the indexes of the locations with
+            cases ('markers') and their 'cases' and 'radii', and the indexes
+            of the routes shown ('routes').
+        """
+        date_index = self._toDateIndex(date)
+        cases = np.asarray(self.cases[date_index])
+        markers = np.flatnonzero(cases > 0)
+        return {
+            'date'    : self.dates[date_index],
+            'markers' : markers,
+            'cases'   : cases[markers],
+            'radii'   : np.asarray(self.radii[date_index])[markers],
+            'routes'  : np.flatnonzero(cases[np.asarray(self.route_locations)[:, 0]] > 0)
+        }
+
+    def getChanges(self, date):
+        """
+        Returns the locations whose cases changed and the routes that were
+        shown or hidden on a date compared to the date before it.
+        """
+        date_index = self._toDateIndex(date)
+        markers = np.asarray(self.marker_changes[self.marker_changes_indptr[date_index]:self.marker_changes_indptr[date_index + 1]])
+        routes = np.asarray(self.route_changes[self.route_changes_indptr[date_index]:self.route_changes_indptr[date_index + 1]])
+        return markers, routes
+
+    def getDiff(self, from_date, to_date):
+        """
+        Returns the changes to the layers to go from the frame of from_date
+        to the frame of to_date, from_date can be None for an empty map.
+
+        returns:
+            A dictionary of the location indexes to add ('added_markers'),
+            remove ('removed_markers') and update ('changed_markers'), the
+            'cases' and 'radii' of the added and changed locations in that
+            order, and the route indexes to add ('added_routes') and remove
+            ('removed_routes').
+        """
+        to_index = self._toDateIndex(to_date)
+        to_cases = np.asarray(self.cases[to_index])
+        to_routes = to_cases[np.asarray(self.route_locations)[:, 0]] > 0
+        if from_date is None:
+            candidates = np.flatnonzero(to_cases)
+            route_candidates = np.flatnonzero(to_routes)
+            from_cases = np.zeros_like(to_cases)
+            from_routes = np.zeros_like(to_routes)
+        else:
+            from_index = self._toDateIndex(from_date)
+            from_cases = np.asarray(self.cases[from_index])
+            from_routes = from_cases[np.asarray(self.route_locations)[:, 0]] > 0
+            if abs(to_index - from_index) == 1:
+                # Neighbouring frames only differ by the precomputed changes
+                candidates, route_candidates = self.getChanges(max(from_index, to_index))
+            else:
+                candidates = np.flatnonzero(from_cases != to_cases)
+                route_candidates = np.flatnonzero(from_routes != to_routes)
+
+        was_shown = from_cases[candidates] > 0
+        is_shown = to_cases[candidates] > 0
+        added = candidates[is_shown & ~was_shown]
+        changed = candidates[is_shown & was_shown]
+        updated = np.concatenate([added, changed])
+        return {
+            'added_markers'   : added,
+            'removed_markers' : candidates[was_shown & ~is_shown],
+            'changed_markers' : changed,
+            'cases'           : to_cases[updated],
+            'radii'           : np.asarray(self.radii[to_index])[updated],
+            'added_routes'    : route_candidates[to_routes[route_candidates]],
+            'removed_routes'  : route_candidates[~to_routes[route_candidates]]
+        }
+
+    def _getPointFeatures(self, frame):
+        coordinates = np.asarray(self.coordinates)
+        features = []
+        for location_index, cases, radius in zip(frame['markers'].tolist(), frame['cases'].tolist(), frame['radii'].tolist()):
+            lat, long = coordinates[location_index].tolist()
+            features.append({
+                'type'       : 'Feature',
+                'geometry'   : {'type' : 'Point', 'coordinates' : [long, lat]},
+                'properties' : {'name' : self.location_names[location_index], self.metric : cases, 'radius' : radius}
+            })
+        return features
+
+    def _getRouteFeatures(self, route_indexes):
+        coordinates = np.asarray(self.coordinates)
+        route_locations = np.asarray(self.route_locations)
+        max_weight = self.getMaxRouteWeight()
+        features = []
+        for route_index in route_indexes:
+            depart, arrival = route_locations[route_index].tolist()
+            weight = int(self.route_weights[route_index])
+            features.append({
+                'type'       : 'Feature',
+                'geometry'   : {'type' : 'LineString', 'coordinates' : [coordinates[depart, ::-1].tolist(), coordinates[arrival, ::-1].tolist()]},
+                'properties' : {'route' : route_index, 'depart' : self.location_names[depart], 'arrival' : self.location_names[arrival],
+                                'NumberOfRoutes' : weight, 'opacity' : weight / max_weight}
+            })
+        return features
+
+    def toGeoJSON(self, date, routes=True):
+        """
+        Returns the frame of a date as a GeoJSON FeatureCollection, a Point
+        for each location with cases and a LineString for each route shown.
+        """
+        frame = self.getFrame(date)
+        features = self._getPointFeatures(frame)
+        if routes:
+            features.extend(self._getRouteFeatures(frame['routes'].tolist()))
+        return {'type' : 'FeatureCollection', 'properties' : {'date' : frame['date']}, 'features' : features}
+
+    def writeGeoJSON(self, filename, routes=True):
+        """
+        Writes the frames as newline delimited GeoJSON so a viewer can stream
+        them one line at a time. The first line is a FeatureCollection of
+        every route, since their lines are the same on every date. Each line
+        after it is the FeatureCollection of the Points of a date, in date
+        order, with the indexes of the routes shown in its 'routes'
+        property.
+        """
+        with span('MapFrames.writeGeoJSON') as stage:
+            with open(filename, 'w') as fp:
+                route_features = self._getRouteFeatures(range(len(self.route_weights))) if routes else []
+                fp.write(json.dumps({'type' : 'FeatureCollection', 'properties' : {'dates' : self.dates}, 'features' : route_features}))
+                fp.write('\n')
+                for date_index in range(len(self.dates)):
+                    frame = self.getFrame(date_index)
+                    properties = {'date' : frame['date']}
+                    if routes:
+                        properties['routes'] = frame['routes'].tolist()
+                    fp.write(json.dumps({'type' : 'FeatureCollection', 'properties' : properties,
+                                         'features' : self._getPointFeatures(frame)}))
+                    fp.write('\n')
+            stage.count('frames', len(self.dates))
+
+    def _getArrays(self):
+        return {
+            'coordinates'           : np.asarray(self.coordinates, dtype=np.float64),
+            'route_locations'       : np.asarray(self.route_locations, dtype=np.int32).reshape(-1, 2),
+            'route_weights'         : np.asarray(self.route_weights, dtype=np.int64),
+            'cases'                 : np.asarray(self.cases, dtype=np.int32),
+            'radii'                 : np.asarray(self.radii, dtype=np.int32),
+            'marker_changes_indptr' : np.asarray(self.marker_changes_indptr, dtype=np.int64),
+            'marker_changes'        : np.asarray(self.marker_changes, dtype=np.int32),
+            'route_changes_indptr'  : np.asarray(self.route_changes_indptr, dtype=np.int64),
+            'route_changes'         : np.asarray(self.route_changes, dtype=np.int32)
+        }
+
+    def save(self, filename):
+        """
+        Saves the frames as a single binary bundle: the magic bytes, the
+        length of a JSON header, the header and the arrays. The header has
+        the locations, dates and the offset, dtype and shape of each array.
+        The cases and radii are stored a date at a time so a viewer can read
+        one frame without reading the rest of the file.
+        """
+        arrays = self._getArrays()
+        header = {
+            'version'        : BUNDLE_VERSION,
+            'metric'         : self.metric,
+            'scale'          : self.scale,
+            'location_names' : self.location_names,
+            'dates'          : self.dates,
+            'arrays'         : {}
+        }
+        offset = 0
+        for name in BUNDLE_ARRAYS:
+            array = arrays[name]
+            header['arrays'][name] = {'offset' : offset, 'dtype' : array.dtype.str, 'shape' : list(array.shape)}
+            offset += -(-array.nbytes // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = len(BUNDLE_MAGIC) + 8 + len(header_bytes)
+        padding = -data_start % BUNDLE_ALIGNMENT
+        with span('MapFrames.save') as stage:
+            with open(filename, 'wb') as fp:
+                fp.write(BUNDLE_MAGIC)
+                fp.write(np.array([len(header_bytes) + padding], dtype='<u8').tobytes())
+                fp.write(header_bytes + b' ' * padding)
+                for name in BUNDLE_ARRAYS:
+                    array = np.ascontiguousarray(arrays[name])
+                    fp.write(array.tobytes())
+                    fp.write(b'\0' * (-array.nbytes % BUNDLE_ALIGNMENT))
+                stage.count('bytes_written', fp.tell())
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """
+        Loads a bundle saved with save.
+
+        parameters:
+            filename:  the bundle file.
+
+            mmap_mode: with the default 'r' the arrays are memory-mapped so
+                       frames are only read from disk when they are shown.
+                       If None the arrays are read into memory.
+        """
+        with open(filename, 'rb') as fp:
+            assert fp.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC, "{} is not a map frames bundle".format(filename)
+            header_length = int(np.frombuffer(fp.read(8), dtype='<u8')[0])
+            header = json.loads(fp.read(header_length).decode('utf-8'))
+            data_start = fp.tell()
+            assert header.get('version', None) == BUNDLE_VERSION, "{} is a different version of map frames bundle".format(filename)
+
+            arrays = {}
+            for name in BUNDLE_ARRAYS:
+                info = header['arrays'][name]
+                dtype = np.dtype(info['dtype'])
+                shape = tuple(info['shape'])
+                if mmap_mode is None or int(np.prod(shape)) == 0:
+                    fp.seek(data_start + info['offset'])
+                    count = int(np.prod(shape))
+                    arrays[name] = np.frombuffer(fp.read(count * dtype.itemsize), dtype=dtype, count=count).reshape(shape)
+                else:
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode=mmap_mode, offset=data_start + info['offset'], shape=shape)
+
+        changes = (arrays['marker_changes_indptr'], arrays['marker_changes'], arrays['route_changes_indptr'], arrays['route_changes'])
+        return cls(header['location_names'], header['dates'], arrays['coordinates'], arrays['cases'],
+                   arrays['route_locations'], arrays['route_weights'], header['scale'], header['metric'],
+                   arrays['radii'], changes)
+
+class TimelineLayers:
+
+    def __init__(self, frames, pymap, show_markers=False, show_routes=True, color='red', route_color='blue'):
+        """
+        Shows MapFrames on an ipyleaflet map. Each widget is created the
+        first time its location or route is shown and kept, so moving the
+        slider only adds, removes or updates the layers that changed:
+
+            layers = TimelineLayers(MapFrames.fromCovidData(covid_data, 'state', 'Australia', scale=0.02), pymap)
+            interact(lambda date: layers.show(date), date=(0, len(layers.frames.dates) - 1))
+
+        parameters:
+            frames:       a MapFrames.
+
+            pymap:        the ipyleaflet Map to add the layers to.
+
+            show_markers: if True a Marker with the cases as its title is
+                          shown for each location.
+
+            show_routes:  if True the routes are shown as lines with an
+                          opacity of their number of routes compared to the
+                          busiest route.
+        """
+        # Only imported when needed since it is only used in the notebooks
+        from ipyleaflet import LayerGroup
+
+        self.frames = frames
+        self.pymap = pymap
+        self.show_markers = show_markers
+        self.show_routes = show_routes
+        self.color = color
+        self.route_color = route_color
+        self.date_index = None
+        self.circles = {}
+        self.markers = {}
+        self.lines = {}
+        self.circle_layer = LayerGroup(name='circles')
+        self.marker_layer = LayerGroup(name='markers')
+        self.line_layer = LayerGroup(name='routes')
+        pymap.add_layer(self.circle_layer)
+        if show_markers:
+            pymap.add_layer(self.marker_layer)
+        if show_routes:
+            pymap.add_layer(self.line_layer)
+
+    def _getLocation(self, location_index):
+        lat, long = np.asarray(self.frames.coordinates[location_index]).tolist()
+        return (lat, long)
+
+    def _getCircle(self, location_index):
+        from ipyleaflet import CircleMarker
+
+        if not location_index in self.circles:
+            self.circles[location_index] = CircleMarker(location=self._getLocation(location_index), radius=0,
+                                                        color=self.color, fill_color=self.color)
+        return self.circles[location_index]
+
+    def _getMarker(self, location_index):
+        from ipyleaflet import Marker
+
+        if not location_index in self.markers:
+            self.markers[location_index] = Marker(location=self._getLocation(location_index), draggable=False, opacity=0.1)
+        return self.markers[location_index]
+
+    def _getLine(self, route_index):
+        from ipyleaflet import Polyline
+
+        if not route_index in self.lines:
+            depart, arrival = np.asarray(self.frames.route_locations[route_index]).tolist()
+            opacity = int(self.frames.route_weights[route_index]) / self.frames.getMaxRouteWeight()
+            self.lines[route_index] = Polyline(locations=[self._getLocation(depart), self._getLocation(arrival)],
+                                               color=self.route_color, opacity=opacity, fill=False)
+        return self.lines[route_index]
+
+    def show(self, date):
+        """
+        Updates the layers to the frame of a date (or date index).
+
+        returns:
+            The date shown.
+        """
+        date_index = self.frames._toDateIndex(date)
+        diff = self.frames.getDiff(self.date_index, date_index)
+
+        for location_index in diff['removed_markers'].tolist():
+            self.circle_layer.remove_layer(self.circles[location_index])
+            if self.show_markers:
+                self.marker_layer.remove_layer(self.markers[location_index])
+
+        updated = np.concatenate([diff['added_markers'], diff['changed_markers']]).tolist()
+        num_added = len(diff['added_markers'])
+        for ii, (location_index, cases, radius) in enumerate(zip(updated, diff['cases'].tolist(), diff['radii'].tolist())):
+            circle = self._getCircle(location_index)
+            circle.radius = radius
+            if self.show_markers:
+                self._getMarker(location_index).title = self.frames.getMarkerTitle(location_index, cases)
+            if ii < num_added:
+                self.circle_layer.add_layer(circle)
+                if self.show_markers:
+                    self.marker_layer.add_layer(self.markers[location_index])
+
+        if self.show_routes:
+            for route_index in diff['removed_routes'].tolist():
+                self.line_layer.remove_layer(self.lines[route_index])
+            for route_index in diff['added_routes'].tolist():
+                self.line_layer.add_layer(self._getLine(route_index))
+
+        self.date_index = date_index
+        return self.frames.dates[date_index]
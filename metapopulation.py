@@ -0,0 +1,451 @@
+import datetime
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from instrumentation import span
+from location_registry import location_keys
+
+# The compartments of the model in the order of the state arrays
+SEIR_COMPARTMENTS = ['S', 'E', 'I', 'R']
+# The replicates simulated together as one batch when replicates_per_task is
+# not given, fixed so the batches do not depend on the number of processes
+REPLICATES_PER_TASK = 16
+
+def simulation_dates(start_date, num_days):
+    """
+    Returns start_date and the num_days dates after it in the format of the
+    COVID datasets, for example "3/1/20".
+    """
+    start = datetime.datetime.strptime(start_date, '%m/%d/%y')
+    dates = []
+    for day in range(num_days + 1):
+        date = start + datetime.timedelta(days=day)
+        dates.append("{}/{}/{}".format(date.month, date.day, date.strftime('%y')))
+    return dates
+
+def location_populations(iso_df, locations, default_population=1e6):
+    """
+    Returns the population of each location from the iso table.
+
+    parameters:
+        iso_df:             the iso table, with the County, Province/State,
+                            Country/Region and Population columns.
+
+        locations:          a dataframe with the location columns of a
+                            bin_region_column, like TimeSeriesStore.locations.
+
+        default_population: the population of locations missing from the
+                            iso table.
+
+    returns:
+        A float64 array with the population of each row of locations.
+    """
+    populations = {}
+    iso_df = iso_df.loc[iso_df['Population'].notnull() & (iso_df['Population'] > 0)]
+    for key, population in zip(zip(*location_keys(iso_df)), iso_df['Population'].to_list()):
+        populations.setdefault(key, population)
+    return np.array([populations.get(key, default_population) for key in zip(*location_keys(locations))],
+                    dtype=np.float64)
+
+class MetapopulationModel:
+
+    def __init__(self, location_names, populations, routes, dates=(), confirmed=None, beta=0.4,
+                 incubation_days=5.2, infectious_days=7.0, travel_per_route=100.0):
+        """
+        Stochastic SEIR model with a population for every location, coupled
+        by travel along the flight routes between them.
+
+        Every location is advanced together each step with array operations.
+        Travellers from location ii spend their day at location jj in
+        proportion to the number of routes from ii to jj, so the force of
+        infection at jj includes the infectious visitors from ii and the
+        residents of ii are exposed to the force of infection at jj. Both
+        are a sparse matrix product with the travel matrix, over all
+        replicates at once.
+
+        parameters:
+            location_names:   the names of the locations, for example
+                              "State:Country".
+
+            populations:      the population of each location.
+
+            routes:           a scipy.sparse matrix with the number of routes
+                              departing location ii and arriving at location
+                              jj, with rows and columns in the order of
+                              location_names.
+
+            dates:            the dates of the COVID datasets, simulations
+                              start on one of these dates.
+
+            confirmed:        the locations x dates matrix of confirmed cases
+                              initialConditions calibrates from.
+
+            beta:             the transmission rate per day.
+
+            incubation_days:  the mean time from exposed to infectious.
+
+            infectious_days:  the mean time from infectious to removed.
+
+            travel_per_route: the number of people travelling along a route
+                              each day.
+        """
+        self.location_names = list(location_names)
+        self.location_index = {name : ii for ii, name in enumerate(self.location_names)}
+        self.populations = np.asarray(populations, dtype=np.float64)
+        self.dates = list(dates)
+        self.confirmed = confirmed
+        self.beta = beta
+        self.incubation_days = incubation_days
+        self.infectious_days = infectious_days
+        self.travel_per_route = travel_per_route
+
+        assert self.populations.shape == (len(self.location_names),), "There needs to be a population for every location!"
+        assert routes.shape == (len(self.location_names), len(self.location_names)), "The routes do not match the locations!"
+
+        # Routes within a location do not move anyone between locations
+        routes = routes.tocoo()
+        between = routes.row != routes.col
+        self.routes = sparse.csr_matrix((routes.data[between].astype(np.float64), (routes.row[between], routes.col[between])),
+                                        shape=routes.shape)
+
+    @classmethod
+    def fromCovidData(cls, covid_data, bin_region_column='state', country=None, default_population=1e6, **params):
+        """
+        Builds the model from the routes and confirmed cases of a CovidData.
+
+        parameters:
+            covid_data:         a CovidData.
+
+            bin_region_column:  Is either 'county', 'state' or 'country'.
+
+            country:            If not None then only the locations and
+                                routes within that country are used.
+
+            default_population: the population of locations missing from
+                                dataset/iso_table.csv.
+
+            params:             the parameters of the model, see __init__.
+        """
+        with span('MetapopulationModel.fromCovidData', bin_region_column=bin_region_column):
+            store = covid_data.getTimeSeriesStore(bin_region_column, country)
+            location_names = store.getLocationNames()
+            covid_manager = covid_data.getCovidManager()
+            iso_df = covid_manager.readDataset(covid_manager.getFileName('iso_table'))
+            populations = location_populations(iso_df, store.locations, default_population)
+
+            # The routes only include locations with a route, so they are
+            # moved to the rows of the locations in the store
+            adjacency, adjacency_locations = covid_data.routesToAdjacency(bin_region_column, country)
+            rows = np.array([store.location_index.get(location, -1) for location in adjacency_locations], dtype=np.int64)
+            adjacency = adjacency.tocoo()
+            departs = rows[adjacency.row]
+            arrivals = rows[adjacency.col]
+            known = (departs >= 0) & (arrivals >= 0)
+            routes = sparse.csr_matrix((adjacency.data[known], (departs[known], arrivals[known])),
+                                       shape=(len(location_names), len(location_names)))
+
+            confirmed = store.getMatrix('confirmed')
+            # Every location has at least as many people as confirmed cases
+            populations = np.maximum(populations, confirmed.max(axis=1) if confirmed.shape[1] > 0 else 0)
+        return cls(location_names, populations, routes, store.getDates(), confirmed, **params)
+
+    def getDateIndex(self, date):
+        try:
+            return self.dates.index(date)
+        except ValueError:
+            raise ValueError("{} is not in the list of dates".format(date))
+
+    def initialConditions(self, start_date, ascertainment=1.0):
+        """
+        Calibrates the compartments on start_date from the time series of
+        confirmed cases.
+
+        The cases confirmed within the last infectious_days are infectious
+        and the cases confirmed before that are removed. The exposed are the
+        cases expected to be confirmed within the next incubation_days at
+        the average daily rate of the last incubation_days.
+
+        parameters:
+            start_date:    the date the simulation starts on.
+
+            ascertainment: the fraction of infections that are confirmed,
+                           the cases are divided by it.
+
+        returns:
+            An int64 array with the S, E, I and R of each location.
+        """
+        assert not self.confirmed is None, "The model has no confirmed cases to calibrate from!"
+        assert 0 < ascertainment <= 1, "ascertainment needs to be in (0, 1]"
+        date_index = self.getDateIndex(start_date)
+        confirmed = np.asarray(self.confirmed, dtype=np.float64) / ascertainment
+
+        def cases_before(days):
+            return confirmed[:, max(date_index - int(round(days)), 0)]
+
+        incubation_window = max(int(round(self.incubation_days)), 1)
+        removed = cases_before(self.infectious_days)
+        infectious = confirmed[:, date_index] - removed
+        daily_cases = (confirmed[:, date_index] - cases_before(incubation_window)) / incubation_window
+        exposed = daily_cases * self.incubation_days
+
+        state = np.rint(np.maximum(np.stack([np.zeros_like(removed), exposed, infectious, removed]), 0)).astype(np.int64)
+        # The infected can not be more than the population
+        populations = np.rint(self.populations).astype(np.int64)
+        infected = state[1:].sum(axis=0)
+        over = infected > populations
+        if over.any():
+            state[1:, over] = np.floor(state[1:, over] * (populations[over] / infected[over])).astype(np.int64)
+        state[0] = populations - state[1:].sum(axis=0)
+        return state
+
+    def seedInfections(self, locations, infectious=1):
+        """
+        Returns initial conditions with no infections except infectious
+        people in each of locations.
+        """
+        state = np.zeros((len(SEIR_COMPARTMENTS), len(self.location_names)), dtype=np.int64)
+        for location in locations:
+            state[2, self.location_index[location]] = infectious
+        state[0] = np.rint(self.populations).astype(np.int64) - state[2]
+        return state
+
+    def getTravelSchedule(self, dates, border_closures=None):
+        """
+        Returns the travel matrices used on each date, only dates where the
+        matrix changes are included.
+
+        parameters:
+            dates:           the dates of the simulation.
+
+            border_closures: a BorderClosureIndex, the routes between
+                             locations are removed from the date either
+                             location closes its borders to the other.
+
+        returns:
+            A list of (date index, travel matrix) with the first on date
+            index 0. The travel matrix is the number of people travelling
+            from location ii to location jj each day.
+        """
+        travel = self.routes * self.travel_per_route
+        if border_closures is None:
+            return [(0, travel)]
+
+        with span('MetapopulationModel.getTravelSchedule') as stage:
+            # Closures are looked up by dates of the COVID datasets, which
+            # the simulation can run past
+            known_dates = set(self.dates)
+            closure_dates = self.dates + [date for date in dates if not date in known_dates]
+            border_closures = border_closures.forDates(closure_dates)
+            offset = border_closures.getDateIndex(dates[0])
+
+            change_indexes = set()
+            for closures in border_closures.closures.values():
+                for epoch_starts, _epoch_policies in closures.values():
+                    change_indexes.update(int(epoch_start) - offset for epoch_start in epoch_starts)
+            change_indexes = [0] + sorted(index for index in change_indexes if 0 < index < len(dates))
+
+            travel = travel.tocoo()
+            names = np.asarray(self.location_names, dtype=object)
+            departs = names[travel.row].tolist()
+            arrivals = names[travel.col].tolist()
+            edge_ids = border_closures.getEdgeIds(departs, arrivals)
+            schedule = []
+            previous_blocked = None
+            for change_index in change_indexes:
+                blocked = border_closures.blockedEdgeIds(edge_ids, change_index + offset)
+                stage.count('edges_checked', len(departs))
+                if not previous_blocked is None and np.array_equal(blocked, previous_blocked):
+                    continue
+                open_travel = travel.copy()
+                open_travel.data[blocked] = 0
+                open_travel = open_travel.tocsr()
+                open_travel.eliminate_zeros()
+                schedule.append((change_index, open_travel))
+                previous_blocked = blocked
+        return schedule
+
+    def _simulateBatch(self, initial, schedule, num_days, replicates, steps_per_day, seed):
+        """
+        Runs replicates simulations as the first dimension of the state
+        arrays with a random generator seeded by seed.
+
+        returns:
+            An int32 array of replicates x compartments x days x locations.
+        """
+        rng = np.random.default_rng(seed)
+        state = np.broadcast_to(np.asarray(initial, dtype=np.int64), (replicates,) + np.shape(initial)).copy()
+        populations = np.maximum(state[0].sum(axis=0).astype(np.float64), 1)
+        history = np.zeros((replicates, len(SEIR_COMPARTMENTS), num_days + 1, state.shape[2]), dtype=np.int32)
+        history[:, :, 0] = state
+
+        dt = 1.0 / steps_per_day
+        exposed_probability = 1 - np.exp(-dt / self.incubation_days)
+        removed_probability = 1 - np.exp(-dt / self.infectious_days)
+        changes = dict(schedule)
+        for day in range(num_days):
+            if day in changes:
+                travel = changes[day]
+                travel_t = travel.T.tocsr()
+                # The fraction of each location's residents away each day
+                away = np.minimum(np.asarray(travel.sum(axis=1)).ravel() / populations, 1)
+                visitors = np.asarray(travel.sum(axis=0)).ravel()
+
+            for _step in range(steps_per_day):
+                susceptible, exposed, infectious = state[:, 0], state[:, 1], state[:, 2]
+                # Infectious people at each location including visitors
+                prevalence = infectious / populations
+                present_infectious = infectious + (travel_t @ prevalence.T).T
+                local_force = self.beta * present_infectious / (populations + visitors)
+                # Residents spend their time away at the locations they travel to
+                force = (1 - away) * local_force + (travel @ local_force.T).T / populations
+
+                new_exposed = rng.binomial(susceptible, 1 - np.exp(-force * dt))
+                new_infectious = rng.binomial(exposed, exposed_probability)
+                new_removed = rng.binomial(infectious, removed_probability)
+                state[:, 0] -= new_exposed
+                state[:, 1] += new_exposed - new_infectious
+                state[:, 2] += new_infectious - new_removed
+                state[:, 3] += new_removed
+            history[:, :, day + 1] = state
+        return history
+
+    def simulate(self, initial, start_date, num_days, replicates=1, seed=None, border_closures=None,
+                 steps_per_day=1, processes=1, replicates_per_task=None):
+        """
+        Runs Monte Carlo simulations of the spread from initial.
+
+        parameters:
+            initial:             the S, E, I and R of each location, from
+                                 initialConditions or seedInfections.
+
+            start_date:          the date of initial.
+
+            num_days:            the number of days to simulate.
+
+            replicates:          the number of simulations.
+
+            seed:                seed of the random numbers, the results are
+                                 the same for the same seed and
+                                 replicates_per_task whatever the number of
+                                 processes.
+
+            border_closures:     a BorderClosureIndex, for example
+                                 CovidData.getBorderClosureIndex(), or None
+                                 to keep every route open.
+
+            steps_per_day:       the number of steps each day is split into.
+
+            processes:           the number of processes the replicates are
+                                 split over, 1 runs them in this process.
+
+            replicates_per_task: the number of replicates simulated together
+                                 as one batch of arrays, defaults to
+                                 REPLICATES_PER_TASK.
+
+        returns:
+            A SimulationResult.
+        """
+        initial = np.asarray(initial, dtype=np.int64)
+        assert initial.shape == (len(SEIR_COMPARTMENTS), len(self.location_names)), "initial needs the S, E, I and R of every location!"
+        assert (initial >= 0).all(), "initial can not have negative compartments!"
+        dates = simulation_dates(start_date, num_days)
+        if replicates_per_task is None:
+            replicates_per_task = REPLICATES_PER_TASK
+        batches = [min(replicates_per_task, replicates - start) for start in range(0, replicates, replicates_per_task)]
+        seeds = np.random.SeedSequence(seed).spawn(len(batches))
+
+        with span('MetapopulationModel.simulate', replicates=replicates, num_days=num_days) as stage:
+            schedule = self.getTravelSchedule(dates, border_closures)
+            tasks = [(initial, schedule, num_days, batch, steps_per_day, batch_seed) for batch, batch_seed in zip(batches, seeds)]
+            if processes > 1 and len(tasks) > 1:
+                with Pool(min(processes, len(tasks)), initializer=_init_worker, initargs=(self,)) as pool:
+                    histories = pool.map(_simulate_task, tasks)
+            else:
+                histories = [self._simulateBatch(*task) for task in tasks]
+            stage.count('location_days', replicates * num_days * len(self.location_names))
+        return SimulationResult(dates, self.location_names, np.concatenate(histories), schedule)
+
+_worker_model = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def _simulate_task(task):
+    return _worker_model._simulateBatch(*task)
+
+class SimulationResult:
+
+    def __init__(self, dates, location_names, history, schedule=None):
+        """
+        The compartments of every replicate of a simulation.
+
+        parameters:
+            dates:          the start date and every simulated date.
+
+            location_names: the names of the locations.
+
+            history:        an array of replicates x compartments x dates x
+                            locations.
+
+            schedule:       the travel schedule of the simulation.
+        """
+        self.dates = list(dates)
+        self.location_names = list(location_names)
+        self.history = history
+        self.schedule = schedule
+
+    def getCompartment(self, compartment):
+        """
+        Returns the replicates x dates x locations array of a compartment,
+        one of 'S', 'E', 'I' and 'R'.
+        """
+        return self.history[:, SEIR_COMPARTMENTS.index(compartment)]
+
+    def getCumulativeInfections(self):
+        """
+        Returns the number of people that have been infected (E, I and R)
+        as a replicates x dates x locations array.
+        """
+        return self.history[:, 1:].sum(axis=1, dtype=np.int64)
+
+    def getQuantiles(self, compartment, quantiles=(0.05, 0.5, 0.95)):
+        """
+        Returns the quantiles over the replicates of a compartment as a
+        quantiles x dates x locations array.
+        """
+        return np.quantile(self.getCompartment(compartment), quantiles, axis=0)
+
+    def to_frame(self, compartment, statistic='mean'):
+        """
+        Returns a statistic ('mean' or a quantile) of a compartment over the
+        replicates as a dataframe with a row per location and a column per
+        date.
+        """
+        values = self.getCompartment(compartment)
+        if statistic == 'mean':
+            values = values.mean(axis=0)
+        else:
+            values = np.quantile(values, statistic, axis=0)
+        return pd.DataFrame(values.T, index=self.location_names, columns=self.dates)
+
+    def getSummary(self, initially_infected=0):
+        """
+        Summarises each location over the replicates.
+
+        returns:
+            A dataframe with the mean peak of infectious people, the mean
+            day of the peak, the mean number of people infected by the end
+            and the fraction of replicates where more than
+            initially_infected people were infected.
+        """
+        infectious = self.getCompartment('I')
+        infected = self.getCumulativeInfections()[:, -1]
+        return pd.DataFrame({
+            'Location'           : self.location_names,
+            'PeakInfectious'     : infectious.max(axis=1).mean(axis=0),
+            'PeakDay'            : infectious.argmax(axis=1).mean(axis=0),
+            'FinalInfected'      : infected.mean(axis=0),
+            'InfectedReplicates' : (infected > initially_infected).mean(axis=0)
+        }, columns=['Location', 'PeakInfectious', 'PeakDay', 'FinalInfected', 'InfectedReplicates'])
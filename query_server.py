@@ -0,0 +1,551 @@
+"""
+Local query service that keeps one warm CovidData in memory so notebooks and
+scripts do not each load every dataset and recompute the same results.
+
+    python query_server.py --socket dataset/covid_query.sock
+
+    from query_server import CovidDataClient
+    with CovidDataClient('dataset/covid_query.sock') as covid_data:
+        data, routes = covid_data.getData(bin_region_column='state', country='Australia')
+"""
+import os, sys, json, time, socket, struct, asyncio, argparse, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from instrumentation import span
+from lru_cache import LRUCache
+
+DEFAULT_SOCKET_PATH = 'dataset/covid_query.sock'
+# Length of the header and of the body of every message
+MESSAGE_PREFIX = struct.Struct('!IQ')
+# Buffers in the body of a message start on a multiple of this many bytes
+BODY_ALIGNMENT = 8
+# Errors that are raised again by the client as the same type
+CLIENT_ERRORS = {error.__name__ : error for error in [AssertionError, ValueError, KeyError, IndexError]}
+
+class BodyWriter:
+
+    def __init__(self):
+        """
+        Collects the binary buffers of a message body, arrays are
+        referenced in the header by their offset, dtype and shape.
+        """
+        self.buffers = []
+        self.size = 0
+
+    def addArray(self, array):
+        array = np.ascontiguousarray(array)
+        entry = {'offset' : self.size, 'dtype' : array.dtype.str, 'shape' : list(array.shape)}
+        self.buffers.append(array.tobytes())
+        self.size += array.nbytes
+        padding = -array.nbytes % BODY_ALIGNMENT
+        if padding > 0:
+            self.buffers.append(b'\0' * padding)
+            self.size += padding
+        return entry
+
+    def getBody(self):
+        return b''.join(self.buffers)
+
+def read_array(entry, body):
+    """
+    Returns the array described by entry as a read only view of body.
+    """
+    dtype = np.dtype(entry['dtype'])
+    count = int(np.prod(entry['shape']))
+    return np.frombuffer(body, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+
+def _encode_column(values, writer):
+    if values.dtype == object:
+        codes, categories = pd.factorize(values)
+        assert all(isinstance(category, str) for category in categories), "Only text columns can be sent"
+        return {'kind' : 'category', 'codes' : writer.addArray(codes.astype(np.int32)), 'categories' : list(categories)}
+    assert values.dtype.kind in 'biuf', "Can not send a column of type {}".format(values.dtype)
+    return {'kind' : 'numeric', 'values' : writer.addArray(values)}
+
+def _decode_column(entry, body):
+    if entry['kind'] == 'category':
+        categories = np.array(entry['categories'] + [np.nan], dtype=object)
+        # Missing values have the code -1, the last category
+        return categories[read_array(entry['codes'], body)]
+    return read_array(entry['values'], body)
+
+def encode_frame(df, writer):
+    """
+    Encodes a dataframe in a columnar format: text columns as int32 codes
+    and their categories, numeric columns with the same dtype as one
+    columns x rows matrix, so a COVID dataset with hundreds of date columns
+    is sent as a single buffer.
+
+    returns:
+        The header of the dataframe, its buffers are added to writer.
+    """
+    header = {'columns' : df.columns.tolist(), 'num_rows' : int(df.shape[0]), 'layout' : [], 'blocks' : []}
+    block_columns = {}
+    for column_index, dtype in enumerate(df.dtypes.tolist()):
+        if not dtype == object and dtype.kind in 'biuf':
+            block_columns.setdefault(dtype.str, []).append(column_index)
+            header['layout'].append(None)
+        else:
+            header['layout'].append(_encode_column(df.iloc[:, column_index].to_numpy(), writer))
+
+    for column_indexes in block_columns.values():
+        block = np.ascontiguousarray(df.iloc[:, column_indexes].to_numpy().T)
+        header['blocks'].append({'columns' : column_indexes, 'values' : writer.addArray(block)})
+
+    index = df.index
+    if isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1:
+        header['index'] = None
+    else:
+        header['index'] = _encode_column(index.to_numpy(), writer)
+    return header
+
+def decode_frame(header, body):
+    """
+    Rebuilds a dataframe encoded by encode_frame from the body of a message.
+    """
+    columns = [None] * len(header['columns'])
+    for column_index, entry in enumerate(header['layout']):
+        if not entry is None:
+            columns[column_index] = _decode_column(entry, body)
+    for block in header['blocks']:
+        values = read_array(block['values'], body)
+        for row, column_index in enumerate(block['columns']):
+            columns[column_index] = values[row]
+
+    index = None if header['index'] is None else _decode_column(header['index'], body)
+    df = pd.DataFrame(dict(zip(range(len(columns)), columns)), index=index,
+                      columns=range(len(columns)))
+    df.columns = header['columns']
+    if index is None:
+        df.index = pd.RangeIndex(header['num_rows'])
+    return df
+
+def encode_message(header, body=b''):
+    header_bytes = json.dumps(header).encode('utf-8')
+    return MESSAGE_PREFIX.pack(len(header_bytes), len(body)) + header_bytes + body
+
+async def read_message(reader):
+    """
+    Reads a message from an asyncio stream, returns (header, body) or None
+    if the stream was closed.
+    """
+    try:
+        prefix = await reader.readexactly(MESSAGE_PREFIX.size)
+    except asyncio.IncompleteReadError:
+        return None
+    header_length, body_length = MESSAGE_PREFIX.unpack(prefix)
+    header = json.loads((await reader.readexactly(header_length)).decode('utf-8'))
+    body = await reader.readexactly(body_length) if body_length > 0 else b''
+    return header, body
+
+class CovidQueryServer:
+
+    def __init__(self, covid_data=None, cache_size=128, warm=True, verbose=True):
+        """
+        Serves the results of a CovidData to clients over a Unix socket or
+        TCP with asyncio.
+
+        Every connection is handled concurrently, but the queries are run
+        one at a time in a worker thread since CovidData is not thread
+        safe. Encoded responses are kept in a LRU cache so repeated queries
+        are answered without touching CovidData, and identical queries that
+        arrive while one is running wait for its result. The cached
+        responses are dropped whenever the cached results of CovidData are
+        cleared, for example by loadDatasets.
+
+        parameters:
+            covid_data: the CovidData to serve, created in the working
+                        directory if None.
+
+            cache_size: the number of encoded responses to keep.
+
+            warm:       if True every dataset is loaded before the server
+                        starts accepting connections.
+
+            verbose:    if True prints when the server starts and stops.
+        """
+        # Only imported when needed since the client does not need them
+        from covid_data import CovidData
+
+        self.covid_data = CovidData() if covid_data is None else covid_data
+        self.response_cache = LRUCache(cache_size)
+        self.warm = warm
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}
+        self.engines = {}
+        # The CovidData.cache_generation the cached responses belong to
+        self.cache_generation = self.covid_data.cache_generation
+        self.stats = {'connections' : 0, 'requests' : 0, 'errors' : 0, 'bytes_sent' : 0, 'seconds' : 0.0, 'methods' : {}}
+        self.methods = {
+            'getData'               : self.getData,
+            'routesToWeightedEdges' : self.routesToWeightedEdges,
+            'routesToAdjacency'     : self.routesToAdjacency,
+            'getDates'              : self.getDates,
+            'getInfectionPath'      : self.getInfectionPath,
+            # Not cached, see _respond
+            'loadDatasets'          : self.loadDatasets
+        }
+
+    def getData(self, bin_region_column='county', country=None, specific_date=None, start_date=None, end_date=None, metrics=None):
+        data, routes = self.covid_data.getData(bin_region_column, country, specific_date, start_date, end_date, metrics)
+        writer = BodyWriter()
+        header = {'data' : {data_type : encode_frame(df, writer) for data_type, df in data.items()},
+                  'routes' : encode_frame(routes, writer)}
+        return header, writer.getBody()
+
+    def routesToWeightedEdges(self, bin_region_column, country):
+        writer = BodyWriter()
+        header = {'routes' : encode_frame(self.covid_data.routesToWeightedEdges(bin_region_column, country), writer)}
+        return header, writer.getBody()
+
+    def routesToAdjacency(self, bin_region_column, country=None):
+        matrix, locations = self.covid_data.routesToAdjacency(bin_region_column, country)
+        writer = BodyWriter()
+        header = {
+            'shape'     : list(matrix.shape),
+            'data'      : writer.addArray(matrix.data),
+            'indices'   : writer.addArray(matrix.indices),
+            'indptr'    : writer.addArray(matrix.indptr),
+            'locations' : locations
+        }
+        return header, writer.getBody()
+
+    def getDates(self):
+        return {'dates' : self.covid_data.getDates()}, b''
+
+    def getInfectionPath(self, bin_region_column='state', infect_percent=1.0, border_closures=False, key_locations=None,
+                         top_parents=5):
+        """
+        Runs the infection path of a scenario like SweepRunner.
+        """
+        from sweep import ScenarioData, initial_infect_thresh, summarise_infection_path
+
+        if not bin_region_column in self.engines:
+            data = ScenarioData.fromCovidData(self.covid_data, bin_region_column)
+            self.engines[bin_region_column] = (data, data.getEngine())
+        data, engine = self.engines[bin_region_column]
+
+        infect_thresh = initial_infect_thresh(data.cases, infect_percent)
+        border_closure_index = None
+        if border_closures:
+            border_closure_index = self.covid_data.getBorderClosureIndex().forDates(engine.dates)
+        result = engine.run(infect_thresh, border_closures=border_closure_index, key_locations=key_locations)
+        _infect_graphs, location_pos, max_confirmed, infected_parents, new_locs, new_edges = result
+
+        latest_date = engine.dates[-1]
+        header = {
+            'infect_thresh'    : infect_thresh,
+            'dates'            : engine.dates,
+            'location_pos'     : {location : [float(coord) for coord in pos] for location, pos in location_pos.items()},
+            'max_confirmed'    : {date : int(confirmed) for date, confirmed in max_confirmed.items()},
+            'infected_parents' : {parent : list(children) for parent, children in infected_parents[latest_date].items()},
+            'new_locs'         : {date : list(locations) for date, locations in new_locs.items()},
+            'new_edges'        : {date : [list(edge) for edge in edges] for date, edges in new_edges.items()},
+            'summary'          : summarise_infection_path(result, len(data.location_names), top_parents)
+        }
+        return header, b''
+
+    def loadDatasets(self):
+        """
+        Reloads the datasets of CovidData, run in the worker thread.
+        """
+        self.covid_data.loadDatasets()
+        return {}, b''
+
+    def _checkCacheGeneration(self):
+        """
+        Drops the cached responses and infection path engines if the cached
+        results of CovidData were cleared since they were made.
+        """
+        if not self.covid_data.cache_generation == self.cache_generation:
+            self.response_cache.clear()
+            self.engines = {}
+            self.cache_generation = self.covid_data.cache_generation
+
+    def getServerStats(self):
+        stats = dict(self.stats)
+        stats['methods'] = {method : dict(method_stats) for method, method_stats in self.stats['methods'].items()}
+        stats['response_cache'] = self.response_cache.info()
+        stats['data_cache'] = self.covid_data.getCacheInfo()
+        return stats
+
+    def _runQuery(self, method, args):
+        """
+        Runs a query in the worker thread and returns the encoded response
+        and False if the query raised an error.
+        """
+        with span('CovidQueryServer.' + method):
+            try:
+                header, body = self.methods[method](**args)
+                return encode_message({'status' : 'ok', 'result' : header}, body), True
+            except Exception as error:
+                return encode_message({'status' : 'error', 'error' : type(error).__name__, 'message' : str(error)}), False
+
+    async def _respond(self, request):
+        method = request.get('method', None)
+        args = request.get('args', {})
+        if method == 'getServerStats':
+            return encode_message({'status' : 'ok', 'result' : self.getServerStats()}), False, True
+        if method == 'loadDatasets':
+            message, ok = await asyncio.get_running_loop().run_in_executor(self.executor, self._runQuery, method, args)
+            self._checkCacheGeneration()
+            return message, False, ok
+        if not method in self.methods:
+            return encode_message({'status' : 'error', 'error' : 'ValueError', 'message' : "Unknown method {}".format(method)}), False, False
+
+        self._checkCacheGeneration()
+        key = json.dumps([method, args], sort_keys=True)
+        message = self.response_cache.get(key)
+        if not message is None:
+            return message, True, True
+
+        future = self.pending.get(key, None)
+        if future is None:
+            generation = self.cache_generation
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self._runQuery, method, args)
+            self.pending[key] = future
+            future.add_done_callback(lambda _future: self.pending.pop(key, None))
+        else:
+            generation = None
+        message, ok = await future
+        self._checkCacheGeneration()
+        # Responses made before the datasets were reloaded are not cached
+        if ok and generation == self.cache_generation:
+            self.response_cache.put(key, message)
+        return message, False, ok
+
+    async def handleConnection(self, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                request, _body = message
+                start = time.perf_counter()
+                response, cache_hit, ok = await self._respond(request)
+                writer.write(response)
+                await writer.drain()
+
+                seconds = time.perf_counter() - start
+                method_stats = self.stats['methods'].setdefault(str(request.get('method')), {'requests' : 0, 'cache_hits' : 0, 'seconds' : 0.0})
+                method_stats['requests'] += 1
+                method_stats['cache_hits'] += int(cache_hit)
+                method_stats['seconds'] += seconds
+                self.stats['requests'] += 1
+                self.stats['bytes_sent'] += len(response)
+                self.stats['seconds'] += seconds
+                self.stats['errors'] += int(not ok)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def start(self, socket_path=DEFAULT_SOCKET_PATH, host=None, port=None):
+        """
+        Starts listening on the Unix socket socket_path, or on host and port
+        if port is not None.
+
+        returns:
+            The asyncio Server.
+        """
+        if self.warm:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.covid_data.warm)
+        if port is None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handleConnection, path=socket_path)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(self.handleConnection, host=host, port=port)
+            address = "{}:{}".format(host, server.sockets[0].getsockname()[1])
+        if self.verbose:
+            print("Serving COVID data on {}".format(address))
+        return server
+
+    async def serve(self, socket_path=DEFAULT_SOCKET_PATH, host=None, port=None):
+        """
+        Serves clients until the task is cancelled.
+        """
+        server = await self.start(socket_path, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if port is None and os.path.exists(socket_path):
+                os.remove(socket_path)
+            if self.verbose:
+                print("Stopped serving COVID data")
+
+    def serveInThread(self, socket_path=DEFAULT_SOCKET_PATH, host=None, port=None):
+        """
+        Serves clients from a daemon thread with its own event loop, for
+        example from a notebook or a benchmark.
+
+        returns:
+            The address to connect to, the socket path or (host, port).
+            Raises the error of start if the server could not start.
+        """
+        started = threading.Event()
+        address = []
+        errors = []
+
+        def run():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                server = loop.run_until_complete(self.start(socket_path, host, port))
+            except Exception as error:
+                errors.append(error)
+                started.set()
+                loop.close()
+                return
+            address.append(socket_path if port is None else (host, server.sockets[0].getsockname()[1]))
+            started.set()
+            loop.run_until_complete(server.serve_forever())
+
+        threading.Thread(target=run, daemon=True).start()
+        started.wait()
+        if len(errors) > 0:
+            raise errors[0]
+        return address[0]
+
+class CovidDataClient:
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, host=None, port=None, timeout=None):
+        """
+        Connects to a CovidQueryServer, the methods have the same signatures
+        and return values as the methods of CovidData.
+
+        parameters:
+            socket_path: the Unix socket of the server.
+
+            host, port:  connect over TCP instead if port is not None.
+
+            timeout:     seconds to wait for a response, None waits forever.
+        """
+        if port is None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.settimeout(timeout)
+            self.socket.connect(socket_path)
+        else:
+            self.socket = socket.create_connection((host, port), timeout=timeout)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.socket.close()
+
+    def _receive(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            num_bytes = self.socket.recv_into(view[received:])
+            if num_bytes == 0:
+                raise ConnectionError("The server closed the connection")
+            received += num_bytes
+        return data
+
+    def query(self, method, **args):
+        """
+        Sends a query to the server and returns the result header and body.
+        """
+        with self.lock:
+            self.socket.sendall(encode_message({'method' : method, 'args' : args}))
+            header_length, body_length = MESSAGE_PREFIX.unpack(self._receive(MESSAGE_PREFIX.size))
+            header = json.loads(self._receive(header_length).decode('utf-8'))
+            body = bytes(self._receive(body_length)) if body_length > 0 else b''
+
+        if header['status'] == 'error':
+            raise CLIENT_ERRORS.get(header['error'], RuntimeError)(header['message'])
+        return header['result'], body
+
+    def getData(self, bin_region_column='county', country=None, specific_date=None, start_date=None, end_date=None, metrics=None):
+        result, body = self.query('getData', bin_region_column=bin_region_column, country=country,
+                                  specific_date=specific_date, start_date=start_date, end_date=end_date,
+                                  metrics=None if metrics is None else list(metrics))
+        data = {data_type : decode_frame(frame, body) for data_type, frame in result['data'].items()}
+        return data, decode_frame(result['routes'], body)
+
+    def routesToWeightedEdges(self, bin_region_column, country):
+        result, body = self.query('routesToWeightedEdges', bin_region_column=bin_region_column, country=country)
+        return decode_frame(result['routes'], body)
+
+    def routesToAdjacency(self, bin_region_column, country=None):
+        result, body = self.query('routesToAdjacency', bin_region_column=bin_region_column, country=country)
+        matrix = sparse.csr_matrix((read_array(result['data'], body), read_array(result['indices'], body),
+                                    read_array(result['indptr'], body)), shape=tuple(result['shape']))
+        return matrix, result['locations']
+
+    def getDates(self):
+        return self.query('getDates')[0]['dates']
+
+    def getInfectionPath(self, bin_region_column='state', infect_percent=1.0, border_closures=False, key_locations=None,
+                         top_parents=5):
+        """
+        Returns the infection path of a scenario, computed once by the server
+        with the same cleaning and threshold as SweepRunner.
+
+        returns:
+            A dictionary with the infect_thresh, dates, location_pos,
+            max_confirmed, the infected_parents on the latest date, new_locs,
+            new_edges and the summary from summarise_infection_path. The
+            infection graph of a date has the new_locs and new_edges of
+            every date up to it.
+        """
+        result, _body = self.query('getInfectionPath', bin_region_column=bin_region_column, infect_percent=infect_percent,
+                                   border_closures=border_closures, key_locations=key_locations, top_parents=top_parents)
+        result['location_pos'] = {location : tuple(pos) for location, pos in result['location_pos'].items()}
+        result['new_edges'] = {date : [tuple(edge) for edge in edges] for date, edges in result['new_edges'].items()}
+        return result
+
+    def loadDatasets(self):
+        """
+        Makes the server reload its datasets, for example after they were
+        refreshed, and drop its cached responses.
+        """
+        self.query('loadDatasets')
+
+    def getServerStats(self):
+        """
+        Returns the number of requests, cache hits and time spent on each
+        method of the server.
+        """
+        return self.query('getServerStats')[0]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serves the COVID datasets from one warm CovidData")
+    parser.add_argument("-s", "--socket", type=str, default=DEFAULT_SOCKET_PATH,
+                        help="the Unix socket to listen on")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="the host to listen on if --port is given")
+    parser.add_argument("-p", "--port", type=int, default=None,
+                        help="listen on TCP instead of the Unix socket")
+    parser.add_argument("-c", "--cache_size", type=int, default=128,
+                        help="the number of encoded responses to keep in memory")
+    parser.add_argument("--no_warm", action="store_true",
+                        help="load the datasets when they are first queried instead of at start up")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = CovidQueryServer(cache_size=args.cache_size, warm=not args.no_warm)
+    try:
+        asyncio.run(server.serve(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from locations import LOCATION_COLUMNS
+
+ROUTE_SIDES = ['Depart', 'Arrival']
+
+class RouteAggregates:
+
+    def __init__(self, routes_df, registry):
+        """
+        The number of routes between locations at the county, state and
+        country level, computed once from the routes dataset.
+
+        The routes are counted by their integer location IDs instead of
+        grouping by strings. The locations are numbered in sorted order of
+        their location columns so the aggregates come out in the same order
+        as a groupby of the filled routes.
+
+        parameters:
+            routes_df: the routes dataset loaded by CovidData, with a row for
+                       every route. The DepartLocationID and ArrivalLocationID
+                       columns are used if they exist, otherwise the
+                       locations are registered.
+
+            registry:  the LocationRegistry the location IDs belong to.
+        """
+        self.registry = registry
+        self.num_routes = routes_df.shape[0]
+        route_ids = []
+        for side in ROUTE_SIDES:
+            if side + 'LocationID' in routes_df.columns:
+                route_ids.append(routes_df[side + 'LocationID'].to_numpy(dtype=np.int64))
+            else:
+                route_ids.append(registry.register(routes_df, side))
+        route_ids = np.concatenate(route_ids)
+
+        self.aggregates = {bin_region_column : self._aggregate(bin_region_column, route_ids) for bin_region_column in LOCATION_COLUMNS}
+
+    def _aggregate(self, bin_region_column, route_ids):
+        ranks = self.registry.getSortRanks(bin_region_column)
+        location_ranks, location_index = np.unique(ranks[self.registry.getRollup('county', bin_region_column)[route_ids]],
+                                                   return_inverse=True)
+        num_locations = len(location_ranks)
+
+        edge_keys = location_index[:self.num_routes]*num_locations + location_index[self.num_routes:]
+        edges, num_of_routes = np.unique(edge_keys, return_counts=True)
+
+        # The registry IDs of the locations in sorted order
+        sorted_ids = np.argsort(ranks)
+        return {
+            'location_ids'  : sorted_ids[location_ranks],
+            'departs'       : edges // num_locations,
+            'arrivals'      : edges % num_locations,
+            'num_of_routes' : num_of_routes.astype(np.int64)
+        }
+
+    def _selectEdges(self, bin_region_column, country):
+        aggregate = self.aggregates[bin_region_column]
+        departs = aggregate['departs']
+        arrivals = aggregate['arrivals']
+        num_of_routes = aggregate['num_of_routes']
+        if not country == None:
+            country_id = self.registry.getID((str(country),), 'country')
+            location_countries = self.registry.getRollup(bin_region_column, 'country')[aggregate['location_ids']]
+            within = (location_countries[departs] == country_id) & (location_countries[arrivals] == country_id)
+            departs = departs[within]
+            arrivals = arrivals[within]
+            num_of_routes = num_of_routes[within]
+        return aggregate['location_ids'], departs, arrivals, num_of_routes
+
+    def getEdges(self, bin_region_column, country=None):
+        """
+        Returns the number of routes between locations in the same format as
+        CovidData.routesToWeightedEdges.
+
+        parameters:
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            country:           If not None then only the routes within that
+                               country are returned.
+        """
+        location_ids, departs, arrivals, num_of_routes = self._selectEdges(bin_region_column, country)
+        location_columns = self.registry.getColumns(bin_region_column)
+
+        edges = {}
+        for side, edge_locations in zip(ROUTE_SIDES, [departs, arrivals]):
+            for column, values in zip(LOCATION_COLUMNS[bin_region_column], location_columns):
+                edges[side + column] = values[location_ids[edge_locations]]
+        edges['NumberOfRoutes'] = num_of_routes
+        return pd.DataFrame(edges, columns=list(edges))
+
+    def getAdjacency(self, bin_region_column, country=None):
+        """
+        Returns the number of routes between locations as a sparse matrix so
+        graph algorithms do not need to build a dataframe or networkx graph.
+
+        parameters:
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            country:           If not None then only the routes within that
+                               country are used.
+
+        returns:
+            A scipy.sparse csr_matrix where entry (ii, jj) is the number of
+            routes departing location ii and arriving at location jj, and the
+            names of the locations of the rows and columns. Only locations
+            with a route are included, sorted by their location columns.
+        """
+        location_ids, departs, arrivals, num_of_routes = self._selectEdges(bin_region_column, country)
+        used_locations, edge_locations = np.unique(np.concatenate([departs, arrivals]), return_inverse=True)
+        num_locations = len(used_locations)
+        matrix = sparse.csr_matrix((num_of_routes, (edge_locations[:len(departs)], edge_locations[len(departs):])),
+                                   shape=(num_locations, num_locations), dtype=np.int64)
+        return matrix, self.registry.getNames(location_ids[used_locations], bin_region_column)
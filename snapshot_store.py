@@ -0,0 +1,161 @@
+from collections.abc import Mapping
+from types import MappingProxyType
+import networkx as nx
+from lru_cache import LRUCache
+
+class SnapshotStore(Mapping):
+
+    def __init__(self, cache_size=8):
+        """
+        Stores a snapshot for every date as the changes made on that date
+        rather than a full copy. Snapshots are only rebuilt when they are
+        looked up and the most recently used ones are kept in a LRU cache.
+
+        Behaves like a read only dictionary mapping dates to snapshots.
+
+        parameters:
+            cache_size: the number of rebuilt snapshots to keep in memory.
+        """
+        self.dates = []
+        self.date_positions = {}
+        self.deltas = []
+        self.cache = LRUCache(cache_size)
+
+    def __getitem__(self, date):
+        position = self.date_positions[date]
+        snapshot = self.cache.get(date)
+        if snapshot is None:
+            snapshot = self._materialize(position)
+            self.cache.put(date, snapshot)
+        return snapshot
+
+    def __iter__(self):
+        return iter(self.dates)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, date):
+        return date in self.date_positions
+
+    def _addDelta(self, date, delta):
+        assert not date in self.date_positions, "{} already has a snapshot".format(date)
+        self.date_positions[date] = len(self.dates)
+        self.dates.append(date)
+        self.deltas.append(delta)
+
+    def _materialize(self, position):
+        # Start from the closest snapshot before position that is still cached
+        base_position = -1
+        base = None
+        for cached_date, cached_snapshot in self.cache.items():
+            cached_position = self.date_positions[cached_date]
+            if base_position < cached_position < position:
+                base_position = cached_position
+                base = cached_snapshot
+
+        state = self._emptyState() if base is None else self._copyState(base)
+        for delta in self.deltas[base_position + 1:position + 1]:
+            self._applyDelta(state, delta)
+        return self._freezeState(state)
+
+    def _emptyState(self):
+        raise NotImplementedError
+
+    def _copyState(self, snapshot):
+        raise NotImplementedError
+
+    def _applyDelta(self, state, delta):
+        raise NotImplementedError
+
+    def _freezeState(self, state):
+        raise NotImplementedError
+
+
+class GraphSnapshotStore(SnapshotStore):
+    """
+    Infection graphs for each date stored as the nodes and edges added, nodes
+    removed and the changes to the 'confirmed' node attribute on each date.
+
+    Looking up a date returns a frozen networkx Graph. Use .copy() on it if
+    the graph needs to be modified.
+    """
+
+    def addSnapshot(self, date, added_nodes, added_edges, removed_nodes, confirmed_changes):
+        """
+        Records the changes made to the infection graph on date.
+
+        parameters:
+            added_nodes:       list of (node, attribute dict) in the order
+                               they were added to the graph.
+
+            added_edges:       list of (node, node) in the order they were
+                               added to the graph.
+
+            removed_nodes:     list of nodes removed after adding the edges.
+
+            confirmed_changes: dictionary of the new 'confirmed' attribute
+                               for the nodes where it changed.
+        """
+        self._addDelta(date, (added_nodes, added_edges, removed_nodes, confirmed_changes))
+
+    def _emptyState(self):
+        return nx.Graph()
+
+    def _copyState(self, snapshot):
+        return snapshot.copy()
+
+    def _applyDelta(self, graph, delta):
+        added_nodes, added_edges, removed_nodes, confirmed_changes = delta
+        for node, attributes in added_nodes:
+            graph.add_node(node, **attributes)
+        graph.add_edges_from(added_edges)
+        graph.remove_nodes_from(removed_nodes)
+        for node, confirmed in confirmed_changes.items():
+            graph.nodes[node]['confirmed'] = confirmed
+
+    def _freezeState(self, graph):
+        return nx.freeze(graph)
+
+
+class ParentsSnapshotStore(SnapshotStore):
+    """
+    Infected parents for each date stored as the parents added, the locations
+    they could of infected on that date and the parents removed.
+
+    Looking up a date returns a read only mapping of parent location to the
+    list of locations it could of infected.
+    """
+
+    def addSnapshot(self, date, added_parents, added_children, removed_parents):
+        """
+        Records the changes made to the infected parents on date.
+
+        parameters:
+            added_parents:   list of new parents in the order they were added.
+
+            added_children:  list of (parent, child) in the order the
+                             children were appended to the parents.
+
+            removed_parents: list of parents removed afterwards.
+        """
+        self._addDelta(date, (added_parents, added_children, removed_parents))
+
+    def _emptyState(self):
+        return {}
+
+    def _copyState(self, snapshot):
+        return snapshot.copy()
+
+    def _applyDelta(self, parents, delta):
+        added_parents, added_children, removed_parents = delta
+        for parent in added_parents:
+            parents[parent] = []
+        for parent, child in added_children:
+            parents[parent] = parents[parent] + [child]
+        for parent in removed_parents:
+            if parent in parents:
+                del parents[parent]
+
+    def _freezeState(self, parents):
+        return MappingProxyType(parents)
@@ -0,0 +1,329 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import itertools
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import networkx as nx
+from infection_path import RouteAdjacency, InfectionPathEngine
+from locations import LOCATION_COLUMNS, get_location_names
+from border_closures import BorderClosureIndex
+
+SUMMARY_COLUMNS = ['Scenario', 'bin_region_column', 'infect_percent', 'border_closures', 'key_locations',
+                   'infect_thresh', 'Locations', 'Edges', 'Components', 'LargestComponent', 'Coverage',
+                   'NewLocations', 'TopParents', 'Seconds']
+
+def initial_infect_thresh(cases, infect_percent):
+    """
+    Same as get_initial_infect_thresh in the infection path notebook, the
+    cases on the latest date of the location infect_percent of the way from
+    the top, but never less than 1.
+    """
+    latest_cases = np.sort(np.asarray(cases)[:, -1])
+    infect_thresh = latest_cases[int(latest_cases.shape[0]*(1 - infect_percent))]
+    if infect_thresh <= 0:
+        infect_thresh = 1
+    return int(infect_thresh)
+
+class ScenarioData:
+    CASES_FILENAME = "cases.npy"
+    COORDINATES_FILENAME = "coordinates.npy"
+    META_FILENAME = "meta.json"
+    ADJACENCY_FILENAMES = ["adjacency_indptr.npy", "adjacency_indices.npy", "route_pairs.npy", "route_counts.npy"]
+
+    def __init__(self, bin_region_column, dates, location_names, coordinates, cases, adjacency_locations, adjacency_arrays):
+        """
+        The case matrix and route adjacency of one bin_region_column as
+        arrays, so the processes of a sweep can memory-map them from disk
+        instead of each being sent the dataframes.
+        """
+        self.bin_region_column = bin_region_column
+        self.dates = list(dates)
+        self.location_names = list(location_names)
+        self.coordinates = coordinates
+        self.cases = cases
+        self.adjacency_locations = list(adjacency_locations)
+        self.adjacency_arrays = adjacency_arrays
+
+    @classmethod
+    def fromCovidData(cls, covid_data, bin_region_column, clean=True):
+        """
+        parameters:
+            covid_data:        a CovidData.
+
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            clean:             if True locations without coordinates (Lat
+                               and Long of 0) are left out like clean_data in
+                               the infection path notebook.
+        """
+        data, routes = covid_data.getData(bin_region_column=bin_region_column)
+        data_confirmed = data['confirmed']
+        if clean:
+            data_confirmed = data_confirmed.loc[(data_confirmed['Lat'] != 0) & (data_confirmed['Long'] != 0)]
+
+        location_columns = LOCATION_COLUMNS[bin_region_column]
+        dates = [column for column in data_confirmed.columns if not column in location_columns + ['Lat', 'Long']]
+        adjacency = RouteAdjacency(routes, bin_region_column)
+        return cls(bin_region_column, dates, get_location_names(data_confirmed, bin_region_column),
+                   data_confirmed[['Lat', 'Long']].to_numpy(dtype=np.float64),
+                   data_confirmed[dates].to_numpy(), adjacency.locations, adjacency.toArrays())
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, self.CASES_FILENAME), self.cases)
+        np.save(os.path.join(folder, self.COORDINATES_FILENAME), self.coordinates)
+        for filename, array in zip(self.ADJACENCY_FILENAMES, self.adjacency_arrays):
+            np.save(os.path.join(folder, filename), array)
+        meta = {
+            'bin_region_column'   : self.bin_region_column,
+            'dates'               : self.dates,
+            'location_names'      : self.location_names,
+            'adjacency_locations' : self.adjacency_locations
+        }
+        with open(os.path.join(folder, self.META_FILENAME), 'w') as fp:
+            json.dump(meta, fp)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        with open(os.path.join(folder, cls.META_FILENAME), 'r') as fp:
+            meta = json.load(fp)
+        cases = np.load(os.path.join(folder, cls.CASES_FILENAME), mmap_mode=mmap_mode)
+        coordinates = np.load(os.path.join(folder, cls.COORDINATES_FILENAME), mmap_mode=mmap_mode)
+        adjacency_arrays = [np.load(os.path.join(folder, filename), mmap_mode=mmap_mode) for filename in cls.ADJACENCY_FILENAMES]
+        return cls(meta['bin_region_column'], meta['dates'], meta['location_names'], coordinates, cases,
+                   meta['adjacency_locations'], adjacency_arrays)
+
+    def getEngine(self):
+        """
+        Returns an InfectionPathEngine using the arrays of this data.
+        """
+        adjacency = RouteAdjacency.fromArrays(self.adjacency_locations, *self.adjacency_arrays,
+                                              bin_region_column=self.bin_region_column)
+        return InfectionPathEngine.fromArrays(self.dates, self.location_names, self.coordinates[:, 0],
+                                              self.coordinates[:, 1], self.cases, adjacency, self.bin_region_column)
+
+class SweepGrid:
+
+    def __init__(self, infect_percents=(1.0,), bin_region_columns=('state',), border_closures=(False,),
+                 key_locations=None):
+        """
+        Declarative grid of infection path scenarios, every combination of
+        the values is a scenario.
+
+        parameters:
+            infect_percents:    percentages given to get_initial_infect_thresh
+                                for the infection threshold.
+
+            bin_region_columns: any of 'county', 'state' and 'country'.
+
+            border_closures:    any of True and False.
+
+            key_locations:      dictionary of a name to a list of key
+                                locations (or None for no key locations).
+                                Defaults to {'all' : None}.
+        """
+        self.infect_percents = list(infect_percents)
+        self.bin_region_columns = list(bin_region_columns)
+        self.border_closures = list(border_closures)
+        self.key_locations = {'all' : None} if key_locations is None else dict(key_locations)
+
+    def getScenarios(self):
+        """
+        Returns the list of scenarios as dictionaries. Border closures and
+        key locations can not be used with counties, so those combinations
+        are left out.
+        """
+        scenarios = []
+        for bin_region_column, infect_percent, border_closures, key_name in itertools.product(
+                self.bin_region_columns, self.infect_percents, self.border_closures, self.key_locations):
+            if bin_region_column == 'county' and (border_closures or not self.key_locations[key_name] is None):
+                continue
+            scenarios.append({
+                'Scenario'          : len(scenarios),
+                'bin_region_column' : bin_region_column,
+                'infect_percent'    : infect_percent,
+                'border_closures'   : border_closures,
+                'key_locations'     : key_name
+            })
+        return scenarios
+
+    def __len__(self):
+        return len(self.getScenarios())
+
+def summarise_infection_path(result, num_locations, top_parents=5):
+    """
+    Summarises the result of InfectionPathEngine.run for the sweep table.
+
+    returns:
+        A dictionary with the number of infected locations and edges on the
+        latest date, the number of connected components, the fraction of the
+        infected locations in the largest component, the fraction of all
+        locations infected, the number of new locations on each date and
+        the top_parents locations that could of infected the most locations.
+    """
+    infect_graphs, _location_pos, _max_confirmed, infected_parents, new_locs, _new_edges = result
+    latest_date = list(infect_graphs)[-1]
+    latest_graph = infect_graphs[latest_date]
+    component_sizes = [len(component) for component in nx.connected_components(latest_graph)]
+    parents = infected_parents[latest_date]
+    parent_counts = sorted(((len(children), parent) for parent, children in parents.items() if len(children) > 0),
+                           key=lambda entry: (-entry[0], entry[1]))
+
+    num_nodes = latest_graph.number_of_nodes()
+    return {
+        'Locations'        : num_nodes,
+        'Edges'            : latest_graph.number_of_edges(),
+        'Components'       : len(component_sizes),
+        'LargestComponent' : max(component_sizes) / num_nodes if num_nodes > 0 else 0.0,
+        'Coverage'         : num_nodes / num_locations if num_locations > 0 else 0.0,
+        'NewLocations'     : [len(new_locs.get(date, [])) for date in infect_graphs],
+        'TopParents'       : [(parent, count) for count, parent in parent_counts[:top_parents]]
+    }
+
+_worker_data = None
+_worker_engines = {}
+_worker_border_closures = None
+_worker_border_indexes = {}
+
+def _init_worker(data_folders, border_closures):
+    global _worker_data, _worker_engines, _worker_border_closures, _worker_border_indexes
+    _worker_data = {bin_region_column : ScenarioData.load(folder) for bin_region_column, folder in data_folders.items()}
+    _worker_engines = {}
+    _worker_border_closures = border_closures
+    _worker_border_indexes = {}
+
+def run_scenario(scenario, key_locations, top_parents=5):
+    """
+    Runs one scenario of a sweep in a worker process.
+    """
+    start = time.perf_counter()
+    bin_region_column = scenario['bin_region_column']
+    data = _worker_data[bin_region_column]
+    if not bin_region_column in _worker_engines:
+        _worker_engines[bin_region_column] = data.getEngine()
+    engine = _worker_engines[bin_region_column]
+
+    infect_thresh = initial_infect_thresh(data.cases, scenario['infect_percent'])
+    border_closures = None
+    if scenario['border_closures']:
+        if not bin_region_column in _worker_border_indexes:
+            _worker_border_indexes[bin_region_column] = BorderClosureIndex(_worker_border_closures, engine.dates)
+        border_closures = _worker_border_indexes[bin_region_column]
+
+    result = engine.run(infect_thresh, border_closures=border_closures, key_locations=key_locations)
+    row = dict(scenario)
+    row['infect_thresh'] = infect_thresh
+    row.update(summarise_infection_path(result, len(data.location_names), top_parents))
+    row['Seconds'] = time.perf_counter() - start
+    return row
+
+def _run_scenario(args):
+    return run_scenario(*args)
+
+class SweepRunner:
+
+    def __init__(self, covid_data, processes=None, data_folder=None, top_parents=5, verbose=True):
+        """
+        Runs the scenarios of a SweepGrid over a pool of processes. The case
+        matrices and route adjacencies are saved once as .npy files that the
+        processes memory-map, so only the scenario parameters are sent to
+        each process.
+
+        parameters:
+            covid_data:  a CovidData.
+
+            processes:   the number of processes, defaults to the number of
+                         CPUs. 1 runs the scenarios in this process.
+
+            data_folder: where the shared arrays are saved, a temporary
+                         folder removed after the sweep if None.
+
+            top_parents: the number of top parents in the summary.
+
+            verbose:     if True prints the progress and the time of each
+                         scenario.
+        """
+        self.covid_data = covid_data
+        self.processes = os.cpu_count() if processes is None else processes
+        self.data_folder = data_folder
+        self.top_parents = top_parents
+        self.verbose = verbose
+
+    def prepare(self, bin_region_columns, folder):
+        """
+        Saves the ScenarioData of each bin_region_column in folder.
+
+        returns:
+            A dictionary of bin_region_column to the folder of its data.
+        """
+        data_folders = {}
+        for bin_region_column in bin_region_columns:
+            data_folders[bin_region_column] = os.path.join(folder, bin_region_column)
+            ScenarioData.fromCovidData(self.covid_data, bin_region_column).save(data_folders[bin_region_column])
+        return data_folders
+
+    def runIter(self, grid):
+        """
+        Runs the scenarios of grid and yields the summary of each scenario
+        as it finishes, not in the order of the scenarios.
+        """
+        scenarios = grid.getScenarios()
+        bin_region_columns = sorted(set(scenario['bin_region_column'] for scenario in scenarios))
+        border_closures = None
+        if any(scenario['border_closures'] for scenario in scenarios):
+            border_closures = self.covid_data.loadBorderDataset()
+
+        folder = tempfile.mkdtemp() if self.data_folder is None else self.data_folder
+        try:
+            data_folders = self.prepare(bin_region_columns, folder)
+            tasks = [(scenario, grid.key_locations[scenario['key_locations']], self.top_parents) for scenario in scenarios]
+            start = time.perf_counter()
+
+            if self.processes > 1 and len(tasks) > 1:
+                pool = Pool(min(self.processes, len(tasks)), initializer=_init_worker,
+                            initargs=(data_folders, border_closures))
+                rows = pool.imap_unordered(_run_scenario, tasks)
+            else:
+                pool = None
+                _init_worker(data_folders, border_closures)
+                rows = map(_run_scenario, tasks)
+
+            try:
+                for done, row in enumerate(rows, start=1):
+                    if self.verbose:
+                        print("[{}/{}] {} infect_percent={} border_closures={} key_locations={}: {} locations in {:.2f}s ({:.1f}s elapsed)".format(
+                            done, len(tasks), row['bin_region_column'], row['infect_percent'], row['border_closures'],
+                            row['key_locations'], row['Locations'], row['Seconds'], time.perf_counter() - start))
+                    yield row
+            finally:
+                if not pool is None:
+                    pool.close()
+                    pool.join()
+        finally:
+            if self.data_folder is None:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    def run(self, grid, output_csv=None):
+        """
+        Runs the scenarios of grid.
+
+        parameters:
+            grid:       a SweepGrid.
+
+            output_csv: if not None each summary is appended to this .csv
+                        file as soon as its scenario finishes.
+
+        returns:
+            The summary table as a dataframe sorted by scenario.
+        """
+        rows = []
+        for row in self.runIter(grid):
+            rows.append(row)
+            if not output_csv is None:
+                pd.DataFrame([row], columns=SUMMARY_COLUMNS).to_csv(output_csv, mode='w' if len(rows) == 1 else 'a',
+                                                                    header=len(rows) == 1, index=False)
+        return pd.DataFrame(rows, columns=SUMMARY_COLUMNS).sort_values('Scenario').reset_index(drop=True)
@@ -0,0 +1,267 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from locations import LOCATION_COLUMNS, get_location_names
+
+METRICS = ['confirmed', 'deaths', 'recovered']
+COORDINATE_COLUMNS = ['Lat', 'Long']
+STORE_META = 'store.json'
+
+def aggregate_locations(df, bin_region_column, dates):
+    """
+    Sums the cases of dates and averages the coordinates of the rows of a
+    filled COVID dataframe that share a location.
+
+    parameters:
+        df:                A COVID dataframe with missing values filled with
+                           "none".
+
+        bin_region_column: Is either 'county', 'state' or 'country'. The
+                           county dataset is returned as is.
+
+        dates:             The date columns to aggregate.
+
+    returns:
+        A dataframe with the location columns, Lat, Long and dates.
+    """
+    if bin_region_column == 'county':
+        return df
+
+    grouped = df.groupby(LOCATION_COLUMNS[bin_region_column])
+    new_df = pd.concat([grouped[COORDINATE_COLUMNS].mean(), grouped[dates].sum()], axis=1)
+    # Order is required so Lat and Long are before dates
+    new_df.columns = COORDINATE_COLUMNS + list(dates)
+    return new_df.reset_index()
+
+class TimeSeriesStore:
+
+    def __init__(self, bin_region_column, locations, dates, metrics, coordinates):
+        """
+        Dense store of the COVID time series, one locations x dates int32
+        matrix per metric, so cases can be looked up by position instead of
+        through pandas.
+
+        parameters:
+            bin_region_column: Is either 'county', 'state' or 'country'.
+
+            locations:         A dataframe with the location columns of each
+                               row of the matrices.
+
+            dates:             The list of dates, the columns of the matrices.
+
+            metrics:           A dictionary mapping 'confirmed', 'deaths' and
+                               (for countries) 'recovered' to the matrices.
+                               The matrices can be memory-mapped.
+
+            coordinates:       A dictionary mapping each metric to a
+                               locations x 2 matrix of Lat and Long, the
+                               datasets do not always agree on coordinates.
+        """
+        self.bin_region_column = bin_region_column
+        self.locations = locations.reset_index(drop=True)
+        self.dates = list(dates)
+        self.metrics = metrics
+        self.coordinates = coordinates
+        self.location_names = get_location_names(self.locations, bin_region_column)
+        self.location_index = {name : ii for ii, name in enumerate(self.location_names)}
+        self.date_index = {date : ii for ii, date in enumerate(self.dates)}
+
+        for metric, matrix in metrics.items():
+            assert matrix.shape == (len(self.location_names), len(self.dates)), "The {} matrix does not match the locations and dates!".format(metric)
+            assert coordinates[metric].shape == (len(self.location_names), 2), "The {} coordinates do not match the locations!".format(metric)
+
+    @classmethod
+    def fromFrames(cls, frames, bin_region_column):
+        """
+        Builds the store from dataframes with the layout returned by
+        CovidData.getData. Every metric is aligned to the locations of the
+        confirmed dataframe, locations missing from a metric are set to 0.
+        """
+        confirmed_df = frames['confirmed']
+        location_columns = LOCATION_COLUMNS[bin_region_column]
+        dates = [column for column in confirmed_df.columns if not column in location_columns + COORDINATE_COLUMNS]
+        locations = confirmed_df[location_columns].reset_index(drop=True)
+        names = get_location_names(locations, bin_region_column)
+
+        metrics = {}
+        coordinates = {}
+        for metric in METRICS:
+            if not metric in frames:
+                continue
+            df = frames[metric]
+            values = df[dates].to_numpy(dtype=np.int32)
+            coords = df[COORDINATE_COLUMNS].to_numpy(dtype=np.float64)
+            metric_names = get_location_names(df, bin_region_column)
+            if not metric_names == names:
+                row_index = {name : ii for ii, name in enumerate(metric_names)}
+                rows = [row_index.get(name, -1) for name in names]
+                missing = np.asarray(rows) < 0
+                values = values[rows]
+                values[missing] = 0
+                coords = coords[rows]
+                coords[missing] = np.nan
+            metrics[metric] = values
+            coordinates[metric] = coords
+
+        return cls(bin_region_column, locations, dates, metrics, coordinates)
+
+    @classmethod
+    def fromCovidManager(cls, covid_manager, bin_region_column='county'):
+        """
+        Builds the store from the datasets of a CovidManager. Recovered is
+        only included for countries, like CovidData.getData.
+        """
+        assert bin_region_column in LOCATION_COLUMNS, "Invalid region parsed to bin_region_column! Needs to be county, state or country"
+        datasets = covid_manager.getDatasets()
+        frames = {
+            'confirmed' : datasets['full']['confirmed'].fillna("none"),
+            'deaths'    : datasets['full']['deaths'].fillna("none")
+        }
+        if bin_region_column == 'country':
+            frames['recovered'] = datasets['covid_recovered'].fillna("none")
+
+        dates = frames['confirmed'].columns[5:].to_list()
+        frames = {metric : aggregate_locations(df, bin_region_column, dates) for metric, df in frames.items()}
+        return cls.fromFrames(frames, bin_region_column)
+
+    @classmethod
+    def fromCovidData(cls, covid_data, bin_region_column='county', country=None):
+        """
+        Builds the store from the result of CovidData.getData.
+        """
+        data, _routes = covid_data.getData(bin_region_column=bin_region_column, country=country)
+        return cls.fromFrames(data, bin_region_column)
+
+    def save(self, folder):
+        """
+        Saves the matrices as .npy files with the locations and dates in
+        store.json so the store can be memory-mapped by TimeSeriesStore.load.
+        """
+        os.makedirs(folder, exist_ok=True)
+        for metric, matrix in self.metrics.items():
+            np.save(os.path.join(folder, metric + '.npy'), np.ascontiguousarray(matrix, dtype=np.int32))
+            np.save(os.path.join(folder, metric + '_coordinates.npy'), self.coordinates[metric])
+
+        meta = {
+            'bin_region_column' : self.bin_region_column,
+            'dates'             : self.dates,
+            'metrics'           : list(self.metrics),
+            'locations'         : {column : self.locations[column].tolist() for column in self.locations.columns}
+        }
+        with open(os.path.join(folder, STORE_META), 'w') as fp:
+            json.dump(meta, fp)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """
+        Loads a store saved with TimeSeriesStore.save.
+
+        parameters:
+            folder:    the folder the store was saved to.
+
+            mmap_mode: passed to numpy.load, with the default 'r' the matrices
+                       are memory-mapped read only so processes loading the
+                       same folder share the pages instead of copying them.
+                       If None the matrices are read into memory.
+        """
+        with open(os.path.join(folder, STORE_META), 'r') as fp:
+            meta = json.load(fp)
+
+        metrics = {metric : np.load(os.path.join(folder, metric + '.npy'), mmap_mode=mmap_mode) for metric in meta['metrics']}
+        coordinates = {metric : np.load(os.path.join(folder, metric + '_coordinates.npy')) for metric in meta['metrics']}
+        locations = pd.DataFrame(meta['locations'], columns=LOCATION_COLUMNS[meta['bin_region_column']])
+        return cls(meta['bin_region_column'], locations, meta['dates'], metrics, coordinates)
+
+    def getMetrics(self):
+        return list(self.metrics)
+
+    def getDates(self):
+        return list(self.dates)
+
+    def getLocationNames(self):
+        return list(self.location_names)
+
+    def getLocationIndex(self, location):
+        """
+        Returns the row of location, either a location name like
+        "County:State:Country" or a tuple of the location columns.
+        """
+        if isinstance(location, tuple):
+            location = ':'.join(str(value) for value in location)
+        return self.location_index[location]
+
+    def getDateIndex(self, date):
+        return self.date_index[date]
+
+    def getMatrix(self, metric):
+        """
+        Returns the locations x dates matrix of metric.
+        """
+        assert metric in self.metrics, "{} is not in the store! The store has {}".format(metric, self.getMetrics())
+        return self.metrics[metric]
+
+    def getCases(self, metric, location, date):
+        """
+        Returns the number of cases of metric at location on date.
+        """
+        return int(self.getMatrix(metric)[self.getLocationIndex(location), self.date_index[date]])
+
+    def getLocationSeries(self, metric, location):
+        """
+        Returns the cases of metric at location for every date as a view of
+        the matrix.
+        """
+        return self.getMatrix(metric)[self.getLocationIndex(location)]
+
+    def getDateSlice(self, metric, date):
+        """
+        Returns the cases of metric for every location on date as a view of
+        the matrix.
+        """
+        return self.getMatrix(metric)[:, self.date_index[date]]
+
+    def select(self, locations=None, dates=None):
+        """
+        Returns a store with only some of the locations and dates.
+
+        parameters:
+            locations: a list of location names or tuples, or None for all
+                       locations.
+
+            dates:     a list of dates, a slice of dates (start and stop
+                       inclusive, like pandas .loc) or None for all dates.
+
+        returns:
+            A TimeSeriesStore, the matrices are views when the selection
+            is a range of dates for all locations.
+        """
+        if locations is None:
+            rows = slice(None)
+            new_locations = self.locations
+        else:
+            rows = [self.getLocationIndex(location) for location in locations]
+            new_locations = self.locations.iloc[rows]
+
+        if dates is None:
+            columns = slice(None)
+        elif isinstance(dates, slice):
+            start = 0 if dates.start is None else self.date_index[dates.start]
+            stop = len(self.dates) if dates.stop is None else self.date_index[dates.stop] + 1
+            columns = slice(start, stop)
+        else:
+            columns = [self.date_index[date] for date in dates]
+        new_dates = np.asarray(self.dates, dtype=object)[columns].tolist()
+
+        metrics = {metric : matrix[rows][:, columns] for metric, matrix in self.metrics.items()}
+        coordinates = {metric : coords[rows] for metric, coords in self.coordinates.items()}
+        return TimeSeriesStore(self.bin_region_column, new_locations, new_dates, metrics, coordinates)
+
+    def to_frame(self, metric):
+        """
+        Returns metric as a dataframe with the same layout as the dataframes
+        returned by CovidData.getData.
+        """
+        coordinates_df = pd.DataFrame(self.coordinates[metric], columns=COORDINATE_COLUMNS)
+        cases_df = pd.DataFrame(self.getMatrix(metric).astype(np.int64), columns=self.dates)
+        return pd.concat([self.locations, coordinates_df, cases_df], axis=1)